@@ -0,0 +1,407 @@
+"""
+Benchmarks of feature extraction, decoding, prediction and training,
+and of the accuracy impact of the resamplers.
+
+Everything runs offline: the audio is synthesized, and the models are
+trained by the unchanged training scripts on a synthetic feature table
+with the layout of features_3_sec.csv. Only the effect of the resamplers
+on the predictions needs models trained on real data, which are taken
+from --resampling-models. The results are written to a JSON
+file and can be compared against a baseline from an earlier run, e.g.
+before and after upgrading librosa or xgboost.
+
+Usage:
+    python -m benchmarks.benchmark -o results.json
+    python -m benchmarks.benchmark -o new.json --baseline results.json
+    python -m benchmarks.benchmark --only resampling --resampling-models models
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import soundfile as sf
+from typing import Callable, Dict, List, Optional
+import src.core.audio_feature_extractor as extractor
+import src.core.genre_prediction as prediction
+from src.core.audio_cache import AudioCache
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+GENRES = ["blues", "classical", "country", "disco", "hiphop",
+          "jazz", "metal", "pop", "reggae", "rock"]
+
+# Model and encoder names used by the training scripts
+TRAINING_SCRIPTS = {
+    "rf": ("src.core.rf_training", "rf_model", "rf_encoder"),
+    "gbm": ("src.core.gbm_training", "gb_model", "gb_encoder"),
+    "xgboost": ("src.core.xgboost_training", "xgb_model", "xgb_encoder"),
+}
+
+# Relative slowdown of the best time reported as a regression
+REGRESSION_THRESHOLD = 0.1
+
+
+def synthesize_audio(duration: float, sampling_rate: int = extractor.SAMPLING_RATE,
+                     seed: int = 0) -> np.ndarray:
+    """
+    Generate a deterministic music-like signal: a few harmonic tones, a
+    click track at a fixed tempo and some background noise.
+
+    Parameters:
+        duration: Length of the signal in seconds.
+        sampling_rate: Sampling rate of the signal.
+        seed: Seed of the noise generator.
+
+    Returns:
+        The mono signal as a float32 array in [-1, 1].
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sampling_rate)) / sampling_rate
+
+    signal = np.zeros_like(t)
+    for frequency in (220.0, 277.2, 329.6):
+        for harmonic in range(1, 4):
+            signal += np.sin(2 * np.pi * frequency * harmonic * t) / harmonic
+
+    # Decaying noise bursts at 120 BPM
+    beat_phase = (t * 2.0) % 1.0
+    signal += 2.0 * np.exp(-beat_phase * 40) * rng.standard_normal(len(t))
+    signal += 0.05 * rng.standard_normal(len(t))
+
+    return (0.9 * signal / np.max(np.abs(signal))).astype(np.float32)
+
+
+def measure(function: Callable, repeats: int, warmup: int = 1) -> Dict[str, float]:
+    """
+    Time a function.
+
+    Parameters:
+        function: The function to call without arguments.
+        repeats: Number of timed calls.
+        warmup: Number of untimed calls before the timed ones.
+
+    Returns:
+        The best, mean and median wall time of a call in seconds and the
+            number of timed calls.
+    """
+    for _ in range(warmup):
+        function()
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return {
+        "min": float(np.min(times)),
+        "mean": float(np.mean(times)),
+        "median": float(np.median(times)),
+        "repeats": repeats,
+    }
+
+
+def benchmark_features(durations: List[float], repeats: int) -> Dict[str, Dict]:
+    results = {}
+    for duration in durations:
+        audio_data = synthesize_audio(duration)
+
+        context = extractor.SpectralContext(audio_data)
+        results[f"features/{duration:g}s/spectral_context"] = measure(
+            lambda: extractor.SpectralContext(audio_data), repeats)
+        for name, block in extractor.FEATURE_BLOCKS:
+            results[f"features/{duration:g}s/{name}"] = measure(
+                lambda block=block: block(context), repeats)
+
+        for profile in extractor.FEATURE_PROFILES:
+            results[f"features/{duration:g}s/extract_features[{profile}]"] = measure(
+                lambda profile=profile: extractor.extract_features(audio_data, profile),
+                repeats)
+            results[f"features/{duration:g}s/extract_segment_features[{profile}]"] = measure(
+                lambda profile=profile: extractor.extract_segment_features(
+                    audio_data, profile=profile),
+                repeats)
+            results[f"features/{duration:g}s/extract_features_batch[{profile}]"] = measure(
+                lambda profile=profile: extractor.extract_features_batch(
+                    extractor.segment_audio(audio_data), profile=profile),
+                repeats)
+    return results
+
+
+def benchmark_decoding(directory: str, durations: List[float],
+                       repeats: int) -> Dict[str, Dict]:
+    # Sources at 44.1 kHz, so that resampling is part of the cost
+    native_rate = 44100
+    formats = {"wav": "WAV", "flac": "FLAC"}
+    if "MP3" in sf.available_formats():
+        formats["mp3"] = "MP3"
+    else:
+        print("libsndfile cannot write MP3, skipping MP3 decoding", file=sys.stderr)
+
+    cache = AudioCache(os.path.join(directory, "audio_cache"))
+    results = {}
+    for duration in durations:
+        audio_data = synthesize_audio(duration, native_rate)
+        for extension, sf_format in formats.items():
+            path = os.path.join(directory, f"decode_{duration:g}s.{extension}")
+            sf.write(path, audio_data, native_rate, format=sf_format)
+            results[f"load_audio/{extension}/{duration:g}s"] = measure(
+                lambda path=path: extractor.load_audio(path), repeats)
+            results[f"probe_audio/{extension}/{duration:g}s"] = measure(
+                lambda path=path: extractor.probe_audio(path), repeats)
+            # The warmup call fills the cache
+            results[f"load_audio_cached/{extension}/{duration:g}s"] = measure(
+                lambda path=path: extractor.load_audio(path, cache=cache), repeats)
+    return results
+
+
+def write_synthetic_features(directory: str, rows: int, seed: int = 0):
+    """
+    Write a feature table with the layout of features_3_sec.csv where
+    the features of each genre are drawn from a different distribution.
+
+    Parameters:
+        directory: Working directory of the training scripts.
+        rows: Number of rows of the table.
+        seed: Seed of the random generator.
+    """
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(len(GENRES), size=rows)
+    centers = rng.standard_normal((len(GENRES), len(extractor.FEATURE_COLUMNS)))
+    features = centers[labels] + rng.standard_normal((rows, len(extractor.FEATURE_COLUMNS)))
+
+    data = pd.DataFrame(features, columns=extractor.FEATURE_COLUMNS)
+    data.insert(0, "filename", [f"track{i}.wav" for i in range(rows)])
+    data.insert(1, "length", extractor.SEGMENT_LENGTH)
+    data["label"] = [GENRES[label] for label in labels]
+
+    # The training scripts read this Windows-style relative path
+    os.makedirs(os.path.join(directory, "data"), exist_ok=True)
+    data.to_csv(os.path.join(directory, r"data\features_3_sec.csv"), index=False)
+
+
+def benchmark_training(directory: str, rows: int,
+                       models: List[str]) -> Dict[str, Dict]:
+    write_synthetic_features(directory, rows)
+    environment = dict(os.environ, PYTHONPATH=REPO_ROOT)
+
+    results = {}
+    for model in models:
+        module = TRAINING_SCRIPTS[model][0]
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-m", module], cwd=directory, env=environment,
+                       check=True, stdout=subprocess.DEVNULL)
+        results[f"training/{model}"] = {"min": time.perf_counter() - start,
+                                        "repeats": 1, "rows": rows}
+    return results
+
+
+def benchmark_prediction(directory: str, models: List[str], repeats: int,
+                         batch_size: int) -> Dict[str, Dict]:
+    features = extractor.extract_segment_features(synthesize_audio(90.0))
+    matrix = extractor.features_to_matrix(features)
+    batch = np.resize(matrix, (batch_size, matrix.shape[1]))
+
+    results = {}
+    for model in models:
+        _, model_name, encoder_name = TRAINING_SCRIPTS[model]
+        classifier = prediction.MusicGenreClassifier(
+            os.path.join(directory, model_name + ".pkl"),
+            os.path.join(directory, encoder_name + ".pkl"))
+
+        results[f"predict/{model}/single_row"] = measure(
+            lambda: classifier.predict_feature_probabilities(batch[:1]), repeats)
+        batched = measure(lambda: classifier.predict_feature_probabilities(batch), repeats)
+        batched["per_row"] = batched["min"] / batch_size
+        results[f"predict/{model}/batch_{batch_size}"] = batched
+
+        compiled = prediction.MusicGenreClassifier(
+            os.path.join(directory, model_name + ".pkl"),
+            os.path.join(directory, encoder_name + ".pkl"), compiled=True)
+        batched = measure(lambda: compiled.predict_feature_probabilities(batch), repeats)
+        batched["per_row"] = batched["min"] / batch_size
+        batched["max_probability_change"] = float(np.max(np.abs(
+            compiled.predict_feature_probabilities(batch)
+            - classifier.predict_feature_probabilities(batch))))
+        results[f"predict/{model}/compiled_batch_{batch_size}"] = batched
+    return results
+
+
+def benchmark_resampling(directory: str, models: List[str], repeats: int,
+                         models_directory: Optional[str] = None,
+                         clips: int = 5, duration: float = 30.0) -> Dict[str, Dict]:
+    """
+    Measure the speed of every resampler on 44.1 kHz sources and how much
+    it changes the features compared to soxr_hq, the resampler the models
+    are validated with.
+
+    Whether the changed features change the predicted genres can only be
+    judged with models trained on real data, the models of the training
+    benchmark learned synthetic noise. The predictions are therefore only
+    compared if a directory of real models is given.
+
+    Parameters:
+        directory: Directory to write the audio clips to.
+        models: Model types to compare the predictions of.
+        repeats: Timed calls per resampler.
+        models_directory: Directory with the models and label encoders
+            written by the training scripts, the predictions are not
+            compared if None.
+        clips: Number of synthesized clips.
+        duration: Duration of each clip in seconds.
+
+    Raises:
+        IOError: If models_directory has none of the models.
+    """
+    native_rate = 44100
+    paths = []
+    for seed in range(clips):
+        path = os.path.join(directory, f"resample_{seed}.wav")
+        sf.write(path, synthesize_audio(duration, native_rate, seed), native_rate)
+        paths.append(path)
+
+    classifiers = {}
+    if models_directory is not None:
+        for model in models:
+            _, model_name, encoder_name = TRAINING_SCRIPTS[model]
+            model_path = os.path.join(models_directory, model_name + ".pkl")
+            if os.path.isfile(model_path):
+                classifiers[model] = prediction.MusicGenreClassifier(
+                    model_path, os.path.join(models_directory, encoder_name + ".pkl"))
+        if not classifiers:
+            raise IOError(f"No trained models found in {models_directory}")
+
+    def segment_features(resampler: str) -> np.ndarray:
+        return np.concatenate([
+            extractor.features_to_matrix(extractor.extract_segment_features(
+                extractor.load_audio(path, resampler)[0]))
+            for path in paths])
+
+    reference = segment_features(extractor.DEFAULT_RESAMPLER)
+    reference_probabilities = {model: classifier.predict_feature_probabilities(reference)
+                               for model, classifier in classifiers.items()}
+    scale = np.abs(reference).mean(axis=0) + 1e-12
+
+    results = {}
+    for resampler in extractor.RESAMPLERS:
+        timing = measure(lambda: extractor.load_audio(paths[0], resampler), repeats)
+        features = segment_features(resampler)
+        timing["feature_error"] = float(np.median(np.abs(features - reference) / scale))
+        results[f"resample/{resampler}/load_audio"] = timing
+
+        for model, classifier in classifiers.items():
+            probabilities = classifier.predict_feature_probabilities(features)
+            results[f"resample/{resampler}/{model}"] = {
+                "agreement": float(np.mean(probabilities.argmax(axis=1) ==
+                                           reference_probabilities[model].argmax(axis=1))),
+                "max_probability_change": float(np.max(np.abs(
+                    probabilities - reference_probabilities[model]))),
+            }
+    return results
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict],
+            threshold: float = REGRESSION_THRESHOLD) -> List[str]:
+    """
+    Compare the best times of two benchmark runs.
+
+    Parameters:
+        results: Results of the current run.
+        baseline: Results of the baseline run.
+        threshold: Relative slowdown reported as a regression.
+
+    Returns:
+        The names of the benchmarks that regressed.
+    """
+    regressions = []
+    print(f"{'benchmark':60} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name in sorted(results.keys() & baseline.keys()):
+        # Accuracy results have no timing
+        if "min" not in results[name] or "min" not in baseline[name]:
+            continue
+        old, new = baseline[name]["min"], results[name]["min"]
+        change = (new - old) / old if old > 0 else 0.0
+        marker = ""
+        if change > threshold:
+            regressions.append(name)
+            marker = "  REGRESSION"
+        print(f"{name:60} {old:10.4f} {new:10.4f} {change:+8.1%}{marker}")
+    return regressions
+
+
+def _environment() -> Dict[str, str]:
+    versions = {"python": platform.python_version(), "platform": platform.platform()}
+    for package in ("librosa", "numpy", "scipy", "sklearn", "xgboost", "soundfile"):
+        try:
+            versions[package] = __import__(package).__version__
+        except ImportError:
+            versions[package] = None
+    return versions
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Run the benchmarks.")
+    parser.add_argument("-o", "--output", default="benchmark_results.json",
+                        help="file to write the results to")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--repeats", type=int, default=5, help="timed calls per benchmark")
+    parser.add_argument("--durations", type=float, nargs="+", default=[3.0, 30.0, 120.0],
+                        help="durations of the synthetic audio in seconds")
+    parser.add_argument("--models", nargs="+", choices=list(TRAINING_SCRIPTS),
+                        default=list(TRAINING_SCRIPTS), help="model types to benchmark")
+    parser.add_argument("--training-rows", type=int, default=9990,
+                        help="rows of the synthetic training table")
+    parser.add_argument("--batch-size", type=int, default=256,
+                        help="rows of the batched prediction benchmark")
+    parser.add_argument("--resampling-models", default=None, metavar="DIRECTORY",
+                        help="directory of models trained on real data, the resampling "
+                             "benchmark compares their predictions (default: only the "
+                             "feature changes are reported)")
+    parser.add_argument("--only", nargs="+",
+                        choices=("features", "decoding", "training", "prediction",
+                                 "resampling"),
+                        help="run only some of the benchmark groups")
+    args = parser.parse_args(argv)
+
+    groups = set(args.only or ("features", "decoding", "training", "prediction",
+                               "resampling"))
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        if "features" in groups:
+            results.update(benchmark_features(args.durations, args.repeats))
+        if "decoding" in groups:
+            results.update(benchmark_decoding(directory, args.durations, args.repeats))
+        # Predictions use the models trained by the training benchmark
+        if groups & {"training", "prediction"}:
+            results.update(benchmark_training(directory, args.training_rows, args.models))
+        if "prediction" in groups:
+            results.update(benchmark_prediction(directory, args.models, args.repeats,
+                                                args.batch_size))
+        if "resampling" in groups:
+            results.update(benchmark_resampling(directory, args.models, args.repeats,
+                                                args.resampling_models))
+
+    with open(args.output, mode="w") as file:
+        json.dump({"environment": _environment(), "results": results}, file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline)
+        if regressions:
+            print(f"{len(regressions)} benchmarks regressed by more than "
+                  f"{REGRESSION_THRESHOLD:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
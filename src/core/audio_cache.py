@@ -0,0 +1,174 @@
+"""
+This module contains a cache of decoded audio.
+
+Decoding and resampling compressed files is a large fixed cost of every
+prediction and of every rebuild of the training features. The cache
+keeps the decoded 22.05 kHz mono float32 signal of each file as an .npy
+file named after a hash of the absolute source path, its modification
+time and size and the resampler. Cached signals are memory-mapped, so
+load_audio returns views into the page cache that are shared by all
+processes reading the same file instead of private copies.
+
+The cache directory is bounded in size. The modification time of a cache
+file is its last use, and the least recently used files are deleted
+first once the directory exceeds its budget. The size of the directory
+is counted once when the cache is opened and then kept as a running
+total, the directory is only scanned again when the total exceeds the
+budget. Several processes may share one cache directory, their writes
+are picked up by that scan.
+"""
+import hashlib
+import os
+import threading
+import numpy as np
+from numpy.typing import NDArray
+from typing import Dict, Optional
+import src.core.audio_feature_extractor as extractor
+
+
+MAX_DISK_BYTES = 4 * 1024 * 1024 * 1024
+
+
+class AudioCache:
+    """
+    A disk cache of decoded audio with LRU eviction.
+    """
+    def __init__(self, directory: str, max_disk_bytes: int = MAX_DISK_BYTES):
+        """
+        Initialize the cache.
+
+        Parameters:
+            directory: Directory of the cached signals, created if needed.
+            max_disk_bytes: Size limit of the directory.
+        """
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._disk_bytes = sum(size for _, size, _ in self._scan())
+
+    def load(self, file_path: str, resampler: str = extractor.DEFAULT_RESAMPLER,
+             cancel: Optional[threading.Event] = None) -> NDArray[np.float32]:
+        """
+        Get the decoded signal of a file, decoding it on a miss.
+
+        Parameters:
+            file_path: The path to the audio file.
+            resampler: The resampling backend, one of extractor.RESAMPLERS.
+            cancel: An event that stops the decoding of a miss when it is
+                set, see extractor.load_audio.
+
+        Returns:
+            A read-only memory-mapped array of the signal at
+                extractor.SAMPLING_RATE.
+
+        Raises:
+            IOError: If the file cannot be loaded.
+            CancelledError: If the cancel event was set.
+        """
+        cache_path = self._cache_path(file_path, resampler)
+        try:
+            audio_data = np.load(cache_path, mmap_mode="r")
+            # Mark the file as recently used for the eviction
+            os.utime(cache_path)
+            with self._lock:
+                self.hits += 1
+            return audio_data
+        except (OSError, ValueError):
+            pass
+
+        audio_data, _ = extractor.load_audio(file_path, resampler, cancel=cancel)
+        with self._lock:
+            self.misses += 1
+        if audio_data.size == 0:
+            # Empty files cannot be memory-mapped
+            return audio_data
+
+        # Written under a temporary name first, readers never see a
+        # partial file
+        temporary_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, mode="wb") as file:
+            np.save(file, np.ascontiguousarray(audio_data, dtype=np.float32))
+        os.replace(temporary_path, cache_path)
+        with self._lock:
+            self._disk_bytes += os.path.getsize(cache_path)
+        self._evict(keep=cache_path)
+
+        return np.load(cache_path, mmap_mode="r")
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the hit/miss counters of this process and the size of the
+        cache directory.
+
+        Returns:
+            A dictionary with the number of hits, misses, files and bytes.
+        """
+        entries = self._entries()
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "files": len(entries),
+                "disk_bytes": sum(entry.stat().st_size for entry in entries),
+            }
+
+    def clear(self):
+        """
+        Delete all cached signals.
+        """
+        for entry in self._entries():
+            self._remove(entry.path)
+        with self._lock:
+            self._disk_bytes = sum(size for _, size, _ in self._scan())
+
+    def _cache_path(self, file_path: str, resampler: str) -> str:
+        status = os.stat(file_path)
+        key = (f"{os.path.abspath(file_path)}:{status.st_mtime_ns}:{status.st_size}:"
+               f"{resampler}:{extractor.SAMPLING_RATE}")
+        name = hashlib.blake2b(key.encode(), digest_size=20).hexdigest()
+        return os.path.join(self.directory, name + ".npy")
+
+    def _entries(self) -> list:
+        return [entry for entry in os.scandir(self.directory)
+                if entry.is_file() and entry.name.endswith(".npy")]
+
+    def _scan(self) -> list:
+        # The last use, size and path of every cached signal
+        entries = []
+        for entry in self._entries():
+            try:
+                status = entry.stat()
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, entry.path))
+        return entries
+
+    def _evict(self, keep: str):
+        # Deletes the least recently used files until the directory fits
+        # into its budget, except the file that was just written. The
+        # running total misses the writes of other processes and files
+        # that were replaced, so the directory is scanned before anything
+        # is deleted.
+        with self._lock:
+            if self._disk_bytes <= self.max_disk_bytes:
+                return
+            entries = self._scan()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_disk_bytes:
+                    break
+                if path != keep and self._remove(path):
+                    total -= size
+            self._disk_bytes = total
+
+    def _remove(self, path: str) -> bool:
+        # Files that are still mapped cannot be deleted on Windows, they
+        # are evicted by a later call instead
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
@@ -13,44 +13,271 @@ features extraction. Using lossy formats such as MP3 or OGG can
 have an impact on the feature extraction and the quality of prediction.
 
 The sampling rate for the training data was 22050 Hz.
+
+Every spectral feature is derived from a single STFT of the signal
+instead of letting each librosa feature function compute its own
+transform.
 """
+import audioread
 import librosa
+import os
 import numpy as np
+import scipy.signal
+import soundfile
+import soxr
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 from numpy.typing import NDArray
-from typing import Tuple, Dict
+from typing import Tuple, Dict, List, NamedTuple, Optional
+import src.core.profiling as profiling
 
 
 SAMPLING_RATE = 22050
 
+# Analysis parameters of the training features (the librosa defaults)
+N_FFT = 2048
+HOP_LENGTH = 512
+N_MFCC = 20
+TOP_DB = 80.0
+
+# Bump whenever a change to the extraction changes the feature values,
+# so that features stored by earlier versions are not reused
+FEATURE_VERSION = 1
+
+# Names of the features computed by each feature block
+BLOCK_COLUMNS = {
+    "chroma": ["chroma_stft_mean", "chroma_stft_var"],
+    "rms": ["rms_mean", "rms_var"],
+    "spectral": ["spectral_centroid_mean", "spectral_centroid_var",
+                 "spectral_bandwidth_mean", "spectral_bandwidth_var",
+                 "rolloff_mean", "rolloff_var"],
+    "zero_crossing_rate": ["zero_crossing_rate_mean", "zero_crossing_rate_var"],
+    "hpss": ["harmony_mean", "harmony_var", "perceptr_mean", "perceptr_var"],
+    "tempo": ["tempo"],
+    "mfcc": [f"mfcc{i}_{stat}" for i in range(1, N_MFCC + 1) for stat in ("mean", "var")],
+}
+
+# Names of the extracted features in the column order of the training data
+FEATURE_COLUMNS = [name for columns in BLOCK_COLUMNS.values() for name in columns]
+
+# Named subsets of the feature blocks. The "fast" profile skips the
+# harmonic/percussive separation and the tempo estimation, which take
+# most of the extraction time. Every profile needs a model trained on
+# its own columns.
+FEATURE_PROFILES = {
+    "full": list(BLOCK_COLUMNS),
+    "fast": ["chroma", "rms", "spectral", "zero_crossing_rate", "mfcc"],
+}
+DEFAULT_PROFILE = "full"
+
+# Length of the 3 second segments the training features were computed
+# on (the 'length' column of features_3_sec.csv)
+SEGMENT_LENGTH = 66149
 
-def load_audio(file_path: str) -> Tuple[NDArray[np.float32], int]:
+# Maximum relative difference between the features computed from the
+# shared STFT and the ones computed by calling each librosa feature
+# function on the raw signal. The transforms are the same, so the only
+# differences come from floating point summation order.
+FEATURE_RTOL = 1e-5
+
+# Resampling backends of load_audio:
+# - soxr_hq: the librosa default, which the models are validated with,
+# - soxr_qq: the fastest soxr quality, with a short, wide filter,
+# - polyphase: scipy's polyphase filter over the reduced rate ratio,
+# - integer: a short polyphase filter for integer rate ratios such as
+#   44.1 kHz to 22.05 kHz, falling back to soxr_qq for other ratios.
+RESAMPLERS = ("soxr_hq", "soxr_qq", "polyphase", "integer")
+DEFAULT_RESAMPLER = "soxr_hq"
+
+# Half length of the filter of the integer resampler in output samples
+INTEGER_FILTER_HALF_LENGTH = 8
+
+# Number of frames decoded and downmixed at once
+DECODE_BLOCK_FRAMES = 1 << 16
+
+
+def load_audio(file_path: str, resampler: str = DEFAULT_RESAMPLER,
+               offset: float = 0.0,
+               duration: Optional[float] = None,
+               cache=None,
+               cancel: Optional[threading.Event] = None) -> Tuple[NDArray[np.float32], int]:
     """
     Load an audio file and return the audio data and
     sampling rate.
     
+    The file is decoded block by block and every block is downmixed to
+    mono right away, so multichannel audio is never held in memory as a
+    whole. The mono signal is then resampled to SAMPLING_RATE, unless
+    the file already has that rate.
+    
+    With a cache the whole file is decoded once and stored, and the
+    requested window is returned as a read-only view into the
+    memory-mapped signal.
+    
     Parameters:
         file_path: The path to the audio file.
+        resampler: The resampling backend, one of RESAMPLERS.
+        offset: Start of the decoded window in seconds.
+        duration: Length of the decoded window in seconds, up to the end
+            of the file if None.
+        cache: An AudioCache of decoded signals, every call decodes the
+            file if None.
+        cancel: An event that stops the decoding when it is set. It is
+            checked between blocks of files that soundfile can read.
         
     Returns:
         A tuple containing audio data as a numpy array and the
             sampling rate.
     
     Raises:
+        ValueError: If the resampler is unknown.
         IOError: If the file cannot be loaded.
+        CancelledError: If the cancel event was set.
     """
+    if resampler not in RESAMPLERS:
+        raise ValueError(f"Unknown resampler '{resampler}', expected one of {RESAMPLERS}")
+    
+    if cache is not None:
+        audio_data = cache.load(file_path, resampler, cancel)
+        start = int(offset * SAMPLING_RATE)
+        stop = None if duration is None else start + int(duration * SAMPLING_RATE)
+        return audio_data[start:stop], SAMPLING_RATE
+    
     try:
-        audio_data, sr = librosa.load(file_path, sr=SAMPLING_RATE)
-        return audio_data, sr
+        with profiling.stage("load_audio"):
+            with profiling.stage("load_audio.decode"):
+                audio_data, native_rate = _decode_mono(file_path, offset, duration, cancel)
+            with profiling.stage("load_audio.resample"):
+                audio_data = resample(audio_data, native_rate, SAMPLING_RATE, resampler)
+        return audio_data, SAMPLING_RATE
+    except CancelledError:
+        raise
     except Exception as e:
         raise IOError(f"Error loading {file_path}: {e}")
 
 
+def _decode_mono(file_path: str, offset: float, duration: Optional[float],
+                 cancel: Optional[threading.Event] = None) -> Tuple[NDArray[np.float32], int]:
+    try:
+        sound_file = soundfile.SoundFile(file_path)
+    except Exception:
+        # Formats libsndfile cannot read are decoded through audioread
+        return librosa.load(file_path, sr=None, mono=True, offset=offset, duration=duration)
+    
+    with sound_file:
+        native_rate = sound_file.samplerate
+        start = min(int(offset * native_rate), sound_file.frames)
+        frames = sound_file.frames - start
+        if duration is not None:
+            frames = min(frames, int(duration * native_rate))
+        if start > 0:
+            sound_file.seek(start)
+        
+        audio_data = np.empty(frames, dtype=np.float32)
+        position = 0
+        while position < frames:
+            if cancel is not None and cancel.is_set():
+                raise CancelledError()
+            block = sound_file.read(min(DECODE_BLOCK_FRAMES, frames - position),
+                                    dtype="float32", always_2d=True)
+            if len(block) == 0:
+                break
+            audio_data[position:position + len(block)] = block.mean(axis=1)
+            position += len(block)
+    
+    return audio_data[:position], native_rate
+
+
+def resample(audio_data: NDArray[np.float32], orig_sr: int, target_sr: int,
+             resampler: str = DEFAULT_RESAMPLER) -> NDArray[np.float32]:
+    """
+    Resample mono audio data.
+    
+    Parameters:
+        audio_data: The audio data as a NumPy array.
+        orig_sr: Sampling rate of the audio data.
+        target_sr: Sampling rate to resample to.
+        resampler: The resampling backend, one of RESAMPLERS.
+        
+    Returns:
+        The resampled audio data, or the audio data itself if the rates
+            are equal. Like librosa.resample the length is rounded up.
+    """
+    if orig_sr == target_sr:
+        return audio_data
+    
+    if resampler == "integer" and orig_sr % target_sr != 0:
+        resampler = "soxr_qq"
+    
+    if resampler == "integer":
+        factor = orig_sr // target_sr
+        taps = scipy.signal.firwin(2 * INTEGER_FILTER_HALF_LENGTH * factor + 1, 1.0 / factor)
+        resampled = scipy.signal.resample_poly(audio_data, 1, factor, window=taps)
+    elif resampler == "polyphase":
+        gcd = np.gcd(orig_sr, target_sr)
+        resampled = scipy.signal.resample_poly(audio_data, target_sr // gcd, orig_sr // gcd)
+    else:
+        resampled = soxr.resample(audio_data, orig_sr, target_sr, quality=resampler)
+    
+    n_samples = int(np.ceil(len(audio_data) * target_sr / orig_sr))
+    resampled = librosa.util.fix_length(resampled, size=n_samples)
+    return np.ascontiguousarray(resampled, dtype=np.float32)
+
+
+class AudioInfo(NamedTuple):
+    sampling_rate: int
+    channels: int
+    # Duration in seconds and number of frames per channel, estimated
+    # from the headers for some compressed formats
+    duration: float
+    frames: int
+    # Container and encoding, e.g. "WAV/PCM_16" or "mp3"
+    codec: str
+
+
+def probe_audio(file_path: str) -> AudioInfo:
+    """
+    Read the properties of an audio file from its headers without
+    decoding it.
+    
+    Files that libsndfile can open are probed with soundfile, other
+    formats (e.g. M4A) with audioread, which may have to start a decoder
+    process but still stops at the headers.
+    
+    Parameters:
+        file_path: The path to the audio file.
+        
+    Returns:
+        The sampling rate, number of channels, duration, number of
+            frames and codec of the file.
+        
+    Raises:
+        IOError: If the file cannot be opened or is not an audio file.
+    """
+    try:
+        info = soundfile.info(file_path)
+        return AudioInfo(info.samplerate, info.channels, info.duration,
+                         info.frames, f"{info.format}/{info.subtype}")
+    except Exception:
+        pass
+    
+    try:
+        with audioread.audio_open(file_path) as audio_file:
+            frames = int(round(audio_file.duration * audio_file.samplerate))
+            codec = os.path.splitext(file_path)[1].lstrip(".").lower()
+            return AudioInfo(audio_file.samplerate, audio_file.channels,
+                             audio_file.duration, frames, codec)
+    except Exception as e:
+        raise IOError(f"Error probing {file_path}: {e}")
+
 
 def get_sampling_rate(file_path: str) -> int:
     """
     Extract and return the sampling rate of the audio
     file.
     
+    Only the headers of the file are read, see probe_audio.
+    
     Parameters:
         file_path: The path to the audio file.
         
@@ -60,70 +287,433 @@ def get_sampling_rate(file_path: str) -> int:
     Raises:
         IOError: If the file is not found.
     """
-    try:
-        _, sr = librosa.load(file_path, sr=None)
-        return sr
-    except Exception as e:
-        raise IOError(f"Error loading {file_path}: {e}")
+    return probe_audio(file_path).sampling_rate
 
 
-def extract_features(audio_data: NDArray[np.float32]) -> Dict[str, float]:
+class SpectralContext:
+    """
+    Transforms of an audio signal shared by every feature block.
+    
+    The complex STFT is computed exactly once. The magnitude, power and
+    log-mel spectrograms as well as the harmonic/percussive split are all
+    derived from it, so extracting the full feature set costs a single
+    forward transform instead of one per librosa feature function.
+    
+    All arrays keep any leading axes of the input signal, so a batch of
+    equal-length clips of shape (n_clips, n_samples) is processed in one
+    vectorized pass.
+
+    The feature blocks compute their statistics over the frames and
+    samples selected by frames and samples. The streaming extraction
+    restricts them to the core of a chunk, whose margins only provide
+    context for the transforms.
+    """
+    def __init__(self, audio_data: NDArray[np.float32],
+                 sampling_rate: int = SAMPLING_RATE,
+                 frames: slice = slice(None),
+                 samples: slice = slice(None)):
+        """
+        Compute the shared transforms of the audio data.
+        
+        Parameters:
+            audio_data: The audio data as a NumPy array.
+            sampling_rate: Sampling rate of the audio data.
+            frames: The STFT frames the statistics are computed over.
+            samples: The samples the statistics of the harmonic and
+                percussive signals are computed over.
+        """
+        self.audio_data = audio_data
+        self.sampling_rate = sampling_rate
+        self.frames = frames
+        self.samples = samples
+        self.stft = librosa.stft(audio_data, n_fft=N_FFT, hop_length=HOP_LENGTH)
+        self.magnitude = np.abs(self.stft)
+        self.power = self.magnitude ** 2
+        
+        mel = librosa.feature.melspectrogram(S=self.power, sr=sampling_rate)
+        
+        # librosa.power_to_db clips to TOP_DB below the maximum of the whole
+        # array, clip every clip of a batch against its own maximum instead
+        log_mel = librosa.power_to_db(mel, top_db=None)
+        self.log_mel = np.maximum(log_mel,
+                                  np.max(log_mel, axis=(-2, -1), keepdims=True) - TOP_DB)
+
+
+def _chroma_features(context: SpectralContext) -> Dict[str, float]:
+    # chroma_stft estimates a single tuning for all clips of a batch, so
+    # compute it one clip at a time to keep clips independent
+    power = context.power
+    clips = power.reshape(-1, *power.shape[-2:])
+    chroma_stft = np.stack([librosa.feature.chroma_stft(S=clip, sr=context.sampling_rate)
+                            for clip in clips])
+    chroma_stft = chroma_stft.reshape(*power.shape[:-2], *chroma_stft.shape[-2:])
+    chroma_stft = chroma_stft[..., context.frames]
+    return {
+        "chroma_stft_mean": np.mean(chroma_stft, axis=(-2, -1)),
+        "chroma_stft_var": np.var(chroma_stft, axis=(-2, -1)),
+    }
+
+
+def _rms_features(context: SpectralContext) -> Dict[str, float]:
+    # Computed on the raw signal, which is cheaper than an FFT and
+    # matches the training data exactly
+    rms = librosa.feature.rms(y=context.audio_data, frame_length=N_FFT,
+                              hop_length=HOP_LENGTH)[..., context.frames]
+    return {
+        "rms_mean": np.mean(rms, axis=(-2, -1)),
+        "rms_var": np.var(rms, axis=(-2, -1)),
+    }
+
+
+def _spectral_features(context: SpectralContext) -> Dict[str, float]:
+    sr = context.sampling_rate
+    spectral_centroid = librosa.feature.spectral_centroid(S=context.magnitude, sr=sr)
+    spectral_bandwidth = librosa.feature.spectral_bandwidth(S=context.magnitude, sr=sr,
+                                                            centroid=spectral_centroid)
+    rolloff = librosa.feature.spectral_rolloff(S=context.magnitude, sr=sr)
+    spectral_centroid = spectral_centroid[..., context.frames]
+    spectral_bandwidth = spectral_bandwidth[..., context.frames]
+    rolloff = rolloff[..., context.frames]
+    return {
+        "spectral_centroid_mean": np.mean(spectral_centroid, axis=(-2, -1)),
+        "spectral_centroid_var": np.var(spectral_centroid, axis=(-2, -1)),
+        "spectral_bandwidth_mean": np.mean(spectral_bandwidth, axis=(-2, -1)),
+        "spectral_bandwidth_var": np.var(spectral_bandwidth, axis=(-2, -1)),
+        "rolloff_mean": np.mean(rolloff, axis=(-2, -1)),
+        "rolloff_var": np.var(rolloff, axis=(-2, -1)),
+    }
+
+
+def _zero_crossing_rate_features(context: SpectralContext) -> Dict[str, float]:
+    zero_crossing_rate = librosa.feature.zero_crossing_rate(y=context.audio_data,
+                                                            frame_length=N_FFT,
+                                                            hop_length=HOP_LENGTH)
+    zero_crossing_rate = zero_crossing_rate[..., context.frames]
+    return {
+        "zero_crossing_rate_mean": np.mean(zero_crossing_rate, axis=(-2, -1)),
+        "zero_crossing_rate_var": np.var(zero_crossing_rate, axis=(-2, -1)),
+    }
+
+
+def _hpss_features(context: SpectralContext) -> Dict[str, float]:
+    # Same as librosa.effects.hpss, but reusing the shared STFT
+    harmonic_stft, perceptr_stft = librosa.decompose.hpss(context.stft)
+    length = context.audio_data.shape[-1]
+    dtype = context.audio_data.dtype
+    harmonic = librosa.istft(harmonic_stft, n_fft=N_FFT, hop_length=HOP_LENGTH,
+                             length=length, dtype=dtype)
+    perceptr = librosa.istft(perceptr_stft, n_fft=N_FFT, hop_length=HOP_LENGTH,
+                             length=length, dtype=dtype)
+    harmonic = harmonic[..., context.samples]
+    perceptr = perceptr[..., context.samples]
+    return {
+        "harmony_mean": np.mean(harmonic, axis=-1),
+        "harmony_var": np.var(harmonic, axis=-1),
+        "perceptr_mean": np.mean(perceptr, axis=-1),
+        "perceptr_var": np.var(perceptr, axis=-1),
+    }
+
+
+def onset_envelope(context: SpectralContext) -> NDArray[np.float32]:
+    """
+    Compute the onset strength envelope the tempo is estimated from.
+
+    Parameters:
+        context: The shared transforms of the audio data.
+
+    Returns:
+        The onset strength of the selected frames of the context.
+    """
+    envelope = librosa.onset.onset_strength(S=context.log_mel, sr=context.sampling_rate,
+                                            hop_length=HOP_LENGTH, aggregate=np.median)
+    return envelope[..., context.frames]
+
+
+def estimate_tempo(envelope: NDArray[np.float32],
+                   sampling_rate: int = SAMPLING_RATE) -> NDArray[np.float64]:
+    """
+    Estimate the tempo from an onset strength envelope.
+
+    Parameters:
+        envelope: The onset strength, see onset_envelope.
+        sampling_rate: Sampling rate of the audio data.
+
+    Returns:
+        The tempo in beats per minute, without the frame axis.
+    """
+    tempo = librosa.feature.tempo(onset_envelope=envelope, sr=sampling_rate,
+                                  hop_length=HOP_LENGTH)
+
+    # beat_track reports a tempo of 0 when there are no onsets at all
+    has_onsets = np.any(envelope, axis=-1, keepdims=True)
+    return np.where(has_onsets, tempo, 0.0)[..., 0]
+
+
+def _tempo_features(context: SpectralContext) -> Dict[str, float]:
+    # librosa.beat.beat_track estimates the tempo from this onset envelope
+    # and then runs a dynamic program to place the beats. Only the tempo
+    # is used, so the beat tracking itself is skipped.
+    return {"tempo": estimate_tempo(onset_envelope(context), context.sampling_rate)}
+
+
+def _mfcc_features(context: SpectralContext) -> Dict[str, float]:
+    mfccs = librosa.feature.mfcc(S=context.log_mel, n_mfcc=N_MFCC)[..., context.frames]
+    mfcc_means = np.mean(mfccs, axis=-1)
+    mfcc_vars = np.var(mfccs, axis=-1)
+    
+    features = {}
+    for i in range(N_MFCC):
+        features[f"mfcc{i+1}_mean"] = mfcc_means[..., i]
+        features[f"mfcc{i+1}_var"] = mfcc_vars[..., i]
+    return features
+
+
+# Independent groups of features in the order of the training columns.
+# Each block reads from the shared SpectralContext only.
+FEATURE_BLOCKS = [
+    ("chroma", _chroma_features),
+    ("rms", _rms_features),
+    ("spectral", _spectral_features),
+    ("zero_crossing_rate", _zero_crossing_rate_features),
+    ("hpss", _hpss_features),
+    ("tempo", _tempo_features),
+    ("mfcc", _mfcc_features),
+]
+
+
+# Order in which the blocks are submitted to the block pool, the most
+# expensive first so that the cheap ones fill in around them
+PARALLEL_BLOCK_ORDER = ["hpss", "chroma", "tempo", "mfcc", "spectral", "rms",
+                        "zero_crossing_rate"]
+
+# Shared thread pool the blocks of one signal run on, None while blocks
+# run one after another
+_block_executor: Optional[ThreadPoolExecutor] = None
+_block_executor_lock = threading.Lock()
+
+
+def set_block_workers(workers: Optional[int]):
+    """
+    Set the number of threads the feature blocks of a signal run on.
+    
+    The blocks only read the shared SpectralContext and spend most of
+    their time in NumPy, SciPy and FFT code that releases the GIL, so on
+    a multi-core machine they overlap and the latency of a single
+    extraction drops. The results are the same as in sequential mode.
+    The pool is shared by all threads of the process, which bounds the
+    number of threads no matter how many extractions run at once. It is
+    meant to be set once when the process starts.
+    
+    Parameters:
+        workers: Number of threads, the blocks run one after another in
+            the calling thread if None or less than 2.
+    """
+    global _block_executor
+    with _block_executor_lock:
+        previous = _block_executor
+        _block_executor = None
+        if workers is not None and workers > 1:
+            _block_executor = ThreadPoolExecutor(max_workers=workers,
+                                                 thread_name_prefix="feature-block")
+    if previous is not None:
+        # Extractions that already took the previous pool finish on it
+        previous.shutdown(wait=False)
+
+
+def profile_columns(profile: str = DEFAULT_PROFILE) -> List[str]:
+    """
+    Get the names of the features of a feature profile.
+    
+    Parameters:
+        profile: Name of the profile, one of FEATURE_PROFILES.
+        
+    Returns:
+        The feature names in training column order.
+        
+    Raises:
+        ValueError: If the profile does not exist.
+    """
+    return [name for block in _profile_blocks(profile) for name in BLOCK_COLUMNS[block]]
+
+
+def _profile_blocks(profile: str) -> List[str]:
+    if profile not in FEATURE_PROFILES:
+        raise ValueError(f"Unknown feature profile '{profile}', "
+                         f"expected one of {list(FEATURE_PROFILES)}")
+    return FEATURE_PROFILES[profile]
+
+
+def _compute_blocks(context: SpectralContext, profile: str) -> Dict[str, NDArray]:
+    blocks = _profile_blocks(profile)
+    selected = [(name, block) for name, block in FEATURE_BLOCKS if name in blocks]
+    
+    executor = _block_executor
+    if executor is None or len(selected) < 2:
+        results = [_compute_block(context, name, block) for name, block in selected]
+    else:
+        futures = {name: executor.submit(_compute_block, context, name, block)
+                   for name, block in sorted(selected,
+                                             key=lambda item: PARALLEL_BLOCK_ORDER.index(item[0]))}
+        results = [futures[name].result() for name, _ in selected]
+    
+    # Merged in training column order whichever block finished first
+    features = {}
+    for result in results:
+        features.update(result)
+    
+    return features
+
+
+def _compute_block(context: SpectralContext, name: str, block) -> Dict[str, NDArray]:
+    with profiling.stage(f"features.{name}"):
+        return block(context)
+
+
+def extract_features(audio_data: NDArray[np.float32],
+                     profile: str = DEFAULT_PROFILE) -> Dict[str, float]:
     """
     Extract features from audio data.
     
+    All spectral features are derived from one shared STFT (see
+    SpectralContext). The result matches calling the individual librosa
+    feature functions on the raw signal within a relative tolerance of
+    FEATURE_RTOL.
+    
     Parameters:
         audio_data: The audio data as a NumPy array.
+        profile: Name of the feature profile to extract.
         
     Returns:
         A dictionary of extracted features.
     """
-    features = {}
+    with profiling.stage("features.stft"):
+        context = SpectralContext(audio_data)
     
-    # Chroma STFT
-    chroma_stft = librosa.feature.chroma_stft(y=audio_data, sr=SAMPLING_RATE)
-    features["chroma_stft_mean"] = np.mean(chroma_stft)
-    features["chroma_stft_var"] = np.var(chroma_stft)
-    
-    # RMS
-    rms = librosa.feature.rms(y=audio_data)
-    features["rms_mean"] = np.mean(rms)
-    features["rms_var"] = np.var(rms)
-    
-    # Spectral Centroid
-    spectral_centroid = librosa.feature.spectral_centroid(y=audio_data, sr=SAMPLING_RATE)
-    features["spectral_centroid_mean"] = np.mean(spectral_centroid)
-    features["spectral_centroid_var"] = np.var(spectral_centroid)
-    
-    # Spectral Bandwidth
-    spectral_bandwith = librosa.feature.spectral_bandwidth(y=audio_data, sr=SAMPLING_RATE)
-    features["spectral_bandwidth_mean"] = np.mean(spectral_bandwith)
-    features["spectral_bandwidth_var"] = np.var(spectral_bandwith)
-    
-    # Spectral Rolloff
-    rolloff = librosa.feature.spectral_rolloff(y=audio_data, sr=SAMPLING_RATE)
-    features["rolloff_mean"] = np.mean(rolloff)
-    features["rolloff_var"] = np.var(rolloff)
-    
-    # Zero Crossing Rate
-    zero_crossing_rate = librosa.feature.zero_crossing_rate(y=audio_data)
-    features["zero_crossing_rate_mean"] = np.mean(zero_crossing_rate)
-    features["zero_crossing_rate_var"] = np.var(zero_crossing_rate)
-    
-    # Harmony and Perceived Harmonicity
-    harmonic, perceptr = librosa.effects.hpss(audio_data)
-    features["harmony_mean"] = np.mean(harmonic)
-    features["harmony_var"] = np.var(harmonic)
-    features["perceptr_mean"] = np.mean(perceptr)
-    features["perceptr_var"] = np.var(perceptr)
-    
-    # Tempo
-    tempo, _ = librosa.beat.beat_track(y=audio_data, sr=SAMPLING_RATE)
-    features["tempo"] = tempo[0]  # tempo is a list
-    
-    # MFCCs
-    mfccs = librosa.feature.mfcc(y=audio_data, sr=SAMPLING_RATE, n_mfcc=20)
-    for i in range(20):
-        features[f"mfcc{i+1}_mean"] = np.mean(mfccs[i])
-        features[f"mfcc{i+1}_var"] = np.var(mfccs[i])
+    features = {}
+    for name, value in _compute_blocks(context, profile).items():
+        # The blocks return 0-d arrays for a 1-D signal, unwrap them
+        # into NumPy scalars
+        features[name] = value[()]
         
     return features
+
+
+def segment_audio(audio_data: NDArray[np.float32],
+                  segment_length: int = SEGMENT_LENGTH) -> NDArray[np.float32]:
+    """
+    Split audio data into consecutive, non-overlapping segments.
+    
+    The trailing samples that do not fill a whole segment are dropped.
+    Audio shorter than one segment is returned as a single segment.
+    
+    Parameters:
+        audio_data: The audio data as a NumPy array.
+        segment_length: Number of samples in each segment.
+        
+    Returns:
+        An array of shape (n_segments, segment_length) that shares
+            memory with the audio data.
+    """
+    n_segments = len(audio_data) // segment_length
+    if n_segments == 0:
+        return audio_data[np.newaxis, :]
+    
+    return audio_data[:n_segments * segment_length].reshape(n_segments, segment_length)
+
+
+def extract_segment_features(audio_data: NDArray[np.float32],
+                             segment_length: int = SEGMENT_LENGTH,
+                             profile: str = DEFAULT_PROFILE) -> Dict[str, NDArray]:
+    """
+    Extract features from every segment of the audio data.
+    
+    All segments are processed together as one batch, so the STFT and
+    the derived features are computed in a single vectorized pass.
+    
+    Parameters:
+        audio_data: The audio data as a NumPy array.
+        segment_length: Number of samples in each segment.
+        profile: Name of the feature profile to extract.
+        
+    Returns:
+        A dictionary mapping feature names to arrays with one value
+            per segment.
+    """
+    segments = segment_audio(audio_data, segment_length)
+    with profiling.stage("features.stft"):
+        context = SpectralContext(segments)
+    
+    return _compute_blocks(context, profile)
+
+
+def extract_features_batch(clips: NDArray[np.float32],
+                           lengths: Optional[NDArray[np.int64]] = None,
+                           profile: str = DEFAULT_PROFILE) -> NDArray[np.float32]:
+    """
+    Extract the features of a batch of clips into a matrix.
+    
+    Clips of equal length are processed together, so a batch of equally
+    long windows costs a single vectorized pass over the leading axis.
+    The features of a padded clip only depend on its first lengths[i]
+    samples, exactly as if it had been passed to extract_features alone.
+    
+    Parameters:
+        clips: Array of shape (n_clips, n_samples).
+        lengths: Number of valid samples of each clip if the clips are
+            padded to a common length, all samples are used if None.
+        profile: Name of the feature profile to extract.
+        
+    Returns:
+        A float32 array of shape (n_clips, n_features) with the columns
+            in the order of profile_columns(profile).
+        
+    Raises:
+        ValueError: If the clips are not a 2-D array, the lengths do not
+            match the clips or the profile does not exist.
+    """
+    clips = np.asarray(clips)
+    if clips.ndim != 2:
+        raise ValueError(f"Expected a 2-D array of clips, got {clips.ndim} dimensions")
+    if lengths is None:
+        lengths = np.full(len(clips), clips.shape[1])
+    lengths = np.asarray(lengths)
+    if lengths.shape != (len(clips),) or np.any(lengths < 1) or np.any(lengths > clips.shape[1]):
+        raise ValueError("Expected one length between 1 and the number of samples per clip")
+    
+    columns = profile_columns(profile)
+    matrix = np.empty((len(clips), len(columns)), dtype=np.float32)
+    for length in np.unique(lengths):
+        rows = np.flatnonzero(lengths == length)
+        batch = clips[:, :length] if len(rows) == len(clips) else clips[rows, :length]
+        with profiling.stage("features.stft"):
+            context = SpectralContext(np.ascontiguousarray(batch))
+        matrix[rows] = features_to_matrix(_compute_blocks(context, profile), columns)
+    
+    return matrix
+
+
+def features_to_matrix(features: Dict[str, NDArray],
+                       columns: Optional[List[str]] = None) -> NDArray[np.float32]:
+    """
+    Arrange extracted features into a matrix for the model.
+    
+    Parameters:
+        features: Features of a single signal as returned by
+            extract_features, or of several segments as returned by
+            extract_segment_features.
+        columns: Names of the features to include, FEATURE_COLUMNS
+            if None.
+        
+    Returns:
+        A float32 array of shape (n_rows, n_features) with the columns
+            in the given order.
+    """
+    if columns is None:
+        columns = FEATURE_COLUMNS
+    
+    n_rows = np.size(features[columns[0]])
+    matrix = np.empty((n_rows, len(columns)), dtype=np.float32)
+    for column, name in enumerate(columns):
+        matrix[:, column] = features[name]
+    
+    return matrix
@@ -0,0 +1,547 @@
+"""
+Headless classification of whole directories of audio files.
+
+Decoding and feature extraction run in a pool of worker processes, one
+per available core. The headers of all files are probed first, so that
+unreadable files are rejected without decoding and the longest files are
+scheduled first. Their results are collected in the main process and
+scored in large batches by a single MusicGenreClassifier, and every
+batch is appended to the output file as soon as it is predicted.
+
+Usage:
+    python -m src.core.batch music/ "other/**/*.mp3" -o results.csv
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import numpy as np
+from numpy.typing import NDArray
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+import src.core.audio_feature_extractor as extractor
+import src.core.genre_prediction as prediction
+import src.core.model_artifact as model_artifact
+import src.core.streaming_features as streaming_features
+from src.core.audio_cache import AudioCache
+from src.core.feature_cache import FeatureCache
+from src.core.fingerprint import FingerprintIndex, compute_fingerprint
+from src.core.history_store import file_hash
+
+
+MODEL_PATH = r"models\xgb_model.pkl"
+ENCODER_PATH = r"models\xgb_encoder.pkl"
+
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".flac", ".ogg")
+BATCH_SIZE = 256
+
+
+def find_audio_files(inputs: Iterable[str]) -> List[str]:
+    """
+    Expand directories, glob patterns and file paths into audio files.
+    
+    Directories are searched recursively for files with one of the
+    AUDIO_EXTENSIONS. Files given explicitly are kept regardless of
+    their extension.
+    
+    Parameters:
+        inputs: Directories, glob patterns or paths to audio files.
+        
+    Returns:
+        A sorted list of unique file paths.
+    """
+    files = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, names in os.walk(item):
+                files.update(os.path.join(root, name) for name in names
+                             if name.lower().endswith(AUDIO_EXTENSIONS))
+        elif os.path.isfile(item):
+            files.add(item)
+        else:
+            files.update(path for path in glob.glob(item, recursive=True)
+                         if os.path.isfile(path))
+            
+    return sorted(files)
+
+
+# Feature cache of the current worker process, opened on first use
+_worker_cache = None
+
+
+def _get_worker_cache(cache_path: Optional[str]) -> Optional[FeatureCache]:
+    global _worker_cache
+    if cache_path is not None and _worker_cache is None:
+        _worker_cache = FeatureCache(cache_path)
+    return _worker_cache
+
+
+# Decoded audio cache of the current worker process, opened on first use
+_worker_audio_cache = None
+
+
+def _get_worker_audio_cache(audio_cache_path: Optional[str]) -> Optional[AudioCache]:
+    global _worker_audio_cache
+    if audio_cache_path is not None and _worker_audio_cache is None:
+        _worker_audio_cache = AudioCache(audio_cache_path)
+    return _worker_audio_cache
+
+
+# Fingerprint index of the current worker process, opened on first use
+_worker_fingerprints = None
+
+
+def _get_worker_fingerprints(fingerprint_path: Optional[str]) -> Optional[FingerprintIndex]:
+    global _worker_fingerprints
+    if fingerprint_path is not None and _worker_fingerprints is None:
+        _worker_fingerprints = FingerprintIndex(fingerprint_path)
+    return _worker_fingerprints
+
+
+class FileFingerprint(NamedTuple):
+    file_hash: str
+    # None if the file is an identical copy of an indexed file
+    words: Optional[NDArray[np.uint32]]
+    # Indexed track the file is a copy of, None if it is new
+    track_id: Optional[int]
+    # Stored prediction of an indexed copy of the file, None if the file
+    # has to be classified
+    probabilities: Optional[Dict[str, float]]
+
+
+def _extract_file_features(file_path: str, segmented: bool,
+                           cache_path: Optional[str] = None,
+                           streaming: bool = False,
+                           profile: str = extractor.DEFAULT_PROFILE,
+                           resampler: str = extractor.DEFAULT_RESAMPLER,
+                           audio_cache_path: Optional[str] = None,
+                           fingerprint_path: Optional[str] = None,
+                           model_key: str = ""
+                           ) -> Tuple[str, Optional[Dict], Optional[str],
+                                      Optional[FileFingerprint]]:
+    # Runs in a worker process, errors are reported back instead of
+    # raised so that one broken file does not stop the whole batch
+    try:
+        if streaming:
+            features = streaming_features.extract_features_streaming(
+                file_path, profile=profile, resampler=resampler)
+            return file_path, {name: [value] for name, value in features.items()}, None, None
+
+        # Identical files and files already matched by an earlier run are
+        # recognized before they are decoded
+        index = _get_worker_fingerprints(fingerprint_path)
+        fingerprint = None
+        if index is not None:
+            content_hash = file_hash(file_path)
+            track_id = index.find_exact(content_hash)
+            if track_id is not None:
+                fingerprint = FileFingerprint(content_hash, None, track_id,
+                                              index.result(track_id, model_key))
+                if fingerprint.probabilities is not None:
+                    return file_path, None, None, fingerprint
+        
+        audio_data, _ = extractor.load_audio(
+            file_path, resampler, cache=_get_worker_audio_cache(audio_cache_path))
+        
+        # Near-duplicates are recognized from the fingerprint of the whole
+        # decoded signal
+        if index is not None and fingerprint is None:
+            audio_fingerprint = compute_fingerprint(audio_data)
+            match = index.find(audio_fingerprint)
+            track_id = probabilities = None
+            if match is not None:
+                track_id = match.track_id
+                probabilities = index.result(track_id, model_key)
+            fingerprint = FileFingerprint(content_hash, audio_fingerprint.words, track_id,
+                                          probabilities)
+            if probabilities is not None:
+                return file_path, None, None, fingerprint
+        
+        cache = _get_worker_cache(cache_path)
+        if segmented:
+            if cache is not None:
+                features = cache.extract_segment_features(audio_data, profile=profile)
+            else:
+                features = extractor.extract_segment_features(audio_data, profile=profile)
+        else:
+            if cache is not None:
+                track_features = cache.extract_features(audio_data, profile=profile)
+            else:
+                track_features = extractor.extract_features(audio_data, profile)
+            features = {name: [value] for name, value in track_features.items()}
+        return file_path, features, None, fingerprint
+    except Exception as e:
+        return file_path, None, str(e), None
+
+
+# Classifier of the current worker process in progressive mode, loaded
+# on first use
+_worker_classifier = None
+
+
+def _get_worker_classifier(model_path: str, encoder_path: Optional[str], profile: str,
+                           compiled: bool,
+                           cache_path: Optional[str]) -> prediction.MusicGenreClassifier:
+    global _worker_classifier
+    if _worker_classifier is None:
+        _worker_classifier = prediction.MusicGenreClassifier(
+            model_path, encoder_path, feature_cache=_get_worker_cache(cache_path),
+            profile=profile, compiled=compiled)
+    return _worker_classifier
+
+
+def _classify_file_progressive(file_path: str, threshold: float, aggregation: str,
+                               model_path: str, encoder_path: Optional[str],
+                               profile: str, compiled: bool = False,
+                               resampler: str = extractor.DEFAULT_RESAMPLER,
+                               cache_path: Optional[str] = None,
+                               audio_cache_path: Optional[str] = None
+                               ) -> Tuple[str, Optional[prediction.ProgressiveResult],
+                                          float, Optional[str]]:
+    # Runs in a worker process, which scores its own segments so that it
+    # can stop extracting features as soon as the track is classified
+    try:
+        classifier = _get_worker_classifier(model_path, encoder_path, profile, compiled,
+                                            cache_path)
+        audio_data, sampling_rate = extractor.load_audio(
+            file_path, resampler, cache=_get_worker_audio_cache(audio_cache_path))
+        result = classifier.predict_progressive(audio_data, threshold, aggregation=aggregation)
+        return file_path, result, len(audio_data) / sampling_rate, None
+    except Exception as e:
+        return file_path, None, 0.0, str(e)
+
+
+def _probe_file(file_path: str) -> Tuple[str, Optional[extractor.AudioInfo], Optional[str]]:
+    try:
+        return file_path, extractor.probe_audio(file_path), None
+    except Exception as e:
+        return file_path, None, str(e)
+
+
+class ResultWriter:
+    """
+    Appends classification results to a CSV or JSON Lines file.
+    """
+    def __init__(self, output_path: str, genres: List[str], output_format: str):
+        self.genres = list(genres)
+        self.output_format = output_format
+        self.file = open(output_path, mode="w", newline="", encoding="utf-8")
+        
+        if output_format == "csv":
+            self.csv_writer = csv.writer(self.file)
+            self.csv_writer.writerow(["file", "genre", *self.genres, "error"])
+    
+    def write(self, file_path: str, genre: Optional[str],
+              probabilities: Optional[NDArray], error: Optional[str] = None):
+        if self.output_format == "csv":
+            if probabilities is None:
+                probabilities = [""] * len(self.genres)
+            self.csv_writer.writerow([file_path, genre or "", *probabilities, error or ""])
+        else:
+            record = {"file": file_path, "genre": genre}
+            if probabilities is not None:
+                record["probabilities"] = dict(zip(self.genres, map(float, probabilities)))
+            if error is not None:
+                record["error"] = error
+            self.file.write(json.dumps(record) + "\n")
+    
+    def flush(self):
+        self.file.flush()
+    
+    def close(self):
+        self.file.close()
+
+
+def _predict_batch(classifier: prediction.MusicGenreClassifier,
+                   batch: List[Tuple[str, Dict]],
+                   writer: ResultWriter,
+                   aggregation: str,
+                   index: Optional[FingerprintIndex] = None,
+                   model_key: str = "",
+                   fingerprints: Optional[Dict[str, FileFingerprint]] = None):
+    # Score the rows of all files in the batch with one model call
+    probabilities = classifier.predict_batch_probabilities([features for _, features in batch])
+    
+    genres = classifier.label_encoder.classes_
+    for (file_path, _), file_probabilities in zip(batch, probabilities):
+        track_probabilities = prediction.aggregate_probabilities(file_probabilities, aggregation)
+        genre = genres[np.argmax(track_probabilities)]
+        writer.write(file_path, genre, track_probabilities)
+        
+        fingerprint = fingerprints.pop(file_path, None) if fingerprints is not None else None
+        if index is not None and fingerprint is not None:
+            track_id = _index_file(index, file_path, fingerprint)
+            index.set_result(track_id, model_key, dict(zip(genres, track_probabilities)))
+    writer.flush()
+
+
+def _index_file(index: FingerprintIndex, file_path: str, fingerprint: FileFingerprint) -> int:
+    # Adds a new file to the index, or records the hash of a copy with the
+    # track it matched so that the next run finds it without decoding it.
+    # Returns the id of the track.
+    track_id = fingerprint.track_id
+    if track_id is None:
+        # An identical copy may have been added earlier in this run
+        track_id = index.find_exact(fingerprint.file_hash)
+        if track_id is None:
+            return index.add(file_path, fingerprint.words, fingerprint.file_hash)
+    if fingerprint.words is not None:
+        index.add_copy(fingerprint.file_hash, track_id)
+    return track_id
+
+
+def _classify_progressive(file_paths: List[str],
+                          classifier: prediction.MusicGenreClassifier,
+                          writer: ResultWriter,
+                          executor: ProcessPoolExecutor,
+                          threshold: float,
+                          aggregation: str,
+                          resampler: str,
+                          cache_path: Optional[str],
+                          audio_cache_path: Optional[str]) -> Tuple[int, int]:
+    # Every worker loads the classifier once from its files, only the
+    # paths are sent with the tasks
+    classified = failed = 0
+    used_seconds = total_seconds = 0.0
+    futures = [executor.submit(_classify_file_progressive, file_path, threshold, aggregation,
+                               classifier.model_path, classifier.encoder_path,
+                               classifier.profile, classifier.compiled, resampler,
+                               cache_path, audio_cache_path)
+               for file_path in file_paths]
+    
+    for future in as_completed(futures):
+        file_path, result, duration, error = future.result()
+        if error is not None:
+            writer.write(file_path, None, None, error)
+            failed += 1
+            continue
+        
+        probabilities = np.array([result.probabilities[genre]
+                                  for genre in classifier.label_encoder.classes_])
+        genre = classifier.label_encoder.classes_[np.argmax(probabilities)]
+        writer.write(file_path, genre, probabilities)
+        classified += 1
+        used_seconds += result.audio_seconds
+        total_seconds += duration
+    writer.flush()
+    
+    if total_seconds > 0:
+        print(f"Classified from {used_seconds / total_seconds:.0%} of the audio",
+              file=sys.stderr)
+    return classified, failed
+
+
+def classify_files(file_paths: List[str],
+                   classifier: prediction.MusicGenreClassifier,
+                   writer: ResultWriter,
+                   workers: Optional[int] = None,
+                   batch_size: int = BATCH_SIZE,
+                   segmented: bool = True,
+                   aggregation: str = "mean",
+                   cache_path: Optional[str] = None,
+                   streaming: bool = False,
+                   resampler: str = extractor.DEFAULT_RESAMPLER,
+                   early_exit: Optional[float] = None,
+                   audio_cache_path: Optional[str] = None,
+                   fingerprint_path: Optional[str] = None,
+                   model_key: str = "") -> Tuple[int, int]:
+    """
+    Classify audio files and write the results as they become available.
+    
+    Parameters:
+        file_paths: Paths to the audio files.
+        classifier: The classifier shared by all batches.
+        writer: Destination of the results.
+        workers: Number of worker processes, all available cores if None.
+        batch_size: Number of files scored together by the model.
+        segmented: Whether to classify the 3 second segments of each file.
+        aggregation: How to combine the segment predictions of a file.
+        cache_path: Path to a feature cache database shared by the workers.
+        streaming: Whether to decode the files block by block and extract
+            one feature vector per file with bounded memory. Overrides
+            segmented and does not use the cache.
+        resampler: The resampling backend of the decoded files, one of
+            extractor.RESAMPLERS. Streaming mode only supports the ones
+            of streaming_features.STREAMING_RESAMPLERS.
+        early_exit: Margin between the two most probable genres at which
+            the classification of a file stops, see predict_progressive.
+            Every segment is classified if None. Implies segmented.
+        audio_cache_path: Directory of a decoded audio cache shared by
+            the workers.
+        fingerprint_path: Path to a fingerprint index database. Files
+            that are identical or near-identical to an indexed file
+            classified with the same model and settings reuse its
+            prediction, and all classified files are added to the index.
+            Not used in streaming and progressive mode.
+        model_key: Identifies the model for the stored predictions, e.g.
+            its path and modification time.
+        
+    Returns:
+        A tuple with the number of classified and failed files.
+
+    Raises:
+        ValueError: If streaming is combined with a resampler that cannot
+            resample block by block.
+    """
+    if streaming and resampler not in streaming_features.STREAMING_RESAMPLERS:
+        raise ValueError(f"Unknown streaming resampler '{resampler}', "
+                         f"expected one of {list(streaming_features.STREAMING_RESAMPLERS)}")
+
+    classified = failed = reused = 0
+    batch = []
+    
+    # Stored predictions are only reused by runs with the same settings
+    model_key = f"{model_key}|{classifier.profile}|{aggregation}|{segmented}"
+    index = fingerprints = None
+    if fingerprint_path is not None and not streaming and early_exit is None:
+        index = FingerprintIndex(fingerprint_path)
+        fingerprints = {}
+    else:
+        fingerprint_path = None
+    
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        # Read the headers of all files first. Files that are not audio
+        # are reported without being decoded, and the longest files are
+        # submitted first so that no worker starts a long file at the end.
+        durations = {}
+        for file_path, info, error in executor.map(_probe_file, file_paths, chunksize=64):
+            if error is not None:
+                writer.write(file_path, None, None, error)
+                failed += 1
+            else:
+                durations[file_path] = info.duration
+        print(f"{len(durations)} files with {sum(durations.values()) / 3600:.1f} hours "
+              f"of audio to classify", file=sys.stderr)
+        
+        file_paths = sorted(durations, key=durations.get, reverse=True)
+        if early_exit is not None:
+            progressive = _classify_progressive(file_paths, classifier, writer, executor,
+                                                early_exit, aggregation, resampler,
+                                                cache_path, audio_cache_path)
+            return classified + progressive[0], failed + progressive[1]
+        
+        futures = [executor.submit(_extract_file_features, file_path, segmented,
+                                   cache_path, streaming, classifier.profile, resampler,
+                                   audio_cache_path, fingerprint_path, model_key)
+                   for file_path in file_paths]
+        
+        for future in as_completed(futures):
+            file_path, features, error, fingerprint = future.result()
+            if error is not None:
+                writer.write(file_path, None, None, error)
+                failed += 1
+                continue
+            
+            if fingerprint is not None and fingerprint.probabilities is not None:
+                _index_file(index, file_path, fingerprint)
+                genres = classifier.label_encoder.classes_
+                probabilities = np.array([fingerprint.probabilities[genre] for genre in genres])
+                writer.write(file_path, genres[np.argmax(probabilities)], probabilities)
+                classified += 1
+                reused += 1
+                continue
+            if fingerprint is not None:
+                fingerprints[file_path] = fingerprint
+            
+            batch.append((file_path, features))
+            if len(batch) >= batch_size:
+                _predict_batch(classifier, batch, writer, aggregation, index, model_key,
+                               fingerprints)
+                classified += len(batch)
+                batch = []
+    
+    if batch:
+        _predict_batch(classifier, batch, writer, aggregation, index, model_key, fingerprints)
+        classified += len(batch)
+    writer.flush()
+    
+    if index is not None:
+        print(f"Reused the predictions of {reused} duplicate files", file=sys.stderr)
+        index.close()
+    return classified, failed
+
+
+def _model_key(model_path: str) -> str:
+    # Changes whenever the model is retrained or exported again
+    if os.path.isdir(model_path):
+        model_path = os.path.join(model_path, model_artifact.METADATA_FILE)
+    return f"{os.path.abspath(model_path)}:{os.stat(model_path).st_mtime_ns}"
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Classify the genres of audio files.")
+    parser.add_argument("inputs", nargs="+",
+                        help="directories, glob patterns or audio files")
+    parser.add_argument("-o", "--output", required=True,
+                        help="output file (.csv or .jsonl)")
+    parser.add_argument("--format", choices=("csv", "jsonl"),
+                        help="output format, guessed from the output file name by default")
+    parser.add_argument("--model", default=MODEL_PATH, help="path to the trained model")
+    parser.add_argument("--encoder", default=ENCODER_PATH, help="path to the label encoder")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes (default: all cores)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="number of files scored together by the model")
+    parser.add_argument("--aggregation", choices=prediction.AGGREGATIONS, default="mean",
+                        help="how to combine the predictions of the segments of a file")
+    parser.add_argument("--cache", default=None,
+                        help="feature cache database reused across runs")
+    parser.add_argument("--whole-track", action="store_true",
+                        help="extract one feature vector per file instead of "
+                             "classifying its 3 second segments")
+    parser.add_argument("--streaming", action="store_true",
+                        help="decode long files block by block with bounded memory "
+                             "(implies --whole-track)")
+    parser.add_argument("--early-exit", type=float, default=None, metavar="MARGIN",
+                        help="stop classifying a file once the two most probable genres "
+                             "differ by this margin (e.g. 0.5)")
+    parser.add_argument("--audio-cache", default=None, metavar="DIRECTORY",
+                        help="cache of decoded audio reused across runs")
+    parser.add_argument("--fingerprints", default=None, metavar="DATABASE",
+                        help="fingerprint index that duplicate files reuse the predictions of")
+    parser.add_argument("--compiled", action="store_true",
+                        help="evaluate the trees with the compiled inference engine")
+    parser.add_argument("--resampler", choices=extractor.RESAMPLERS,
+                        default=extractor.DEFAULT_RESAMPLER,
+                        help="resampling backend, faster ones change the features slightly")
+    args = parser.parse_args(argv)
+    if args.streaming and args.resampler not in streaming_features.STREAMING_RESAMPLERS:
+        parser.error(f"--streaming only supports the resamplers "
+                     f"{', '.join(streaming_features.STREAMING_RESAMPLERS)}")
+    
+    output_format = args.format
+    if output_format is None:
+        output_format = "jsonl" if args.output.lower().endswith((".jsonl", ".json")) else "csv"
+    
+    file_paths = find_audio_files(args.inputs)
+    if not file_paths:
+        print("No audio files found", file=sys.stderr)
+        return 1
+    
+    classifier = prediction.MusicGenreClassifier(args.model, args.encoder,
+                                                 compiled=args.compiled)
+    writer = ResultWriter(args.output, classifier.label_encoder.classes_, output_format)
+    try:
+        classified, failed = classify_files(file_paths, classifier, writer,
+                                            workers=args.workers,
+                                            batch_size=args.batch_size,
+                                            segmented=not args.whole_track,
+                                            aggregation=args.aggregation,
+                                            cache_path=args.cache,
+                                            streaming=args.streaming,
+                                            resampler=args.resampler,
+                                            early_exit=args.early_exit,
+                                            audio_cache_path=args.audio_cache,
+                                            fingerprint_path=args.fingerprints,
+                                            model_key=_model_key(args.model))
+    finally:
+        writer.close()
+    
+    print(f"Classified {classified} files, {failed} failed", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,394 @@
+"""
+This module contains a compiled inference engine for the tree ensembles.
+
+compile_model converts a trained Random Forest, Gradient Boosting
+Machine or XGBoost model into one flat array of 64-bit node words. Each
+word packs the index of the left child (the right child always follows
+it), the feature and the threshold of a node, so a tree level costs a
+single gather per sample and tree instead of one per node attribute.
+The nodes of all trees are laid out level by level and leaves point to
+themselves, so every tree is descended with the same fixed number of
+branch-free, vectorized steps.
+
+Thresholds are quantized without loss. The distinct thresholds of every
+feature are collected into sorted float32 bin edges, each node stores
+the index of its threshold (16 bits), and the input features are mapped
+to bins once per call with np.searchsorted. Float64 thresholds of
+scikit-learn are rounded down to the largest float32 that keeps the
+comparison for every float32 input, which is what the models receive.
+The compiled model therefore takes the same path through every tree as
+the original one, and its probabilities only differ by the rounding of
+the float32 leaf values and the summation order (see PROBABILITY_ATOL).
+compile_model checks this on rows around the thresholds of the model
+before it returns the compiled model.
+
+Missing values (NaN) follow the default direction of each node like in
+the original model: default_left of XGBoost, missing_go_to_left of
+scikit-learn and the right child for the flattened artifacts. The
+directions are only looked at for inputs that contain NaN.
+"""
+import json
+import warnings
+import numpy as np
+from numpy.typing import NDArray
+from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
+from typing import List, NamedTuple, Optional
+import src.core.model_artifact as model_artifact
+
+
+# Maximum difference between the probabilities of a compiled model and
+# the ones of the original model
+PROBABILITY_ATOL = 1e-4
+
+# Number of (row, tree) pairs descended at once, which keeps the working
+# arrays of a step in the CPU caches
+CHUNK_NODES = 1 << 17
+
+# Threshold index of leaves, which no bin index exceeds
+LEAF_THRESHOLD = 0xFFFF
+
+# Number of rows around the thresholds compile_model checks the compiled
+# model on if no feature rows are given
+CHECK_ROWS = 256
+
+
+class _Nodes(NamedTuple):
+    # Nodes of all trees with global child indices, leaves have a left
+    # child of -1. A sample goes left if feature <= threshold.
+    feature: NDArray[np.int64]
+    threshold: NDArray[np.float32]
+    left: NDArray[np.int64]
+    right: NDArray[np.int64]
+    # Output of every node of shape (n_nodes, n_outputs), only the rows
+    # of the leaves are used
+    value: NDArray[np.float64]
+    roots: NDArray[np.int64]
+    # Whether a sample with a missing value goes left at each node
+    missing_left: NDArray[np.bool_]
+
+
+class CompiledTreeEnsemble:
+    """
+    A tree ensemble compiled into packed node words.
+
+    It provides predict_proba and predict like the original model.
+    """
+    def __init__(self, nodes: _Nodes, kind: str, n_features: int,
+                 feature_names: Optional[List[str]] = None,
+                 tree_class: Optional[NDArray[np.int64]] = None,
+                 bias: Optional[NDArray[np.float64]] = None):
+        """
+        Compile the nodes of an ensemble.
+
+        Parameters:
+            nodes: The nodes of all trees.
+            kind: "forest" to average the class distributions of the
+                leaves, or "boosting" to add up the leaf values of the
+                trees of each class on top of the bias and apply a
+                softmax.
+            n_features: Number of input features.
+            feature_names: Names of the input features.
+            tree_class: Class of each tree of a boosting ensemble.
+            bias: Initial raw score of each class of a boosting ensemble.
+
+        Raises:
+            ValueError: If a feature has too many distinct thresholds or
+                the ensemble has too many nodes to be packed.
+        """
+        self.kind = kind
+        self.n_features_in_ = n_features
+        if feature_names is not None:
+            self.feature_names_in_ = np.array(feature_names, dtype=object)
+        self.n_trees = len(nodes.roots)
+
+        # Level order over all trees, the children of a node are adjacent
+        n_nodes = len(nodes.left)
+        if n_nodes >= 2 ** 31:
+            raise ValueError(f"The ensemble has too many nodes to be compiled ({n_nodes})")
+        levels = []
+        child = np.empty(n_nodes, dtype=np.int64)
+        frontier = nodes.roots.astype(np.int64)
+        position = 0
+        while len(frontier):
+            levels.append(frontier)
+            internal = frontier[nodes.left[frontier] != -1]
+            next_start = position + len(frontier)
+            child[internal] = next_start + 2 * np.arange(len(internal))
+            position = next_start
+            frontier = np.column_stack([nodes.left[internal], nodes.right[internal]]).ravel()
+        order = np.concatenate(levels)
+        self.depth = len(levels) - 1
+
+        is_leaf = nodes.left[order] == -1
+        feature = np.where(is_leaf, 0, nodes.feature[order])
+        threshold = nodes.threshold[order]
+        # Leaves point to themselves and never go right
+        child = np.where(is_leaf, np.arange(len(order)), child[order])
+
+        self.bin_edges = []
+        threshold_index = np.full(len(order), LEAF_THRESHOLD, dtype=np.int64)
+        for index in range(n_features):
+            split = ~is_leaf & (feature == index)
+            edges = np.unique(threshold[split])
+            if len(edges) >= LEAF_THRESHOLD:
+                raise ValueError(f"Feature {index} has too many distinct thresholds "
+                                 f"to be quantized ({len(edges)})")
+            threshold_index[split] = np.searchsorted(edges, threshold[split])
+            self.bin_edges.append(edges)
+
+        self.nodes = (child << 32) | (feature.astype(np.int64) << 16) | threshold_index
+        # Leaves go "left" to stay in place when their dummy feature is NaN
+        self.missing_left = nodes.missing_left[order] | is_leaf
+        self.leaf_index = np.cumsum(is_leaf, dtype=np.int64) - 1
+        self.leaf_values = np.ascontiguousarray(nodes.value[order[is_leaf]], dtype=np.float32)
+
+        if kind == "forest":
+            self.classes_ = np.arange(self.leaf_values.shape[1])
+        else:
+            self.leaf_values = self.leaf_values[:, 0]
+            self.bias = np.asarray(bias, dtype=np.float64)
+            self.classes_ = np.arange(len(self.bias))
+            # Sums the leaf values of the trees of each class in one product
+            self.class_matrix = np.zeros((self.n_trees, len(self.bias)))
+            self.class_matrix[np.arange(self.n_trees), tree_class] = 1.0
+
+    def apply(self, X: NDArray[np.float32]) -> NDArray[np.int64]:
+        """
+        Find the leaf of every tree each sample falls into.
+
+        Parameters:
+            X: Feature matrix of shape (n_samples, n_features).
+
+        Returns:
+            Leaf indices into leaf_values of shape (n_samples, n_trees).
+        """
+        binned = self._bin(X).ravel()
+        missing = np.isnan(X).ravel()
+        if not missing.any():
+            missing = None
+        rows = np.arange(len(X))[:, np.newaxis] * self.n_features_in_
+        nodes = np.broadcast_to(np.arange(self.n_trees), (len(X), self.n_trees))
+
+        for _ in range(self.depth):
+            words = self.nodes[nodes]
+            values = rows + ((words >> 16) & 0xFFFF)
+            go_right = binned[values] > (words & 0xFFFF)
+            if missing is not None:
+                go_right = np.where(missing[values], ~self.missing_left[nodes], go_right)
+            nodes = (words >> 32) + go_right
+
+        return self.leaf_index[nodes]
+
+    def predict_proba(self, X: NDArray[np.float32]) -> NDArray[np.float64]:
+        X = np.asarray(X, dtype=np.float32)
+        probabilities = np.empty((len(X), len(self.classes_)))
+        chunk_rows = max(CHUNK_NODES // self.n_trees, 1)
+        for start in range(0, len(X), chunk_rows):
+            leaves = self.apply(X[start:start + chunk_rows])
+            probabilities[start:start + len(leaves)] = self._combine(leaves)
+        return probabilities
+
+    def predict(self, X: NDArray[np.float32]) -> NDArray[np.int64]:
+        return np.argmax(self.predict_proba(X), axis=1)
+
+    def _bin(self, X: NDArray[np.float32]) -> NDArray[np.uint16]:
+        # The bin of a value is the number of thresholds below it, so it
+        # exceeds the index of a threshold exactly if the value does
+        binned = np.empty(X.shape, dtype=np.uint16)
+        for index, edges in enumerate(self.bin_edges):
+            binned[:, index] = np.searchsorted(edges, X[:, index], side="left")
+        return binned
+
+    def _combine(self, leaves: NDArray[np.int64]) -> NDArray[np.float64]:
+        if self.kind == "forest":
+            return self.leaf_values[leaves].sum(axis=1, dtype=np.float64) / self.n_trees
+
+        raw = self.leaf_values[leaves].astype(np.float64) @ self.class_matrix + self.bias
+        raw -= raw.max(axis=1, keepdims=True)
+        probabilities = np.exp(raw)
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+
+def compile_model(model, check_features: Optional[NDArray[np.float32]] = None,
+                  atol: float = PROBABILITY_ATOL) -> CompiledTreeEnsemble:
+    """
+    Compile a trained tree ensemble.
+
+    Parameters:
+        model: A fitted RandomForestClassifier, GradientBoostingClassifier
+            or XGBClassifier, or a model loaded from a serving artifact.
+        check_features: Feature rows the compiled model is checked
+            against the original one on. CHECK_ROWS rows with values at
+            and next to the thresholds of the model are used if None.
+        atol: Largest accepted difference of the probabilities.
+
+    Returns:
+        The compiled model.
+
+    Raises:
+        TypeError: If the model type is not supported.
+        ValueError: If the model is not a multi-class model, cannot be
+            packed or its predictions differ from the original model.
+    """
+    feature_names = getattr(model, "feature_names_in_", None)
+    if hasattr(model, "get_booster"):
+        booster = model.get_booster()
+        # Early stopped models keep the trees after the best iteration,
+        # which are not used for predictions
+        best_iteration = getattr(model, "best_iteration", None)
+        if best_iteration is not None:
+            booster = booster[:best_iteration + 1]
+        compiled = _compile_xgboost(booster)
+    elif isinstance(model, model_artifact.FlatTreeEnsemble):
+        compiled = _compile_flat(model)
+    elif isinstance(model, RandomForestClassifier):
+        nodes = _concatenate_trees([tree.tree_ for tree in model.estimators_], normalize=True)
+        compiled = CompiledTreeEnsemble(nodes, "forest", model.n_features_in_, feature_names)
+    elif isinstance(model, GradientBoostingClassifier):
+        if model.n_classes_ < 3:
+            raise ValueError("Only multi-class Gradient Boosting models can be compiled")
+        nodes = _concatenate_trees([tree.tree_ for tree in model.estimators_.ravel()],
+                                   normalize=False)
+        nodes = nodes._replace(value=nodes.value * model.learning_rate)
+        tree_class = np.tile(np.arange(model.n_classes_), len(model.estimators_))
+        bias = model._raw_predict_init(np.zeros((1, model.n_features_in_),
+                                                dtype=np.float32))[0]
+        compiled = CompiledTreeEnsemble(nodes, "boosting", model.n_features_in_,
+                                        feature_names, tree_class, bias)
+    else:
+        raise TypeError(f"Cannot compile a model of type {type(model).__name__}")
+
+    if feature_names is not None:
+        compiled.feature_names_in_ = np.array(feature_names, dtype=object)
+
+    if check_features is None:
+        check_features = _threshold_rows(compiled)
+    check_features = np.asarray(check_features, dtype=np.float32)
+    with warnings.catch_warnings():
+        # Models fitted on DataFrames warn about the plain matrix
+        warnings.filterwarnings("ignore", message="X does not have valid feature names")
+        expected = model.predict_proba(check_features)
+    difference = np.max(np.abs(compiled.predict_proba(check_features) - expected))
+    if difference > atol:
+        raise ValueError(f"The compiled model differs from the original model "
+                         f"by up to {difference:.2e}")
+
+    return compiled
+
+
+def _threshold_rows(compiled: CompiledTreeEnsemble, n_rows: int = CHECK_ROWS,
+                    seed: int = 0) -> NDArray[np.float32]:
+    # Random rows whose values are thresholds of the model or the next
+    # float32 values below and above them, where a quantization error
+    # would change the path through a tree
+    rng = np.random.default_rng(seed)
+    X = np.zeros((n_rows, compiled.n_features_in_), dtype=np.float32)
+    for index, edges in enumerate(compiled.bin_edges):
+        if len(edges):
+            values = np.concatenate([np.nextafter(edges, np.float32(-np.inf)), edges,
+                                     np.nextafter(edges, np.float32(np.inf))])
+            # scikit-learn splits off missing values with infinite thresholds
+            values = values[np.isfinite(values)]
+            if len(values):
+                X[:, index] = rng.choice(values, n_rows)
+    return X
+
+
+def _round_down(threshold: NDArray[np.float64]) -> NDArray[np.float32]:
+    # The largest float32 t with x <= t exactly if x <= threshold for
+    # every float32 x
+    rounded = threshold.astype(np.float32)
+    too_high = rounded.astype(np.float64) > threshold
+    rounded[too_high] = np.nextafter(rounded[too_high], np.float32(-np.inf))
+    return rounded
+
+
+def _concatenate_trees(trees: List, normalize: bool) -> _Nodes:
+    offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+    feature, threshold, left, right, value, missing_left = [], [], [], [], [], []
+
+    for tree, offset in zip(trees, offsets):
+        is_leaf = tree.children_left == -1
+        feature.append(tree.feature)
+        threshold.append(tree.threshold)
+        left.append(np.where(is_leaf, -1, tree.children_left + offset))
+        right.append(np.where(is_leaf, -1, tree.children_right + offset))
+        # Versions before scikit-learn 1.3 do not support missing values
+        missing_left.append(getattr(tree, "missing_go_to_left",
+                                    np.zeros(tree.node_count)).astype(bool))
+
+        node_value = tree.value[:, 0, :]
+        if normalize:
+            total = node_value.sum(axis=1, keepdims=True)
+            node_value = node_value / np.where(total == 0, 1, total)
+        value.append(node_value)
+
+    return _Nodes(np.concatenate(feature).astype(np.int64),
+                  _round_down(np.concatenate(threshold)),
+                  np.concatenate(left).astype(np.int64),
+                  np.concatenate(right).astype(np.int64),
+                  np.concatenate(value),
+                  offsets[:-1].astype(np.int64),
+                  np.concatenate(missing_left))
+
+
+def _compile_flat(model: model_artifact.FlatTreeEnsemble) -> CompiledTreeEnsemble:
+    nodes = _Nodes(np.asarray(model.feature, dtype=np.int64),
+                   _round_down(np.asarray(model.threshold, dtype=np.float64)),
+                   np.asarray(model.left, dtype=np.int64),
+                   np.asarray(model.right, dtype=np.int64),
+                   np.asarray(model.value, dtype=np.float64),
+                   np.asarray(model.roots, dtype=np.int64),
+                   # The artifacts send NaN right, it fails every <= test
+                   np.zeros(len(model.feature), dtype=bool))
+    if model.kind == "forest":
+        return CompiledTreeEnsemble(nodes, "forest", model.n_features_in_)
+
+    nodes = nodes._replace(value=nodes.value * model.learning_rate)
+    return CompiledTreeEnsemble(nodes, "boosting", model.n_features_in_, None,
+                                np.asarray(model.tree_class), model.init_raw)
+
+
+def _compile_xgboost(booster) -> CompiledTreeEnsemble:
+    # The JSON model holds the exact float32 split conditions and leaf
+    # values, unlike the text dumps
+    learner = json.loads(booster.save_raw(raw_format="json"))["learner"]
+    objective = learner["objective"]["name"]
+    if objective not in ("multi:softprob", "multi:softmax"):
+        raise ValueError(f"Only multi-class XGBoost models can be compiled, "
+                         f"got objective '{objective}'")
+    gradient_booster = learner["gradient_booster"]
+    if gradient_booster["name"] != "gbtree":
+        raise TypeError(f"Cannot compile an XGBoost model with the "
+                        f"'{gradient_booster['name']}' booster")
+
+    trees = gradient_booster["model"]["trees"]
+    offsets = np.cumsum([0] + [len(tree["left_children"]) for tree in trees])
+    feature, threshold, left, right, value, missing_left = [], [], [], [], [], []
+    for tree, offset in zip(trees, offsets):
+        tree_left = np.array(tree["left_children"], dtype=np.int64)
+        tree_right = np.array(tree["right_children"], dtype=np.int64)
+        conditions = np.array(tree["split_conditions"], dtype=np.float32)
+        is_leaf = tree_left == -1
+        feature.append(np.array(tree["split_indices"], dtype=np.int64))
+        # XGBoost sends x < condition to the left child, leaves hold
+        # their value in place of the condition
+        threshold.append(np.nextafter(conditions, np.float32(-np.inf)))
+        left.append(np.where(is_leaf, -1, tree_left + offset))
+        right.append(np.where(is_leaf, -1, tree_right + offset))
+        value.append(np.where(is_leaf, conditions, 0.0)[:, np.newaxis])
+        missing_left.append(np.array(tree["default_left"], dtype=bool))
+
+    nodes = _Nodes(np.concatenate(feature), np.concatenate(threshold).astype(np.float32),
+                   np.concatenate(left), np.concatenate(right), np.concatenate(value),
+                   offsets[:-1].astype(np.int64), np.concatenate(missing_left))
+
+    parameters = learner["learner_model_param"]
+    n_classes = int(parameters["num_class"])
+    # A single number before XGBoost 3, one value per class since
+    base_score = [float(value) for value in parameters["base_score"].strip("[]").split(",")]
+    bias = np.broadcast_to(np.array(base_score), (n_classes,))
+    tree_class = np.array(gradient_booster["model"]["tree_info"], dtype=np.int64)
+
+    return CompiledTreeEnsemble(nodes, "boosting", int(parameters["num_feature"]),
+                                learner.get("feature_names") or None, tree_class, bias)
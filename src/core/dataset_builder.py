@@ -0,0 +1,253 @@
+"""
+Builds the training feature table from a directory of labelled audio.
+
+The audio directory is laid out as <label>/<track>, with any further
+nesting below the label directory. Every track is split into 3 second
+segments and the features of all its segments are extracted in a pool of
+worker processes. Each finished track is saved as a small part file
+named after a hash of its path, size, modification time and the feature
+version, so an interrupted build resumes where it stopped and only
+changed tracks are extracted again.
+
+Once all tracks are done the parts are combined into the table
+directory:
+- features.npy: float32 matrix of shape (n_segments, n_features),
+- labels.npy: index of the label of each row,
+- tracks.npy: index of the track of each row,
+- schema.json: the feature columns, labels, track paths and settings.
+
+The .npy files can be memory-mapped by the training scripts.
+
+Usage:
+    python -m src.core.dataset_builder genres/ -o data/features_3_sec
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from numpy.typing import NDArray
+from typing import Dict, List, Optional, Tuple
+import src.core.audio_feature_extractor as extractor
+from src.core.audio_cache import AudioCache
+from src.core.batch import AUDIO_EXTENSIONS
+
+
+FORMAT_VERSION = 1
+SCHEMA_FILE = "schema.json"
+PARTS_DIRECTORY = "parts"
+TABLE_PATH = r"data\features_3_sec"
+
+
+def find_labelled_tracks(audio_root: str) -> List[Tuple[str, str]]:
+    """
+    Find the audio files of every label directory.
+
+    Parameters:
+        audio_root: Directory with one subdirectory per label.
+
+    Returns:
+        A sorted list of (path relative to audio_root, label) tuples.
+            Files directly in audio_root have no label and are skipped.
+    """
+    tracks = []
+    for root, _, names in os.walk(audio_root):
+        relative_root = os.path.relpath(root, audio_root)
+        if relative_root == os.curdir:
+            continue
+        label = relative_root.split(os.sep)[0]
+        tracks.extend((os.path.join(relative_root, name), label) for name in names
+                      if name.lower().endswith(AUDIO_EXTENSIONS))
+    return sorted(tracks)
+
+
+def _part_name(audio_root: str, track: str, segment_length: int) -> str:
+    status = os.stat(os.path.join(audio_root, track))
+    key = (f"{track}:{status.st_size}:{status.st_mtime_ns}:"
+           f"{segment_length}:{extractor.FEATURE_VERSION}")
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + ".npy"
+
+
+def _extract_track(audio_root: str, track: str, part_path: str, segment_length: int,
+                   audio_cache_path: Optional[str] = None) -> Tuple[str, Optional[str]]:
+    # Runs in a worker process. The part is written to a temporary file
+    # first so that a crash never leaves a truncated part behind.
+    try:
+        cache = None if audio_cache_path is None else AudioCache(audio_cache_path)
+        audio_data, _ = extractor.load_audio(os.path.join(audio_root, track), cache=cache)
+        matrix = extractor.extract_features_batch(
+            extractor.segment_audio(audio_data, segment_length))
+
+        temporary_path = part_path + ".tmp"
+        with open(temporary_path, mode="wb") as file:
+            np.save(file, matrix)
+        os.replace(temporary_path, part_path)
+        return track, None
+    except Exception as e:
+        return track, str(e)
+
+
+def build_feature_table(audio_root: str, output_path: str,
+                        workers: Optional[int] = None,
+                        segment_length: int = extractor.SEGMENT_LENGTH,
+                        audio_cache_path: Optional[str] = None) -> Tuple[int, int]:
+    """
+    Extract the segment features of all labelled tracks and write them
+    as a feature table.
+
+    Parameters:
+        audio_root: Directory with one subdirectory per label.
+        output_path: Directory of the feature table.
+        workers: Number of worker processes, all available cores if None.
+        segment_length: Number of samples in each segment.
+        audio_cache_path: Directory of a decoded audio cache, which
+            makes rebuilds with a different segment length or feature
+            version skip the decoding.
+
+    Returns:
+        A tuple with the number of tracks in the table and the number of
+            tracks that failed and were left out.
+    """
+    parts_path = os.path.join(output_path, PARTS_DIRECTORY)
+    os.makedirs(parts_path, exist_ok=True)
+
+    tracks = find_labelled_tracks(audio_root)
+    if not tracks:
+        return 0, 0
+
+    part_paths = {track: os.path.join(parts_path, _part_name(audio_root, track, segment_length))
+                  for track, _ in tracks}
+    pending = [track for track, _ in tracks if not os.path.exists(part_paths[track])]
+    print(f"{len(tracks) - len(pending)} of {len(tracks)} tracks already extracted",
+          file=sys.stderr)
+
+    failed = set()
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            futures = [executor.submit(_extract_track, audio_root, track,
+                                       part_paths[track], segment_length, audio_cache_path)
+                       for track in pending]
+            for done, future in enumerate(as_completed(futures), start=1):
+                track, error = future.result()
+                if error is not None:
+                    failed.add(track)
+                    print(f"{track}: {error}", file=sys.stderr)
+                if done % 100 == 0 or done == len(futures):
+                    print(f"Extracted {done} of {len(futures)} tracks", file=sys.stderr)
+
+    if len(failed) < len(tracks):
+        _write_table([(track, label, part_paths[track]) for track, label in tracks
+                      if track not in failed],
+                     output_path, segment_length)
+    _remove_stale_parts(parts_path, set(part_paths.values()))
+    return len(tracks) - len(failed), len(failed)
+
+
+def _write_table(tracks: List[Tuple[str, str, str]], output_path: str, segment_length: int):
+    # Parts are loaded twice, once for the row counts and once to fill
+    # the table, so the whole table is never held in memory
+    row_counts = [np.load(part_path, mmap_mode="r").shape[0] for _, _, part_path in tracks]
+    n_rows = sum(row_counts)
+    labels = sorted({label for _, label, _ in tracks})
+    label_index = {label: index for index, label in enumerate(labels)}
+
+    features_path = os.path.join(output_path, "features.npy")
+    temporary_path = features_path + ".tmp"
+    features = np.lib.format.open_memmap(temporary_path, mode="w+", dtype=np.float32,
+                                         shape=(n_rows, len(extractor.FEATURE_COLUMNS)))
+    row_labels = np.empty(n_rows, dtype=np.int32)
+    row_tracks = np.empty(n_rows, dtype=np.int32)
+
+    start = 0
+    for index, ((_, label, part_path), count) in enumerate(zip(tracks, row_counts)):
+        features[start:start + count] = np.load(part_path)
+        row_labels[start:start + count] = label_index[label]
+        row_tracks[start:start + count] = index
+        start += count
+    features.flush()
+    del features
+
+    # The schema is written last, a table without one is incomplete
+    schema_path = os.path.join(output_path, SCHEMA_FILE)
+    if os.path.exists(schema_path):
+        os.remove(schema_path)
+    os.replace(temporary_path, features_path)
+    np.save(os.path.join(output_path, "labels.npy"), row_labels)
+    np.save(os.path.join(output_path, "tracks.npy"), row_tracks)
+
+    schema = {
+        "format_version": FORMAT_VERSION,
+        "feature_version": extractor.FEATURE_VERSION,
+        "sampling_rate": extractor.SAMPLING_RATE,
+        "segment_length": segment_length,
+        "columns": extractor.FEATURE_COLUMNS,
+        "labels": labels,
+        "tracks": [track for track, _, _ in tracks],
+    }
+    with open(schema_path, mode="w") as file:
+        json.dump(schema, file, indent=2)
+
+
+def _remove_stale_parts(parts_path: str, current_parts: set):
+    # Parts of tracks that were changed or removed since an earlier
+    # build, and temporary files of interrupted ones
+    for name in os.listdir(parts_path):
+        part_path = os.path.join(parts_path, name)
+        if part_path not in current_parts:
+            os.remove(part_path)
+
+
+def load_feature_table(path: str, mmap: bool = True) -> Tuple[NDArray[np.float32],
+                                                             NDArray[np.int32], Dict]:
+    """
+    Load a feature table written by build_feature_table.
+
+    Parameters:
+        path: Directory of the feature table.
+        mmap: Whether to memory-map the arrays instead of reading them
+            into memory.
+
+    Returns:
+        A tuple with the feature matrix, the label index of each row and
+            the schema of the table.
+
+    Raises:
+        IOError: If the table cannot be read.
+    """
+    try:
+        with open(os.path.join(path, SCHEMA_FILE)) as file:
+            schema = json.load(file)
+        mmap_mode = "r" if mmap else None
+        features = np.load(os.path.join(path, "features.npy"), mmap_mode=mmap_mode)
+        labels = np.load(os.path.join(path, "labels.npy"), mmap_mode=mmap_mode)
+    except Exception as e:
+        raise IOError(f"Error loading feature table {path}: {e}")
+
+    return features, labels, schema
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Build the training feature table.")
+    parser.add_argument("audio_root", help="directory with one subdirectory per label")
+    parser.add_argument("-o", "--output", default=TABLE_PATH,
+                        help="directory of the feature table")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes (default: all cores)")
+    parser.add_argument("--audio-cache", default=None, metavar="DIRECTORY",
+                        help="cache of decoded audio reused across rebuilds")
+    args = parser.parse_args(argv)
+
+    tracks, failed = build_feature_table(args.audio_root, args.output, args.workers,
+                                         audio_cache_path=args.audio_cache)
+    if tracks + failed == 0:
+        print("No labelled audio files found", file=sys.stderr)
+        return 1
+
+    print(f"Wrote {tracks} tracks to {args.output}, {failed} failed", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,329 @@
+"""
+This module contains a cache of extracted features.
+
+Features are stored under a hash of the decoded audio samples, the
+sampling rate and the feature version, so identical audio is only
+processed once no matter which file it was loaded from. Recently used
+entries are kept in memory and, optionally, all entries are persisted
+in an SQLite database so that they survive restarts of the application.
+
+Both tiers are bounded in size and evict the least recently used
+entries first.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+from numpy.typing import NDArray
+from typing import Dict, Optional
+import src.core.audio_feature_extractor as extractor
+
+
+MAX_MEMORY_BYTES = 64 * 1024 * 1024
+MAX_DISK_BYTES = 1024 * 1024 * 1024
+
+# Access times of disk hits are written in batches, after this many hits
+# or this many seconds, whichever comes first
+ACCESS_FLUSH_SIZE = 64
+ACCESS_FLUSH_SECONDS = 10.0
+
+
+def audio_hash(audio_data: NDArray[np.float32]) -> str:
+    """
+    Compute a hash of the content of audio data.
+
+    Parameters:
+        audio_data: The audio data as a NumPy array.
+
+    Returns:
+        A hexadecimal digest of the samples, their type and shape.
+    """
+    audio_data = np.ascontiguousarray(audio_data)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{audio_data.dtype.str}{audio_data.shape}".encode())
+    digest.update(audio_data.data)
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    """
+    A two-tier LRU cache of extracted features.
+
+    The cache is safe to use from several threads, and several processes
+    may share one database file.
+    """
+    def __init__(self, db_path: Optional[str] = None,
+                 max_memory_bytes: int = MAX_MEMORY_BYTES,
+                 max_disk_bytes: int = MAX_DISK_BYTES):
+        """
+        Initialize the feature cache.
+
+        Parameters:
+            db_path: Path to the SQLite database of the on-disk tier. Only
+                the in-memory tier is used if None.
+            max_memory_bytes: Size limit of the in-memory tier.
+            max_disk_bytes: Size limit of the on-disk tier.
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+        # Access times not yet written to the database, and an estimate of
+        # its size that is only recounted when it exceeds the budget
+        self._accesses = {}
+        self._last_flush = time.monotonic()
+        self._disk_bytes = 0
+
+        self._db = None
+        if db_path is not None:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS features ("
+                             "key TEXT PRIMARY KEY, "
+                             "data BLOB NOT NULL, "
+                             "size INTEGER NOT NULL, "
+                             "last_access REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS features_last_access "
+                             "ON features (last_access)")
+            self._db.commit()
+            self._disk_bytes = self._count_disk_bytes()
+
+    def extract_features(self, audio_data: NDArray[np.float32],
+                         sampling_rate: int = extractor.SAMPLING_RATE,
+                         profile: str = extractor.DEFAULT_PROFILE) -> Dict[str, float]:
+        """
+        Cached version of extractor.extract_features.
+
+        Parameters:
+            audio_data: The audio data as a NumPy array.
+            sampling_rate: Sampling rate of the audio data.
+            profile: Name of the feature profile to extract.
+
+        Returns:
+            A dictionary of extracted features.
+        """
+        columns = extractor.profile_columns(profile)
+        key = self._key(f"track:{profile}", audio_data, sampling_rate)
+        matrix = self._get(key, len(columns))
+        if matrix is None:
+            features = extractor.extract_features(audio_data, profile)
+            self._put(key, np.array([[features[name] for name in columns]]))
+            return features
+
+        return dict(zip(columns, matrix[0]))
+
+    def extract_segment_features(self, audio_data: NDArray[np.float32],
+                                 segment_length: int = extractor.SEGMENT_LENGTH,
+                                 sampling_rate: int = extractor.SAMPLING_RATE,
+                                 profile: str = extractor.DEFAULT_PROFILE
+                                 ) -> Dict[str, NDArray]:
+        """
+        Cached version of extractor.extract_segment_features.
+
+        Parameters:
+            audio_data: The audio data as a NumPy array.
+            segment_length: Number of samples in each segment.
+            sampling_rate: Sampling rate of the audio data.
+            profile: Name of the feature profile to extract.
+
+        Returns:
+            A dictionary mapping feature names to arrays with one value
+                per segment.
+        """
+        columns = extractor.profile_columns(profile)
+        key = self._key(f"segments{segment_length}:{profile}", audio_data, sampling_rate)
+        n_segments = max(len(audio_data) // segment_length, 1)
+        matrix = self._get(key, len(columns), n_segments)
+        if matrix is None:
+            features = extractor.extract_segment_features(audio_data, segment_length, profile)
+            self._put(key, np.stack([features[name] for name in columns], axis=1))
+            return features
+
+        return dict(zip(columns, matrix.T))
+
+    def get_leading_segments(self, audio_data: NDArray[np.float32],
+                             segment_length: int = extractor.SEGMENT_LENGTH,
+                             sampling_rate: int = extractor.SAMPLING_RATE,
+                             profile: str = extractor.DEFAULT_PROFILE
+                             ) -> Optional[NDArray[np.float64]]:
+        """
+        Get the cached features of the first segments of the audio data.
+
+        Progressive classification only extracts the segments it needs,
+        so the entry may hold fewer rows than the audio has segments.
+
+        Parameters:
+            audio_data: The audio data as a NumPy array.
+            segment_length: Number of samples in each segment.
+            sampling_rate: Sampling rate of the audio data.
+            profile: Name of the feature profile.
+
+        Returns:
+            A matrix with one row per cached segment and the columns in
+                the order of profile_columns(profile), or None.
+        """
+        columns = extractor.profile_columns(profile)
+        key = self._key(f"segments{segment_length}:{profile}", audio_data, sampling_rate)
+        return self._get(key, len(columns))
+
+    def put_leading_segments(self, audio_data: NDArray[np.float32], matrix: NDArray,
+                             segment_length: int = extractor.SEGMENT_LENGTH,
+                             sampling_rate: int = extractor.SAMPLING_RATE,
+                             profile: str = extractor.DEFAULT_PROFILE):
+        """
+        Store the features of the first segments of the audio data.
+
+        Entries with fewer rows than segments are only returned by
+        get_leading_segments, extract_segment_features extracts all
+        segments again and replaces them.
+
+        Parameters:
+            audio_data: The audio data as a NumPy array.
+            matrix: The features of the first segments, with the columns
+                in the order of profile_columns(profile).
+            segment_length: Number of samples in each segment.
+            sampling_rate: Sampling rate of the audio data.
+            profile: Name of the feature profile.
+        """
+        key = self._key(f"segments{segment_length}:{profile}", audio_data, sampling_rate)
+        self._put(key, matrix)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the hit/miss counters and the size of the cache.
+
+        Returns:
+            A dictionary with the number of hits (of which disk_hits were
+                served from the on-disk tier), misses and the sizes of
+                both tiers in bytes.
+        """
+        with self._lock:
+            disk_bytes = 0
+            if self._db is not None:
+                disk_bytes = self._count_disk_bytes()
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_bytes": self._memory_bytes,
+                "disk_bytes": disk_bytes,
+            }
+
+    def clear(self):
+        """
+        Remove all entries from both tiers.
+        """
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            self._accesses.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM features")
+                self._db.commit()
+                self._disk_bytes = 0
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._flush_accesses()
+                self._db.close()
+                self._db = None
+
+    def _key(self, kind: str, audio_data: NDArray[np.float32], sampling_rate: int) -> str:
+        return f"{kind}:{sampling_rate}:{extractor.FEATURE_VERSION}:{audio_hash(audio_data)}"
+
+    def _get(self, key: str, n_columns: int,
+             min_rows: int = 1) -> Optional[NDArray[np.float64]]:
+        # Entries with fewer than min_rows rows count as misses
+        with self._lock:
+            matrix = self._memory.get(key)
+            if matrix is not None:
+                self._memory.move_to_end(key)
+            elif self._db is not None:
+                row = self._db.execute("SELECT data FROM features WHERE key = ?",
+                                       (key,)).fetchone()
+                if row is not None:
+                    self._accesses[key] = time.time()
+                    if (len(self._accesses) >= ACCESS_FLUSH_SIZE
+                            or time.monotonic() - self._last_flush >= ACCESS_FLUSH_SECONDS):
+                        self._flush_accesses()
+                    matrix = np.frombuffer(row[0], dtype=np.float64)
+                    matrix = matrix.reshape(-1, n_columns)
+                    self._remember(key, matrix)
+                    if len(matrix) >= min_rows:
+                        self.disk_hits += 1
+
+            if matrix is None or len(matrix) < min_rows:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return matrix
+
+    def _put(self, key: str, matrix: NDArray):
+        matrix = np.ascontiguousarray(matrix, dtype=np.float64)
+        with self._lock:
+            self._remember(key, matrix)
+            if self._db is not None:
+                data = matrix.tobytes()
+                self._db.execute("INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?)",
+                                 (key, data, len(data), time.time()))
+                self._disk_bytes += len(data)
+                self._evict_disk()
+                self._db.commit()
+
+    def _remember(self, key: str, matrix: NDArray[np.float64]):
+        # Must be called with the lock held
+        if key in self._memory:
+            self._memory_bytes -= self._memory.pop(key).nbytes
+        self._memory[key] = matrix
+        self._memory_bytes += matrix.nbytes
+
+        while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes
+
+    def _count_disk_bytes(self) -> int:
+        # Must be called with the lock held, or from __init__
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM features").fetchone()[0]
+
+    def _flush_accesses(self):
+        # Must be called with the lock held, writes the batched access
+        # times of disk hits
+        if self._accesses:
+            self._db.executemany("UPDATE features SET last_access = ? WHERE key = ?",
+                                 [(last_access, key)
+                                  for key, last_access in self._accesses.items()])
+            self._db.commit()
+            self._accesses.clear()
+        self._last_flush = time.monotonic()
+
+    def _evict_disk(self):
+        # Must be called with the lock held, deletes the least recently
+        # used rows until the database fits into its budget. The running
+        # total misses replaced rows and writes of other processes, so it
+        # is recounted before anything is deleted.
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+        self._flush_accesses()
+        self._disk_bytes = self._count_disk_bytes()
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+
+        excess = self._disk_bytes - self.max_disk_bytes
+        rows = self._db.execute("SELECT key, size FROM features ORDER BY last_access")
+        evicted = []
+        for key, size in rows:
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+            self._disk_bytes -= size
+        self._db.executemany("DELETE FROM features WHERE key = ?", evicted)
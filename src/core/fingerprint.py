@@ -0,0 +1,392 @@
+"""
+This module contains audio fingerprints and an index of them for finding
+duplicate and near-duplicate tracks (re-encodes, other bitrates, trimmed
+copies).
+
+The fingerprint follows Haitsma and Kalker. The whole signal is split
+into overlapping frames with a hop of FRAME_HOP samples, much shorter
+than the frames, so that a copy trimmed by any number of samples is
+misaligned by at most half a hop, a small fraction of a frame. The
+energy of every frame is pooled into 33 bands between 300 and 2000 Hz,
+and every frame yields one 32-bit word: each bit is the sign of the
+change over time of the difference between two adjacent bands. These
+signs survive lossy coding and gain changes, so the fingerprints of two
+copies of a track differ in few bits. The magnitude of the change is
+kept as the reliability of the bit, bits close to zero flip first.
+
+The index is an SQLite database of the fingerprints and a table from
+words to their occurrences, for a content-defined sample of about one in
+INDEX_SAMPLING words of every track. A query looks up the sampled words
+among its own words and their variants with the PROBE_BITS least
+reliable bits flipped, so frames whose words picked up a few bit errors
+still find their counterpart. Its cost depends on the length of the
+query and not on the number of indexed tracks. Tracks that share words
+at a consistent time offset are then compared word by word, and a track
+matches if the bit error rate of the aligned fingerprints is at most
+MAX_BIT_ERROR_RATE. Identical files are found by their content hash
+without decoding them.
+
+Predictions can be stored with each indexed track, keyed by the model
+they were made with, so that duplicates reuse them.
+"""
+import json
+import sqlite3
+import threading
+import numpy as np
+from collections import Counter, defaultdict
+from numpy.typing import NDArray
+from typing import Dict, NamedTuple, Optional, Tuple
+import src.core.audio_feature_extractor as extractor
+
+
+# Frames of about 186 ms with a hop of about 12 ms at 22050 Hz
+FRAME_LENGTH = 4096
+FRAME_HOP = 256
+
+# Frequency range of the bands in Hz
+MIN_FREQUENCY = 300.0
+MAX_FREQUENCY = 2000.0
+
+# Number of pooled bands, adjacent pairs of which give the 32 bits
+N_BANDS = 33
+
+# Number of frames transformed at once, bounds the memory of long files
+FRAME_CHUNK = 2048
+
+# About one in INDEX_SAMPLING words of a track is indexed
+INDEX_SAMPLING = 16
+
+# Number of least reliable bits of every query word that are flipped in
+# all combinations when looking up the index
+PROBE_BITS = 8
+
+# Largest fraction of differing bits of two aligned fingerprints of the
+# same recording
+MAX_BIT_ERROR_RATE = 0.35
+
+# Smallest fraction of the shorter fingerprint two matching tracks have
+# to overlap in, so that an excerpt does not match the whole track
+MIN_OVERLAP = 0.8
+
+# Number of sampled words a candidate has to share with the query at the
+# same offset before its fingerprint is compared
+MIN_VOTES = 3
+
+# Number of best candidates whose fingerprints are compared
+MAX_CANDIDATES = 5
+
+# Number of words looked up per query to the postings table
+LOOKUP_CHUNK = 500
+
+# Number of query frames whose variants are generated and looked up at
+# once, bounds the memory of long queries
+PROBE_CHUNK = 4096
+
+
+class Fingerprint(NamedTuple):
+    # One 32-bit word per frame after the first
+    words: NDArray[np.uint32]
+    # Magnitude behind every bit of shape (n_words, 32), the smaller the
+    # likelier the bit is to differ in a copy
+    reliability: NDArray[np.float32]
+
+
+class DuplicateMatch(NamedTuple):
+    track_id: int
+    file_path: str
+    bit_error_rate: float
+    # Frame of the indexed track aligned with the first frame of the query
+    offset: int
+    # Fraction of the shorter fingerprint covered by both
+    overlap: float
+
+
+def compute_fingerprint(audio_data: NDArray[np.float32],
+                        sampling_rate: int = extractor.SAMPLING_RATE) -> Fingerprint:
+    """
+    Compute the fingerprint of a whole signal.
+
+    Parameters:
+        audio_data: The mono audio data as a NumPy array.
+        sampling_rate: Sampling rate of the audio data.
+
+    Returns:
+        The words of the fingerprint and the reliability of their bits.
+    """
+    bands = _band_energies(audio_data, sampling_rate)
+    difference = bands[:, :-1] - bands[:, 1:]
+    change = difference[1:] - difference[:-1]
+
+    weights = np.left_shift(np.uint32(1), np.arange(N_BANDS - 1, dtype=np.uint32))
+    words = ((change > 0) * weights).sum(axis=1, dtype=np.uint32)
+    return Fingerprint(words, np.abs(change).astype(np.float32))
+
+
+def _band_energies(audio_data: NDArray[np.float32], sampling_rate: int) -> NDArray[np.float64]:
+    # Log energy of every frame in every band, of shape (n_frames, N_BANDS).
+    # The frames are transformed in chunks, a spectrogram of a whole
+    # track at this hop would not fit into memory.
+    audio_data = np.asarray(audio_data, dtype=np.float32)
+    if len(audio_data) < FRAME_LENGTH:
+        audio_data = np.pad(audio_data, (0, FRAME_LENGTH - len(audio_data)))
+    frames = np.lib.stride_tricks.sliding_window_view(audio_data, FRAME_LENGTH)[::FRAME_HOP]
+
+    # Bins of every band, each band gets at least one bin
+    frequencies = np.geomspace(MIN_FREQUENCY, MAX_FREQUENCY, N_BANDS + 1)
+    edges = np.round(frequencies * FRAME_LENGTH / sampling_rate).astype(int)
+    edges = np.maximum(edges, edges[0] + np.arange(N_BANDS + 1))
+
+    window = np.hanning(FRAME_LENGTH).astype(np.float32)
+    energies = np.empty((len(frames), N_BANDS))
+    for start in range(0, len(frames), FRAME_CHUNK):
+        spectrum = np.fft.rfft(frames[start:start + FRAME_CHUNK] * window, axis=1)
+        power = np.abs(spectrum[:, edges[0]:edges[-1]]) ** 2
+        energies[start:start + FRAME_CHUNK] = np.add.reduceat(power, edges[:-1] - edges[0],
+                                                              axis=1)
+
+    # Digital silence gives equal bands and words of zero bits
+    return np.log(energies + 1e-10)
+
+
+def bit_error_rate(first: NDArray[np.uint32], second: NDArray[np.uint32]) -> float:
+    """
+    Get the fraction of differing bits of two aligned fingerprints of
+    the same length.
+    """
+    differences = np.bitwise_xor(first, second)
+    return float(np.unpackbits(differences.view(np.uint8)).mean())
+
+
+def _is_sampled(words: NDArray) -> NDArray[np.bool_]:
+    # Whether words are in the indexed sample. The sample depends on the
+    # words only, so it picks the same words in a shifted copy. Words of
+    # silence (all bits equal) occur in every track and are left out.
+    words = np.asarray(words, dtype=np.uint64)
+    mixed = (words * np.uint64(2654435761)) & np.uint64(0xFFFFFFFF)
+    return (((mixed >> np.uint64(16)) % np.uint64(INDEX_SAMPLING) == 0)
+            & (words != 0) & (words != 0xFFFFFFFF))
+
+
+def _probes(words: NDArray[np.uint32],
+            reliability: NDArray[np.float32]) -> Tuple[NDArray[np.int64], NDArray[np.int64]]:
+    # Sampled words among the query words and their variants with the
+    # least reliable bits flipped, and the frames they were derived from.
+    # The arrays have 2**PROBE_BITS entries per word, so callers pass
+    # chunks of at most PROBE_CHUNK words.
+    if len(words) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    n_bits = min(PROBE_BITS, reliability.shape[1])
+    unreliable = np.argpartition(reliability, n_bits - 1, axis=1)[:, :n_bits]
+
+    # Every subset of the unreliable bits of a frame as a mask
+    subsets = (np.arange(1 << n_bits)[:, np.newaxis] >> np.arange(n_bits)) & 1
+    masks = np.left_shift(1, unreliable.astype(np.int64)) @ subsets.T
+    candidates = words.astype(np.int64)[:, np.newaxis] ^ masks
+
+    sampled = _is_sampled(candidates)
+    frames, _ = np.nonzero(sampled)
+    return candidates[sampled], frames
+
+
+class FingerprintIndex:
+    """
+    An SQLite index of track fingerprints and their predictions.
+
+    The index is safe to use from several threads, and several processes
+    may share one database file.
+    """
+    def __init__(self, db_path: str):
+        """
+        Open or create the index.
+
+        Parameters:
+            db_path: Path to the SQLite database.
+        """
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS tracks ("
+                         "id INTEGER PRIMARY KEY, "
+                         "file_path TEXT NOT NULL, "
+                         "file_hash TEXT, "
+                         "words BLOB NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS tracks_file_hash ON tracks (file_hash)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS postings ("
+                         "word INTEGER NOT NULL, "
+                         "track_id INTEGER NOT NULL, "
+                         "frame INTEGER NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS postings_word ON postings (word)")
+        # Content hashes of other files that matched an indexed track
+        self._db.execute("CREATE TABLE IF NOT EXISTS copies ("
+                         "file_hash TEXT PRIMARY KEY, "
+                         "track_id INTEGER NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS results ("
+                         "track_id INTEGER NOT NULL, "
+                         "model TEXT NOT NULL, "
+                         "probabilities TEXT NOT NULL, "
+                         "PRIMARY KEY (track_id, model))")
+        self._db.commit()
+
+    def add(self, file_path: str, words: NDArray[np.uint32],
+            file_hash: Optional[str] = None) -> int:
+        """
+        Add the fingerprint of a track.
+
+        Parameters:
+            file_path: Path to the audio file.
+            words: The words of the fingerprint, see compute_fingerprint.
+            file_hash: Hash of the file content, see history_store.file_hash.
+
+        Returns:
+            The id of the new track.
+        """
+        words = np.ascontiguousarray(words, dtype=np.uint32)
+        frames = np.flatnonzero(_is_sampled(words))
+        with self._lock:
+            cursor = self._db.execute("INSERT INTO tracks (file_path, file_hash, words) "
+                                      "VALUES (?, ?, ?)",
+                                      (file_path, file_hash, words.tobytes()))
+            track_id = cursor.lastrowid
+            self._db.executemany("INSERT INTO postings (word, track_id, frame) "
+                                 "VALUES (?, ?, ?)",
+                                 [(int(words[frame]), track_id, int(frame))
+                                  for frame in frames])
+            self._db.commit()
+        return track_id
+
+    def add_copy(self, file_hash: str, track_id: int):
+        """
+        Record that a file is a copy of an indexed track, so that
+        find_exact finds the track by the hash of the file.
+
+        Parameters:
+            file_hash: Hash of the content of the copy.
+            track_id: The id of the track.
+        """
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO copies (file_hash, track_id) "
+                             "VALUES (?, ?)", (file_hash, track_id))
+            self._db.commit()
+
+    def find_exact(self, file_hash: str) -> Optional[int]:
+        """
+        Find a track by the hash of its file content or of a copy of it.
+
+        Returns:
+            The id of the track, or None.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT id FROM tracks WHERE file_hash = ? "
+                                   "UNION ALL "
+                                   "SELECT track_id FROM copies WHERE file_hash = ? "
+                                   "LIMIT 1", (file_hash, file_hash)).fetchone()
+        return None if row is None else row[0]
+
+    def find(self, fingerprint: Fingerprint) -> Optional[DuplicateMatch]:
+        """
+        Find an indexed track that is a copy of the query.
+
+        Parameters:
+            fingerprint: The fingerprint of the query.
+
+        Returns:
+            The matching track with the lowest bit error rate, or None.
+        """
+        # Votes for the time offsets of the tracks sharing sampled words
+        votes = Counter()
+        words, reliability = fingerprint
+        for first_frame in range(0, len(words), PROBE_CHUNK):
+            self._vote(votes, words[first_frame:first_frame + PROBE_CHUNK],
+                       reliability[first_frame:first_frame + PROBE_CHUNK], first_frame)
+
+        best = None
+        candidates = [candidate for candidate, count in votes.most_common(MAX_CANDIDATES)
+                      if count >= MIN_VOTES]
+        words = np.asarray(fingerprint.words, dtype=np.uint32)
+        for track_id, offset in candidates:
+            match = self._compare(words, track_id, offset)
+            if match is not None and (best is None or match.bit_error_rate < best.bit_error_rate):
+                best = match
+        return best
+
+    def set_result(self, track_id: int, model: str, probabilities: Dict[str, float]):
+        """
+        Store the prediction of a track.
+
+        Parameters:
+            track_id: The id of the track.
+            model: Key of the model and the settings it was made with.
+            probabilities: The probability of each genre.
+        """
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO results (track_id, model, probabilities) "
+                             "VALUES (?, ?, ?)",
+                             (track_id, model, json.dumps(
+                                 {name: float(value) for name, value in probabilities.items()})))
+            self._db.commit()
+
+    def result(self, track_id: int, model: str) -> Optional[Dict[str, float]]:
+        """
+        Get the stored prediction of a track.
+
+        Returns:
+            The probability of each genre, or None if the track was not
+                classified with this model.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT probabilities FROM results "
+                                   "WHERE track_id = ? AND model = ?",
+                                   (track_id, model)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _vote(self, votes: Counter, words: NDArray[np.uint32],
+              reliability: NDArray[np.float32], first_frame: int):
+        # Adds the votes of a chunk of query frames starting at first_frame
+        query_frames = defaultdict(list)
+        probe_words, probe_frames = _probes(words, reliability)
+        for word, frame in zip(probe_words.tolist(), (probe_frames + first_frame).tolist()):
+            query_frames[word].append(frame)
+
+        lookup = list(query_frames)
+        with self._lock:
+            for start in range(0, len(lookup), LOOKUP_CHUNK):
+                chunk = lookup[start:start + LOOKUP_CHUNK]
+                rows = self._db.execute("SELECT word, track_id, frame FROM postings "
+                                        f"WHERE word IN ({', '.join('?' * len(chunk))})",
+                                        chunk).fetchall()
+                for word, track_id, frame in rows:
+                    for query_frame in query_frames[word]:
+                        votes[track_id, frame - query_frame] += 1
+
+    def _compare(self, words: NDArray[np.uint32], track_id: int,
+                 offset: int) -> Optional[DuplicateMatch]:
+        with self._lock:
+            row = self._db.execute("SELECT file_path, words FROM tracks WHERE id = ?",
+                                   (track_id,)).fetchone()
+        if row is None:
+            return None
+        file_path, blob = row
+        indexed = np.frombuffer(blob, dtype=np.uint32)
+
+        # Frame i of the query is aligned with frame i + offset of the track
+        start = max(0, -offset)
+        stop = min(len(words), len(indexed) - offset)
+        if stop <= start:
+            return None
+        overlap = (stop - start) / min(len(words), len(indexed))
+        if overlap < MIN_OVERLAP:
+            return None
+
+        error_rate = bit_error_rate(words[start:stop], indexed[start + offset:stop + offset])
+        if error_rate > MAX_BIT_ERROR_RATE:
+            return None
+        return DuplicateMatch(track_id, file_path, error_rate, offset, overlap)
@@ -1,64 +1,401 @@
 import joblib
+import os
+import warnings
 import numpy as np
 import pandas as pd
-from typing import Dict
+from typing import Dict, List, NamedTuple, Optional, Union
 from numpy.typing import NDArray
 import src.core.audio_feature_extractor as extractor
+import src.core.compiled_trees as compiled_trees
+import src.core.model_artifact as model_artifact
+import src.core.profiling as profiling
+from src.core.feature_cache import FeatureCache
+
+
+# Ways of combining the probabilities predicted for the segments of
+# a track into the probabilities for the whole track
+AGGREGATIONS = ("mean", "vote", "max")
+
+# Scores of the running aggregate that can end a progressive
+# classification early: "margin" is the difference between the two most
+# probable genres, "confidence" the probability of the most probable one
+EARLY_EXIT_CRITERIA = ("margin", "confidence")
+EARLY_EXIT_THRESHOLD = 0.5
+
+# Progressive classification never stops before MIN_SEGMENTS segments
+# and scores PROGRESSIVE_STEP segments per model call
+MIN_SEGMENTS = 3
+PROGRESSIVE_STEP = 2
+
+
+class ProgressiveResult(NamedTuple):
+    # Aggregated probability of each genre over the segments used
+    probabilities: Dict[str, float]
+    segments_used: int
+    total_segments: int
+    # Seconds of audio the features were extracted from
+    audio_seconds: float
+    # Whether the threshold was reached before the end of the audio
+    early_exit: bool
+
+
+def aggregate_probabilities(segment_probabilities: NDArray[np.float64],
+                            aggregation: str = "mean") -> NDArray[np.float64]:
+    """
+    Combine per-segment genre probabilities into track probabilities.
+    
+    Parameters:
+        segment_probabilities: Array of shape (n_segments, n_genres).
+        aggregation: "mean" averages the probabilities, "vote" returns
+            the fraction of segments for which each genre was the most
+            probable one and "max" takes the highest probability of each
+            genre over all segments, normalized to sum to one.
+    
+    Returns:
+        An array with the probability of each genre.
+        
+    Raises:
+        ValueError: If the aggregation is not one of AGGREGATIONS.
+    """
+    if aggregation == "mean":
+        return segment_probabilities.mean(axis=0)
+    if aggregation == "vote":
+        n_segments, n_genres = segment_probabilities.shape
+        votes = np.bincount(segment_probabilities.argmax(axis=1), minlength=n_genres)
+        return votes / n_segments
+    if aggregation == "max":
+        maxima = segment_probabilities.max(axis=0)
+        return maxima / maxima.sum()
+    
+    raise ValueError(f"Unknown aggregation '{aggregation}', "
+                     f"expected one of {AGGREGATIONS}")
+
 
 class MusicGenreClassifier:
     def __init__(self, model_path: str,
-                 encoder_path: str,
-                 sampling_rate: int = extractor.SAMPLING_RATE):
+                 encoder_path: Optional[str] = None,
+                 sampling_rate: int = extractor.SAMPLING_RATE,
+                 feature_cache: Optional[FeatureCache] = None,
+                 profile: Optional[str] = None,
+                 compiled: bool = False):
         """
         Initialize the music genre classifier.
         
         Parameters:
-            model_path: Path to the trained XGBoost model.
-            encoder_path: Path to the label encoder.
+            model_path: Path to the trained model, either a pickle or a
+                serving artifact directory written by export_model.
+            encoder_path: Path to the label encoder. Artifacts embed
+                their labels, so it may be omitted for them.
             sampling_rate: Sampling rate for audio processing.
+            feature_cache: Cache of extracted features. Features are
+                extracted anew for every call if None.
+            profile: Feature profile the model was trained on, one of
+                FEATURE_PROFILES. Determined from the feature names of
+                the model if None.
+            compiled: Whether to evaluate the trees with the compiled
+                inference engine of compiled_trees instead of the
+                library of the model. The compiled model is checked
+                against the original one when it is loaded.
+        
+        Raises:
+            ValueError: If the model was not trained on the features of
+                a known profile, the label encoder of a pickled model is
+                missing, or the model cannot be compiled or its compiled
+                probabilities differ by more than
+                compiled_trees.PROBABILITY_ATOL.
         """
         self.sampling_rate = sampling_rate
-        self.model = joblib.load(model_path)
-        self.label_encoder = joblib.load(encoder_path)
+        self.model_path = model_path
+        self.encoder_path = encoder_path
+        self.compiled = compiled
+        if os.path.isdir(model_path):
+            self.model, self.label_encoder = model_artifact.load_model(model_path)
+        else:
+            self.model = joblib.load(model_path)
+        if encoder_path is not None:
+            self.label_encoder = joblib.load(encoder_path)
+        elif not os.path.isdir(model_path):
+            raise ValueError("A label encoder is required for pickled models")
+        self.feature_cache = feature_cache
+        
+        # Features are passed to the model as plain float32 matrices, so
+        # their order is checked once here instead of on every prediction
+        self.profile = self._resolve_profile(profile)
+        self.feature_columns = extractor.profile_columns(self.profile)
+        
+        # XGBoost models are scored directly through their booster, which
+        # skips the input conversion of the scikit-learn wrapper
+        self._booster = None
+        self._iteration_range = (0, 0)
+        if compiled:
+            self.model = compiled_trees.compile_model(self.model)
+        elif hasattr(self.model, "get_booster"):
+            self._booster = self.model.get_booster()
+            best_iteration = getattr(self.model, "best_iteration", None)
+            if best_iteration is not None:
+                self._iteration_range = (0, best_iteration + 1)
     
-    def classify_genre(self, audio_data: NDArray[np.float32]) -> str:
+    def classify_genre(self, audio_data: NDArray[np.float32],
+                       segmented: bool = False,
+                       aggregation: str = "mean") -> str:
         """
         Classify the genre of an audio file based on its raw audio data.
         
         Parameters:
             audio_data: Raw audio data as a NumPy array.
+            segmented: Whether to classify the 3 second segments of the
+                audio, like the models were trained on, instead of the
+                whole signal at once.
+            aggregation: How to combine the segment predictions, one of
+                AGGREGATIONS. Only used in segmented mode.
         
         Returns:
             The predicted genre of the audio file.
         """
-        features = extractor.extract_features(audio_data)
-        features_df = pd.DataFrame([features])
-        
-        # Perform prediction
-        y_pred_encoded = self.model.predict(features_df)
+        with profiling.stage("classify_genre"):
+            if segmented:
+                probabilities = self.predict_probabilities(audio_data, segmented, aggregation)
+                return max(probabilities, key=probabilities.get)
+            
+            features = self._extract_features(audio_data)
+            
+            # Perform prediction
+            matrix = extractor.features_to_matrix(features, self.feature_columns)
+            probabilities = self.predict_feature_probabilities(matrix)
         
-        # Decode the predicted label
-        y_pred = self.label_encoder.inverse_transform(y_pred_encoded)
-        
-        return y_pred[0]
+            # Decode the predicted label
+            return self.label_encoder.classes_[np.argmax(probabilities[0])]
     
-    def predict_probabilities(self, audio_data: NDArray[np.float32]) -> Dict[str, float]:
+    def predict_probabilities(self, audio_data: NDArray[np.float32],
+                              segmented: bool = False,
+                              aggregation: str = "mean") -> Dict[str, float]:
         """
         Get the probabilities that the audio file belongs to each genre.
         
         Parameters:
             audio_data: Raw audio data as a NumPy array.
+            segmented: Whether to classify the 3 second segments of the
+                audio, like the models were trained on, instead of the
+                whole signal at once.
+            aggregation: How to combine the segment predictions, one of
+                AGGREGATIONS. Only used in segmented mode.
         
         Returns:
             A dictionary with genres as keys and their corresponding
                 probabilities as values.
         """
-        features = extractor.extract_features(audio_data)
-        features_df = pd.DataFrame([features])
-        
-        probabilities = self.model.predict_proba(features_df)[0]
+        with profiling.stage("predict_probabilities"):
+            if segmented:
+                segment_probabilities = self.predict_segment_probabilities(audio_data)
+                probabilities = aggregate_probabilities(segment_probabilities, aggregation)
+            else:
+                features = self._extract_features(audio_data)
+                probabilities = self.predict_feature_probabilities(
+                    extractor.features_to_matrix(features, self.feature_columns))[0]
         
-        # Map probabilities to genre labels
-        genre_probabilities = dict(zip(self.label_encoder.classes_, probabilities))
+            # Map probabilities to genre labels
+            genre_probabilities = dict(zip(self.label_encoder.classes_, probabilities))
 
-        return genre_probabilities
+            return genre_probabilities
+    
+    def predict_segment_probabilities(self,
+                                      audio_data: NDArray[np.float32]) -> NDArray[np.float64]:
+        """
+        Get the genre probabilities of every 3 second segment of the audio.
+        
+        The features of all segments are extracted in one batch and scored
+        with a single call to the model.
+        
+        Parameters:
+            audio_data: Raw audio data as a NumPy array.
+        
+        Returns:
+            An array of shape (n_segments, n_genres) with the columns in
+                the order of the label encoder classes.
+        """
+        features = self._extract_segment_features(audio_data)
+        
+        matrix = extractor.features_to_matrix(features, self.feature_columns)
+        
+        return self.predict_feature_probabilities(matrix)
+    
+    def predict_progressive(self, audio_data: NDArray[np.float32],
+                            threshold: float = EARLY_EXIT_THRESHOLD,
+                            criterion: str = "margin",
+                            aggregation: str = "mean",
+                            min_segments: int = MIN_SEGMENTS,
+                            step: int = PROGRESSIVE_STEP) -> ProgressiveResult:
+        """
+        Classify the 3 second segments of the audio in order and stop as
+        soon as the aggregated prediction is certain enough.
+        
+        Ambiguous tracks that never reach the threshold are classified
+        from all their segments, like predict_probabilities does in
+        segmented mode.
+        
+        With a feature cache, the features of the segments classified by
+        an earlier call are reused and the ones extracted by this call are
+        added to them.
+        
+        Parameters:
+            audio_data: Raw audio data as a NumPy array.
+            threshold: Score of the aggregated probabilities at which the
+                classification stops.
+            criterion: The score compared to the threshold, one of
+                EARLY_EXIT_CRITERIA.
+            aggregation: How to combine the segment predictions, one of
+                AGGREGATIONS.
+            min_segments: Number of segments classified before the score
+                is first checked.
+            step: Number of segments classified per model call after the
+                first min_segments.
+        
+        Returns:
+            The aggregated probabilities and how much of the audio was
+                used to compute them.
+        
+        Raises:
+            ValueError: If the criterion or the aggregation is unknown.
+        """
+        if criterion not in EARLY_EXIT_CRITERIA:
+            raise ValueError(f"Unknown early exit criterion '{criterion}', "
+                             f"expected one of {EARLY_EXIT_CRITERIA}")
+        
+        with profiling.stage("predict_progressive"):
+            segments = extractor.segment_audio(audio_data)
+            
+            # Features of the segments extracted so far, by earlier calls
+            # or by this one
+            extracted = []
+            if self.feature_cache is not None:
+                cached = self.feature_cache.get_leading_segments(
+                    audio_data, sampling_rate=self.sampling_rate, profile=self.profile)
+                if cached is not None:
+                    extracted.append(cached.astype(np.float32))
+            n_cached = n_extracted = sum(len(matrix) for matrix in extracted)
+            
+            segment_probabilities = []
+            used = 0
+            while used < len(segments):
+                count = max(step, min_segments - used)
+                stop = min(used + count, len(segments))
+                if stop > n_extracted:
+                    extracted.append(extractor.extract_features_batch(
+                        segments[n_extracted:stop], profile=self.profile))
+                    n_extracted = stop
+                matrix = np.concatenate(extracted)[used:stop]
+                segment_probabilities.append(self.predict_feature_probabilities(matrix))
+                used = stop
+                
+                probabilities = aggregate_probabilities(
+                    np.concatenate(segment_probabilities), aggregation)
+                if used >= min_segments and self._early_exit_score(
+                        probabilities, criterion) >= threshold:
+                    break
+            
+            if self.feature_cache is not None and n_extracted > n_cached:
+                self.feature_cache.put_leading_segments(
+                    audio_data, np.concatenate(extracted), sampling_rate=self.sampling_rate,
+                    profile=self.profile)
+        
+        audio_seconds = min(used * segments.shape[1], len(audio_data)) / self.sampling_rate
+        return ProgressiveResult(dict(zip(self.label_encoder.classes_, probabilities)),
+                                 used, len(segments), audio_seconds, used < len(segments))
+    
+    def _early_exit_score(self, probabilities: NDArray[np.float64], criterion: str) -> float:
+        top, second = np.sort(probabilities)[::-1][:2]
+        if criterion == "margin":
+            return top - second
+        return top
+    
+    def predict_feature_probabilities(self, features: Union[NDArray[np.float32], pd.DataFrame]
+                                      ) -> NDArray:
+        """
+        Get the genre probabilities of already extracted feature rows.
+        
+        Parameters:
+            features: A matrix with one row of features per segment or
+                track and the columns in the order of feature_columns,
+                or a DataFrame with named feature columns.
+        
+        Returns:
+            An array of shape (n_rows, n_genres) with the columns in
+                the order of the label encoder classes.
+        """
+        if isinstance(features, pd.DataFrame):
+            features = features[self.feature_columns].to_numpy(dtype=np.float32)
+        
+        with profiling.stage("model.predict_proba"):
+            return self._predict_proba(features)
+    
+    def _predict_proba(self, features: NDArray[np.float32]) -> NDArray:
+        # Unprofiled scoring, also used by the ensembles of model_registry
+        # which time the scoring of all their models as one stage
+        if self._booster is not None:
+            return self._booster.inplace_predict(features,
+                                                 iteration_range=self._iteration_range)
+        
+        # The models were fitted on DataFrames, scikit-learn warns about
+        # the missing column names of the already validated matrix
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message="X does not have valid feature names")
+            return self.model.predict_proba(features)
+    
+    def predict_batch_probabilities(self,
+                                    batch: List[Dict[str, NDArray]]) -> List[NDArray[np.float64]]:
+        """
+        Get the genre probabilities of the features of several files
+        with a single call to the model.
+        
+        Parameters:
+            batch: Features of each file as returned by
+                extract_segment_features, one or more rows per file.
+        
+        Returns:
+            A list with an array of shape (n_rows, n_genres) per file.
+        """
+        matrices = [extractor.features_to_matrix(features, self.feature_columns)
+                    for features in batch]
+        probabilities = self.predict_feature_probabilities(np.concatenate(matrices))
+        boundaries = np.cumsum([len(matrix) for matrix in matrices])[:-1]
+        
+        return np.split(probabilities, boundaries)
+    
+    def _resolve_profile(self, profile: Optional[str]) -> str:
+        feature_names = getattr(self.model, "feature_names_in_", None)
+        if feature_names is None and hasattr(self.model, "get_booster"):
+            feature_names = self.model.get_booster().feature_names
+        
+        if profile is None:
+            profile = extractor.DEFAULT_PROFILE
+            if feature_names is not None:
+                profile = next((name for name in extractor.FEATURE_PROFILES
+                                if extractor.profile_columns(name) == list(feature_names)),
+                               None)
+                if profile is None:
+                    raise ValueError("The model was trained on features that do not "
+                                     "match any feature profile")
+        
+        columns = extractor.profile_columns(profile)
+        if feature_names is not None:
+            if list(feature_names) != columns:
+                raise ValueError(f"The model was trained on different feature columns "
+                                 f"than the ones of the '{profile}' profile")
+        elif getattr(self.model, "n_features_in_", len(columns)) != len(columns):
+            raise ValueError(f"The model expects {self.model.n_features_in_} features, "
+                             f"the '{profile}' profile has {len(columns)}")
+        
+        return profile
+    
+    def _extract_features(self, audio_data: NDArray[np.float32]) -> Dict[str, float]:
+        if self.feature_cache is None:
+            return extractor.extract_features(audio_data, self.profile)
+        return self.feature_cache.extract_features(audio_data, self.sampling_rate,
+                                                   self.profile)
+    
+    def _extract_segment_features(self, audio_data: NDArray[np.float32]) -> Dict[str, NDArray]:
+        if self.feature_cache is None:
+            return extractor.extract_segment_features(audio_data, profile=self.profile)
+        return self.feature_cache.extract_segment_features(audio_data,
+                                                           sampling_rate=self.sampling_rate,
+                                                           profile=self.profile)
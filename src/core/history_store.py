@@ -0,0 +1,237 @@
+"""
+This module contains the persistent history of predictions.
+
+Every prediction is stored in an SQLite database in WAL mode with the
+file name and path, a hash of the file content, the predicted genre, the
+probabilities of all genres and the time the prediction took. The table
+is indexed by time and by genre and time, so that pages of a filtered
+history are read with index range scans no matter how long the history
+grows. Pages are addressed by the position of their last entry (keyset
+pagination) rather than by an offset, which would have to skip all
+preceding rows.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+
+# Date format of the history.csv file of earlier versions
+LEGACY_DATE_FORMAT = "%H:%M:%S %d-%m-%Y"
+
+
+class HistoryEntry(NamedTuple):
+    id: int
+    timestamp: float
+    file_name: str
+    file_path: Optional[str]
+    file_hash: Optional[str]
+    genre: str
+    probabilities: Dict[str, float]
+    # Duration of the prediction in seconds, None for imported entries
+    elapsed: Optional[float]
+
+
+def file_hash(file_path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Compute a hash of the content of a file.
+
+    Parameters:
+        file_path: Path to the file.
+        chunk_size: Number of bytes read at once.
+
+    Returns:
+        A hexadecimal digest of the file content.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_path, mode="rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HistoryStore:
+    """
+    An SQLite store of past predictions.
+
+    The store is safe to use from several threads.
+    """
+    def __init__(self, db_path: str):
+        """
+        Open or create the history database.
+
+        Parameters:
+            db_path: Path to the SQLite database.
+        """
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS predictions ("
+                         "id INTEGER PRIMARY KEY, "
+                         "timestamp REAL NOT NULL, "
+                         "file_name TEXT NOT NULL, "
+                         "file_path TEXT, "
+                         "file_hash TEXT, "
+                         "genre TEXT NOT NULL, "
+                         "probabilities TEXT NOT NULL, "
+                         "elapsed REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS predictions_timestamp "
+                         "ON predictions (timestamp, id)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS predictions_genre "
+                         "ON predictions (genre, timestamp, id)")
+        self._db.commit()
+
+    def add(self, file_path: str, probabilities: Dict[str, float],
+            file_hash: Optional[str] = None, elapsed: Optional[float] = None,
+            timestamp: Optional[float] = None) -> int:
+        """
+        Record a prediction.
+
+        Parameters:
+            file_path: Path to the audio file.
+            probabilities: The probability of each genre.
+            file_hash: Hash of the file content.
+            elapsed: Duration of the prediction in seconds.
+            timestamp: Time of the prediction as a Unix timestamp, the
+                current time if None.
+
+        Returns:
+            The id of the new entry.
+        """
+        genre = max(probabilities, key=probabilities.get)
+        row = (time.time() if timestamp is None else timestamp,
+               os.path.basename(file_path), file_path, file_hash, genre,
+               json.dumps({name: float(value) for name, value in probabilities.items()}),
+               elapsed)
+        with self._lock:
+            cursor = self._db.execute("INSERT INTO predictions (timestamp, file_name, "
+                                      "file_path, file_hash, genre, probabilities, elapsed) "
+                                      "VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+            self._db.commit()
+            return cursor.lastrowid
+
+    def count(self, genre: Optional[str] = None, since: Optional[float] = None,
+              until: Optional[float] = None) -> int:
+        """
+        Count the entries matching a filter.
+
+        Parameters:
+            genre: Only count predictions of this genre if given.
+            since: Only count predictions at or after this Unix timestamp.
+            until: Only count predictions before this Unix timestamp.
+
+        Returns:
+            The number of matching entries.
+        """
+        where, parameters = self._filter(genre, since, until)
+        with self._lock:
+            return self._db.execute(f"SELECT COUNT(*) FROM predictions{where}",
+                                    parameters).fetchone()[0]
+
+    def page(self, limit: int, after: Optional[Tuple[float, int]] = None,
+             genre: Optional[str] = None, since: Optional[float] = None,
+             until: Optional[float] = None) -> List[HistoryEntry]:
+        """
+        Read a page of entries matching a filter, newest first.
+
+        Parameters:
+            limit: Maximum number of entries.
+            after: (timestamp, id) of the last entry of the previous page,
+                the page starts with the newest entry if None.
+            genre: Only return predictions of this genre if given.
+            since: Only return predictions at or after this Unix timestamp.
+            until: Only return predictions before this Unix timestamp.
+
+        Returns:
+            The entries of the page.
+        """
+        where, parameters = self._filter(genre, since, until, after)
+        with self._lock:
+            rows = self._db.execute("SELECT id, timestamp, file_name, file_path, file_hash, "
+                                    f"genre, probabilities, elapsed FROM predictions{where} "
+                                    "ORDER BY timestamp DESC, id DESC LIMIT ?",
+                                    parameters + [limit]).fetchall()
+        return [HistoryEntry(*row[:6], json.loads(row[6]), row[7]) for row in rows]
+
+    def genres(self) -> List[str]:
+        """
+        Get the genres that occur in the history.
+
+        Returns:
+            A sorted list of genres.
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT DISTINCT genre FROM predictions "
+                                    "ORDER BY genre").fetchall()
+        return [genre for genre, in rows]
+
+    def import_csv(self, csv_path: str) -> int:
+        """
+        Import the history.csv file of earlier versions, which has the
+        file name, the genre and the date of each prediction.
+
+        Parameters:
+            csv_path: Path to the CSV file.
+
+        Returns:
+            The number of imported entries.
+        """
+        rows = []
+        with open(csv_path, mode="r", newline="", encoding="utf-8") as file:
+            for line in file:
+                # The file names were written unquoted and may contain
+                # commas, the genre and date never do
+                fields = line.rstrip("\r\n").rsplit(",", 2)
+                if len(fields) != 3:
+                    continue
+                file_name, genre, date_time = fields
+                try:
+                    timestamp = datetime.strptime(date_time, LEGACY_DATE_FORMAT).timestamp()
+                except ValueError:
+                    continue
+                rows.append((timestamp, file_name, None, None, genre,
+                             json.dumps({genre: 1.0}), None))
+
+        with self._lock:
+            self._db.executemany("INSERT INTO predictions (timestamp, file_name, "
+                                 "file_path, file_hash, genre, probabilities, elapsed) "
+                                 "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+        return len(rows)
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM predictions")
+            self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _filter(self, genre: Optional[str], since: Optional[float], until: Optional[float],
+                after: Optional[Tuple[float, int]] = None) -> Tuple[str, List]:
+        conditions, parameters = [], []
+        if genre is not None:
+            conditions.append("genre = ?")
+            parameters.append(genre)
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("timestamp < ?")
+            parameters.append(until)
+        if after is not None:
+            conditions.append("(timestamp, id) < (?, ?)")
+            parameters.extend(after)
+
+        if not conditions:
+            return "", parameters
+        return " WHERE " + " AND ".join(conditions), parameters
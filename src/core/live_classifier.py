@@ -0,0 +1,418 @@
+"""
+This module contains a live genre tracker for audio streams (radio,
+stream ingest, microphone input).
+
+The tracker keeps the most recent WINDOW_SECONDS of the stream and emits
+a smoothed genre estimate every HOP_SECONDS. The work per update does
+not depend on how long the stream has been running:
+- the STFT and the frame-wise features (chroma, RMS, spectral
+  statistics, zero crossing rate, log-mel spectrum) are computed only
+  for the frames completed by the new samples and kept in ring buffers
+  of a fixed size,
+- the harmonic/percussive masks of a frame are computed once, as soon
+  as the HPSS_CONTEXT frames after it have arrived,
+- only the statistics of the window (means and variances, MFCCs, the
+  tempo and the inverse STFT of the harmonic and percussive parts) are
+  computed over the whole window at every update.
+Memory and CPU time per second of audio are therefore bounded.
+
+The features of a window approximate the ones extract_features computes
+from the same 3 seconds of audio. The frames at the edges of the window
+see the neighbouring audio instead of padding, and the chroma features
+assume standard tuning (A440) instead of estimating it per window. For
+models using the harmonic/percussive features the window ends
+HPSS_CONTEXT frames (about 0.35 s) before the latest sample, the
+lookahead of the harmonic median filter.
+
+The edge frames cause most of the difference. extract_features pads the
+window with zeros, so its two frames at each edge are quieter, which
+raises the variances of the RMS and of the MFCCs in particular. On
+synthesized music the means stay within LIVE_MEAN_TOLERANCE standard
+deviations of the offline features, and the variances and the tempo
+within a relative difference of LIVE_RTOL (rms_var differs most, by
+about 55%).
+
+Usage:
+    classifier = MusicGenreClassifier(MODEL_PATH, ENCODER_PATH)
+    for estimate in track_genres(classifier, blocks):
+        print(estimate.time, estimate.genre)
+
+    python -m src.core.live_classifier stream.wav
+"""
+import argparse
+import librosa
+import numpy as np
+import scipy.ndimage
+from numpy.typing import NDArray
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional
+import src.core.audio_feature_extractor as extractor
+import src.core.genre_prediction as prediction
+import src.core.profiling as profiling
+import src.core.streaming_features as streaming_features
+from src.core.audio_feature_extractor import SAMPLING_RATE, N_FFT, HOP_LENGTH, N_MFCC, TOP_DB
+
+
+MODEL_PATH = r"models\xgb_model.pkl"
+ENCODER_PATH = r"models\xgb_encoder.pkl"
+
+# Length of the analysed window, the 3 second segments the models were
+# trained on
+WINDOW_SECONDS = extractor.SEGMENT_LENGTH / SAMPLING_RATE
+
+# Time between two estimates
+HOP_SECONDS = 0.5
+
+# Time constant of the exponential smoothing of the estimates
+SMOOTHING_SECONDS = 5.0
+
+# Kernel size of the median filters of librosa.decompose.hpss, a frame
+# is separated once the HPSS_CONTEXT frames after it have arrived
+HPSS_KERNEL = 31
+HPSS_CONTEXT = HPSS_KERNEL // 2
+
+# Largest differences between the features of a live window and the ones
+# extract_features computes from the same samples: means in standard
+# deviations of the feature within the window, all other features
+# relative to the offline value
+LIVE_MEAN_TOLERANCE = 0.15
+LIVE_RTOL = 0.6
+
+
+class LiveEstimate(NamedTuple):
+    # Position of the end of the analysed window in the stream in seconds
+    time: float
+    genre: str
+    # Smoothed probability of each genre
+    probabilities: Dict[str, float]
+    # Probability of each genre in the current window alone
+    window_probabilities: Dict[str, float]
+
+
+class RingBuffer:
+    """
+    A fixed-size buffer of the most recent items of a stream.
+
+    Items are addressed by their position in the whole stream.
+    """
+    def __init__(self, capacity: int, item_shape: tuple = (), dtype=np.float32):
+        self.capacity = capacity
+        self.data = np.zeros((capacity,) + tuple(item_shape), dtype=dtype)
+        # Number of items written since the start of the stream
+        self.end = 0
+
+    def extend(self, items: NDArray):
+        """
+        Append items, overwriting the oldest ones.
+        """
+        if len(items) > self.capacity:
+            self.end += len(items) - self.capacity
+            items = items[-self.capacity:]
+        positions = (self.end + np.arange(len(items))) % self.capacity
+        self.data[positions] = items
+        self.end += len(items)
+
+    def read(self, start: int, stop: int) -> NDArray:
+        """
+        Get a copy of the items from position start to stop.
+
+        Raises:
+            ValueError: If some of the items were overwritten or have
+                not been written yet.
+        """
+        if start < self.end - self.capacity or stop > self.end:
+            raise ValueError(f"Items {start} to {stop} are not in the buffer, "
+                             f"it holds {max(self.end - self.capacity, 0)} to {self.end}")
+        return self.data[np.arange(start, stop) % self.capacity]
+
+
+class LiveGenreTracker:
+    """
+    Tracks the genre of an audio stream over a sliding window.
+    """
+    def __init__(self, classifier: prediction.MusicGenreClassifier,
+                 window_seconds: float = WINDOW_SECONDS,
+                 hop_seconds: float = HOP_SECONDS,
+                 smoothing_seconds: float = SMOOTHING_SECONDS,
+                 callback: Optional[Callable[[LiveEstimate], None]] = None):
+        """
+        Initialize the tracker.
+
+        Parameters:
+            classifier: The classifier whose model scores the windows, a
+                MusicGenreClassifier or an EnsembleClassifier.
+            window_seconds: Length of the analysed window.
+            hop_seconds: Time between two estimates, rounded to whole
+                STFT hops.
+            smoothing_seconds: Time constant of the exponential moving
+                average of the probabilities, no smoothing if 0.
+            callback: Called with every estimate.
+
+        Raises:
+            ValueError: If the classifier works at another sampling rate
+                than SAMPLING_RATE or the window is shorter than N_FFT.
+        """
+        if classifier.sampling_rate != SAMPLING_RATE:
+            raise ValueError(f"Live tracking needs a classifier at {SAMPLING_RATE} Hz, "
+                             f"got {classifier.sampling_rate} Hz")
+        if window_seconds * SAMPLING_RATE < N_FFT:
+            raise ValueError(f"The window must be at least {N_FFT} samples long")
+
+        self.classifier = classifier
+        self.callback = callback
+        self.blocks = set(extractor.FEATURE_PROFILES[classifier.profile])
+        self.window_frames = 1 + int(window_seconds * SAMPLING_RATE) // HOP_LENGTH
+        self.hop_frames = max(int(round(hop_seconds * SAMPLING_RATE / HOP_LENGTH)), 1)
+        self.smoothing = 1.0
+        if smoothing_seconds > 0:
+            self.smoothing = 1.0 - np.exp(-self.hop_frames * HOP_LENGTH / SAMPLING_RATE
+                                          / smoothing_seconds)
+        self.context = HPSS_CONTEXT if "hpss" in self.blocks else 0
+        self.mel_basis = librosa.filters.mel(sr=SAMPLING_RATE, n_fft=N_FFT)
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the stream, the next sample starts a new one.
+        """
+        # The samples of the frames of one update, and the frames of the
+        # window plus the lookahead and lookbehind of the harmonic filter
+        self.samples = RingBuffer(N_FFT + (self.hop_frames + 1) * HOP_LENGTH)
+        capacity = self.window_frames + 2 * self.context + self.hop_frames + 2
+        n_bins = 1 + N_FFT // 2
+        self.frames = {}
+        if "chroma" in self.blocks:
+            self.frames["chroma"] = RingBuffer(capacity, (12,))
+        if "rms" in self.blocks:
+            self.frames["rms"] = RingBuffer(capacity)
+        if "spectral" in self.blocks:
+            for name in ("spectral_centroid", "spectral_bandwidth", "rolloff"):
+                self.frames[name] = RingBuffer(capacity)
+        if "zero_crossing_rate" in self.blocks:
+            self.frames["zero_crossing_rate"] = RingBuffer(capacity)
+        if "hpss" in self.blocks:
+            self.frames["stft"] = RingBuffer(capacity, (n_bins,), np.complex64)
+            self.frames["magnitude"] = RingBuffer(capacity, (n_bins,))
+            self.frames["harmony"] = RingBuffer(capacity, (n_bins,), np.complex64)
+            self.frames["perceptr"] = RingBuffer(capacity, (n_bins,), np.complex64)
+        if "tempo" in self.blocks or "mfcc" in self.blocks:
+            self.frames["log_mel"] = RingBuffer(capacity, (len(self.mel_basis),))
+
+        # Frames are centered on the samples like in librosa.stft, so the
+        # stream starts with half a frame of padding
+        self.samples.extend(np.zeros(N_FFT // 2, dtype=np.float32))
+        self.n_frames = 0
+        self.n_separated = 0
+        self.next_estimate = self.window_frames
+        self.smoothed = None
+
+    def push(self, block: NDArray[np.float32]) -> List[LiveEstimate]:
+        """
+        Add a block of samples to the stream.
+
+        Parameters:
+            block: Samples at SAMPLING_RATE, either mono or of shape
+                (n_samples, n_channels). Blocks may have any length.
+
+        Returns:
+            The estimates completed by the block, usually none or one.
+        """
+        block = np.asarray(block, dtype=np.float32)
+        if block.ndim > 1:
+            block = block.mean(axis=1, dtype=np.float32)
+
+        # Long blocks are processed one hop at a time, which bounds the
+        # frames of every update and emits every estimate in between
+        estimates = []
+        step = self.hop_frames * HOP_LENGTH
+        for start in range(0, len(block), step):
+            self.samples.extend(block[start:start + step])
+            with profiling.stage("live.frames"):
+                self._update_frames()
+                if self.context:
+                    self._update_separation()
+
+            ready = self.n_separated if self.context else self.n_frames
+            if ready >= self.next_estimate:
+                estimate = self._estimate(ready)
+                self.next_estimate = ready + self.hop_frames
+                estimates.append(estimate)
+                if self.callback is not None:
+                    self.callback(estimate)
+
+        return estimates
+
+    def _update_frames(self):
+        # Frames whose samples have all arrived
+        n_frames = max((self.samples.end - N_FFT) // HOP_LENGTH + 1, 0)
+        if n_frames <= self.n_frames:
+            return
+
+        first = self.n_frames
+        samples = self.samples.read(first * HOP_LENGTH, (n_frames - 1) * HOP_LENGTH + N_FFT)
+        stft = librosa.stft(samples, n_fft=N_FFT, hop_length=HOP_LENGTH, center=False)
+        magnitude = np.abs(stft)
+        power = magnitude ** 2
+
+        if "chroma" in self.frames:
+            chroma = librosa.feature.chroma_stft(S=power, sr=SAMPLING_RATE, tuning=0.0)
+            self.frames["chroma"].extend(chroma.T)
+        if "rms" in self.frames:
+            frames = librosa.util.frame(samples, frame_length=N_FFT, hop_length=HOP_LENGTH)
+            self.frames["rms"].extend(np.sqrt(np.mean(frames ** 2, axis=0)))
+        if "spectral_centroid" in self.frames:
+            centroid = librosa.feature.spectral_centroid(S=magnitude, sr=SAMPLING_RATE)
+            bandwidth = librosa.feature.spectral_bandwidth(S=magnitude, sr=SAMPLING_RATE,
+                                                           centroid=centroid)
+            rolloff = librosa.feature.spectral_rolloff(S=magnitude, sr=SAMPLING_RATE)
+            self.frames["spectral_centroid"].extend(centroid[0])
+            self.frames["spectral_bandwidth"].extend(bandwidth[0])
+            self.frames["rolloff"].extend(rolloff[0])
+        if "zero_crossing_rate" in self.frames:
+            zero_crossing_rate = librosa.feature.zero_crossing_rate(
+                y=samples, frame_length=N_FFT, hop_length=HOP_LENGTH, center=False)
+            self.frames["zero_crossing_rate"].extend(zero_crossing_rate[0])
+        if "stft" in self.frames:
+            self.frames["stft"].extend(stft.T)
+            self.frames["magnitude"].extend(magnitude.T)
+        if "log_mel" in self.frames:
+            # The 80 dB floor depends on the loudest frame of the window,
+            # it is applied when the window is scored
+            log_mel = librosa.power_to_db(self.mel_basis @ power, top_db=None)
+            self.frames["log_mel"].extend(log_mel.T)
+
+        self.n_frames = n_frames
+
+    def _update_separation(self):
+        # Same masks as librosa.decompose.hpss, computed for the frames
+        # whose harmonic filter window has fully arrived
+        ready = self.n_frames - self.context
+        if ready <= self.n_separated:
+            return
+
+        first = self.n_separated
+        slab_start = max(first - self.context, 0)
+        magnitude = self.frames["magnitude"].read(slab_start, self.n_frames).T
+        core = slice(first - slab_start, ready - slab_start)
+        harmonic = scipy.ndimage.median_filter(magnitude, size=(1, HPSS_KERNEL),
+                                               mode="reflect")[:, core]
+        percussive = scipy.ndimage.median_filter(magnitude[:, core], size=(HPSS_KERNEL, 1),
+                                                 mode="reflect")
+        harmonic_mask = librosa.util.softmask(harmonic, percussive, power=2.0)
+        percussive_mask = librosa.util.softmask(percussive, harmonic, power=2.0)
+
+        stft = self.frames["stft"].read(first, ready).T
+        self.frames["harmony"].extend((harmonic_mask * stft).T)
+        self.frames["perceptr"].extend((percussive_mask * stft).T)
+        self.n_separated = ready
+
+    def _estimate(self, end: int) -> LiveEstimate:
+        with profiling.stage("live.window"):
+            features = self._window_features(end - self.window_frames, end)
+        matrix = extractor.features_to_matrix(features, self.classifier.feature_columns)
+        window_probabilities = self.classifier.predict_feature_probabilities(matrix)[0]
+
+        if self.smoothed is None:
+            self.smoothed = window_probabilities
+        else:
+            self.smoothed = self.smoothed + self.smoothing * (window_probabilities
+                                                              - self.smoothed)
+
+        genres = self.classifier.label_encoder.classes_
+        probabilities = dict(zip(genres, self.smoothed))
+        return LiveEstimate(time=(end - 1) * HOP_LENGTH / SAMPLING_RATE,
+                            genre=max(probabilities, key=probabilities.get),
+                            probabilities=probabilities,
+                            window_probabilities=dict(zip(genres, window_probabilities)))
+
+    def _window_features(self, start: int, end: int) -> Dict[str, float]:
+        features = {}
+
+        def moments(name: str, values: NDArray):
+            features[f"{name}_mean"] = np.mean(values)
+            features[f"{name}_var"] = np.var(values)
+
+        for name in ("chroma", "rms", "spectral_centroid", "spectral_bandwidth", "rolloff",
+                     "zero_crossing_rate"):
+            if name in self.frames:
+                moments("chroma_stft" if name == "chroma" else name,
+                        self.frames[name].read(start, end))
+
+        if "hpss" in self.blocks:
+            for name in ("harmony", "perceptr"):
+                signal = librosa.istft(self.frames[name].read(start, end).T, n_fft=N_FFT,
+                                       hop_length=HOP_LENGTH, center=False, dtype=np.float32)
+                # Only the samples between the centers of the first and
+                # the last frame are covered by overlapping windows
+                moments(name, signal[N_FFT // 2:len(signal) - N_FFT // 2])
+
+        if "log_mel" in self.frames:
+            log_mel = self.frames["log_mel"].read(start, end).T
+            log_mel = np.maximum(log_mel, np.max(log_mel) - TOP_DB)
+
+            if "tempo" in self.blocks:
+                onset_envelope = librosa.onset.onset_strength(S=log_mel, sr=SAMPLING_RATE,
+                                                              hop_length=HOP_LENGTH,
+                                                              aggregate=np.median)
+                tempo = 0.0
+                if onset_envelope.any():
+                    tempo = librosa.feature.tempo(onset_envelope=onset_envelope,
+                                                  sr=SAMPLING_RATE,
+                                                  hop_length=HOP_LENGTH)[0]
+                features["tempo"] = tempo
+
+            if "mfcc" in self.blocks:
+                mfccs = librosa.feature.mfcc(S=log_mel, n_mfcc=N_MFCC)
+                for i in range(N_MFCC):
+                    features[f"mfcc{i+1}_mean"] = np.mean(mfccs[i])
+                    features[f"mfcc{i+1}_var"] = np.var(mfccs[i])
+
+        return features
+
+
+def track_genres(classifier: prediction.MusicGenreClassifier,
+                 blocks: Iterable[NDArray[np.float32]],
+                 window_seconds: float = WINDOW_SECONDS,
+                 hop_seconds: float = HOP_SECONDS,
+                 smoothing_seconds: float = SMOOTHING_SECONDS) -> Iterator[LiveEstimate]:
+    """
+    Track the genre of a stream of sample blocks.
+
+    Parameters:
+        classifier: The classifier whose model scores the windows.
+        blocks: Blocks of samples at SAMPLING_RATE, e.g. from an audio
+            input device, a network stream or a synthetic signal.
+        window_seconds: Length of the analysed window.
+        hop_seconds: Time between two estimates.
+        smoothing_seconds: Time constant of the smoothing.
+
+    Returns:
+        An iterator of the estimates, produced as the blocks arrive.
+    """
+    tracker = LiveGenreTracker(classifier, window_seconds, hop_seconds, smoothing_seconds)
+    for block in blocks:
+        yield from tracker.push(block)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Track the genre of an audio file as if "
+                                                 "it were a live stream.")
+    parser.add_argument("input", help="path to the audio file")
+    parser.add_argument("--model", default=MODEL_PATH, help="path to the trained model")
+    parser.add_argument("--encoder", default=ENCODER_PATH, help="path to the label encoder")
+    parser.add_argument("--window", type=float, default=WINDOW_SECONDS,
+                        help="length of the analysed window in seconds")
+    parser.add_argument("--hop", type=float, default=HOP_SECONDS,
+                        help="time between two estimates in seconds")
+    parser.add_argument("--smoothing", type=float, default=SMOOTHING_SECONDS,
+                        help="time constant of the smoothing in seconds, 0 to disable")
+    args = parser.parse_args(argv)
+
+    classifier = prediction.MusicGenreClassifier(args.model, args.encoder)
+    blocks = streaming_features.stream_audio(args.input, block_seconds=args.hop)
+    for estimate in track_genres(classifier, blocks, args.window, args.hop, args.smoothing):
+        print(f"{estimate.time:8.2f}s  {estimate.genre:<10} "
+              f"{estimate.probabilities[estimate.genre]:.1%}")
+
+
+if __name__ == "__main__":
+    main()
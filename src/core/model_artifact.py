@@ -0,0 +1,256 @@
+"""
+This module contains the compact serving format of the trained models.
+
+An artifact is a directory holding a metadata.json file with the genre
+labels and the feature column order, and the model itself:
+- XGBoost models are stored in the native UBJSON format (model.ubj),
+- scikit-learn Random Forests and Gradient Boosting Machines are
+  flattened into one array per node attribute (.npy files), which are
+  memory-mapped when loaded. Worker processes loading the same artifact
+  therefore share a single copy of the trees through the page cache
+  instead of each unpickling a private one.
+
+The flattened ensembles are evaluated with vectorized NumPy and give the
+same probabilities as predict_proba of the original estimators.
+"""
+import json
+import os
+import numpy as np
+from numpy.typing import NDArray
+from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
+from sklearn.preprocessing import LabelEncoder
+from typing import Dict, List, Tuple
+import src.core.audio_feature_extractor as extractor
+
+
+FORMAT_VERSION = 1
+METADATA_FILE = "metadata.json"
+XGBOOST_FILE = "model.ubj"
+
+# Node attributes of the flattened ensembles
+NODE_ARRAYS = ("feature", "threshold", "left", "right", "value")
+
+
+def profile_model_name(model_name: str, profile: str) -> str:
+    """
+    Get the name the training scripts save the model of a feature
+    profile under.
+    
+    Parameters:
+        model_name: Base name of the model, e.g. "xgb_model".
+        profile: Name of the feature profile.
+        
+    Returns:
+        The base name for the default profile, otherwise the base name
+            with the profile appended, e.g. "xgb_model_fast".
+    """
+    if profile == extractor.DEFAULT_PROFILE:
+        return model_name
+    return f"{model_name}_{profile}"
+
+
+def export_model(model, label_encoder: LabelEncoder,
+                 feature_columns: List[str], path: str):
+    """
+    Save a trained model as a serving artifact.
+
+    Parameters:
+        model: A fitted XGBClassifier, RandomForestClassifier or
+            GradientBoostingClassifier.
+        label_encoder: The encoder of the genre labels.
+        feature_columns: Names of the features in training order.
+        path: Directory to write the artifact to.
+
+    Raises:
+        TypeError: If the model type is not supported.
+    """
+    os.makedirs(path, exist_ok=True)
+    metadata = {
+        "format_version": FORMAT_VERSION,
+        "labels": [str(label) for label in label_encoder.classes_],
+        "feature_columns": list(feature_columns),
+    }
+
+    if hasattr(model, "get_booster"):
+        metadata["kind"] = "xgboost"
+        booster = model.get_booster()
+        # Early stopped models keep the trees after the best iteration,
+        # which the artifact leaves out
+        best_iteration = getattr(model, "best_iteration", None)
+        if best_iteration is not None:
+            booster = booster[:best_iteration + 1]
+        booster.save_model(os.path.join(path, XGBOOST_FILE))
+    elif isinstance(model, GradientBoostingClassifier):
+        # Gradient boosting: one regression tree per stage and class
+        metadata["kind"] = "gbm"
+        metadata["learning_rate"] = model.learning_rate
+        metadata["init_raw"] = model._raw_predict_init(
+            np.zeros((1, len(feature_columns)), dtype=np.float32))[0].tolist()
+        trees = [tree.tree_ for tree in model.estimators_.ravel()]
+        tree_class = np.tile(np.arange(model.estimators_.shape[1]), model.estimators_.shape[0])
+        np.save(os.path.join(path, "tree_class.npy"), tree_class.astype(np.int32))
+        _save_trees(trees, path, normalize=False)
+    elif isinstance(model, RandomForestClassifier):
+        metadata["kind"] = "forest"
+        _save_trees([tree.tree_ for tree in model.estimators_], path, normalize=True)
+    else:
+        raise TypeError(f"Cannot export a model of type {type(model).__name__}")
+
+    with open(os.path.join(path, METADATA_FILE), mode="w") as file:
+        json.dump(metadata, file, indent=2)
+
+
+def _save_trees(trees: List, path: str, normalize: bool):
+    # Concatenate the node arrays of all trees, child indices are made
+    # global and leaves get feature 0 so that they can be indexed safely
+    offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+    feature, threshold, left, right, value = [], [], [], [], []
+
+    for tree, offset in zip(trees, offsets):
+        is_leaf = tree.children_left == -1
+        feature.append(np.where(is_leaf, 0, tree.feature))
+        threshold.append(tree.threshold)
+        left.append(np.where(is_leaf, -1, tree.children_left + offset))
+        right.append(np.where(is_leaf, -1, tree.children_right + offset))
+
+        node_value = tree.value[:, 0, :]
+        if normalize:
+            total = node_value.sum(axis=1, keepdims=True)
+            node_value = node_value / np.where(total == 0, 1, total)
+        value.append(node_value)
+
+    arrays = {
+        "feature": np.concatenate(feature).astype(np.int32),
+        "threshold": np.concatenate(threshold).astype(np.float64),
+        "left": np.concatenate(left).astype(np.int32),
+        "right": np.concatenate(right).astype(np.int32),
+        "value": np.concatenate(value).astype(np.float64),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), array)
+    np.save(os.path.join(path, "roots.npy"), offsets[:-1].astype(np.int32))
+
+
+class FlatTreeEnsemble:
+    """
+    A Random Forest or Gradient Boosting Machine flattened into arrays.
+    """
+    def __init__(self, metadata: Dict, arrays: Dict[str, NDArray]):
+        self.kind = metadata["kind"]
+        self.feature_names_in_ = np.array(metadata["feature_columns"], dtype=object)
+        self.n_features_in_ = len(self.feature_names_in_)
+        self.classes_ = np.arange(len(metadata["labels"]))
+
+        self.feature = arrays["feature"]
+        self.threshold = arrays["threshold"]
+        self.left = arrays["left"]
+        self.right = arrays["right"]
+        self.value = arrays["value"]
+        self.roots = arrays["roots"]
+
+        if self.kind == "gbm":
+            self.tree_class = arrays["tree_class"]
+            self.learning_rate = metadata["learning_rate"]
+            self.init_raw = np.array(metadata["init_raw"])
+
+    def apply(self, X: NDArray[np.float32]) -> NDArray[np.int32]:
+        """
+        Find the leaf of every tree each sample falls into.
+
+        Parameters:
+            X: Feature matrix of shape (n_samples, n_features).
+
+        Returns:
+            Node indices of shape (n_samples, n_trees).
+        """
+        X = np.asarray(X, dtype=np.float32)
+        rows = np.arange(len(X))[:, np.newaxis]
+        nodes = np.broadcast_to(self.roots, (len(X), len(self.roots))).copy()
+
+        # All trees descend one level per iteration
+        while True:
+            left = self.left[nodes]
+            active = left != -1
+            if not active.any():
+                return nodes
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(active, np.where(go_left, left, self.right[nodes]), nodes)
+
+    def predict_proba(self, X: NDArray[np.float32]) -> NDArray[np.float64]:
+        leaves = self.apply(X)
+
+        if self.kind == "forest":
+            return self.value[leaves].mean(axis=1)
+
+        # Gradient boosting: scaled sum of the per-class tree outputs on
+        # top of the prior, followed by a softmax
+        raw = np.tile(self.init_raw, (len(leaves), 1))
+        contributions = self.learning_rate * self.value[leaves, 0]
+        for k in range(raw.shape[1]):
+            raw[:, k] += contributions[:, self.tree_class == k].sum(axis=1)
+        raw -= raw.max(axis=1, keepdims=True)
+        probabilities = np.exp(raw)
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+    def predict(self, X: NDArray[np.float32]) -> NDArray[np.int64]:
+        return np.argmax(self.predict_proba(X), axis=1)
+
+
+class XGBoostArtifactModel:
+    """
+    An XGBoost booster loaded from the native format.
+    """
+    def __init__(self, metadata: Dict, model_file: str):
+        import xgboost as xgb
+
+        self.booster = xgb.Booster(model_file=model_file)
+        self.feature_names_in_ = np.array(metadata["feature_columns"], dtype=object)
+        self.n_features_in_ = len(self.feature_names_in_)
+        self.classes_ = np.arange(len(metadata["labels"]))
+
+    def get_booster(self):
+        return self.booster
+
+    def predict_proba(self, X: NDArray[np.float32]) -> NDArray[np.float32]:
+        return self.booster.inplace_predict(np.asarray(X, dtype=np.float32))
+
+    def predict(self, X: NDArray[np.float32]) -> NDArray[np.int64]:
+        return np.argmax(self.predict_proba(X), axis=1)
+
+
+def load_model(path: str, mmap: bool = True) -> Tuple[object, LabelEncoder]:
+    """
+    Load a serving artifact.
+
+    Parameters:
+        path: Directory of the artifact.
+        mmap: Whether to memory-map the node arrays of flattened
+            ensembles instead of reading them into memory.
+
+    Returns:
+        A tuple with the model, which provides predict_proba, and a label
+            encoder of the genres.
+
+    Raises:
+        IOError: If the artifact cannot be read.
+    """
+    try:
+        with open(os.path.join(path, METADATA_FILE)) as file:
+            metadata = json.load(file)
+
+        if metadata["kind"] == "xgboost":
+            model = XGBoostArtifactModel(metadata, os.path.join(path, XGBOOST_FILE))
+        else:
+            names = NODE_ARRAYS + ("roots",)
+            if metadata["kind"] == "gbm":
+                names += ("tree_class",)
+            arrays = {name: np.load(os.path.join(path, f"{name}.npy"),
+                                    mmap_mode="r" if mmap else None)
+                      for name in names}
+            model = FlatTreeEnsemble(metadata, arrays)
+    except Exception as e:
+        raise IOError(f"Error loading model artifact {path}: {e}")
+
+    label_encoder = LabelEncoder()
+    label_encoder.classes_ = np.array(metadata["labels"])
+    return model, label_encoder
@@ -0,0 +1,391 @@
+"""
+This module contains a registry of the loaded genre models.
+
+The registry holds named models with weights and publishes them as an
+immutable EnsembleClassifier. Models are loaded before the lock is
+taken. Under the lock, which only serializes updates, a new ensemble is
+built from the loaded models and replaces the current one in a single
+assignment. Requests never take the lock, so requests that already took
+the previous ensemble finish with it while new requests get the new one.
+No request is dropped and nothing has to be restarted to roll out a
+model.
+
+An ensemble with several models extracts the features once, in the
+smallest feature profile that covers the columns of all its models,
+scores the models in parallel threads and returns the weighted average
+of their probabilities. An ensemble with a single model gives the same
+results as its MusicGenreClassifier.
+"""
+import os
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from numpy.typing import NDArray
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import src.core.audio_feature_extractor as extractor
+import src.core.genre_prediction as prediction
+import src.core.model_artifact as model_artifact
+import src.core.profiling as profiling
+from src.core.feature_cache import FeatureCache
+
+
+class EnsembleMember(NamedTuple):
+    name: str
+    classifier: prediction.MusicGenreClassifier
+    weight: float
+
+
+class EnsembleClassifier:
+    """
+    An immutable weighted ensemble of genre classifiers.
+
+    It provides the prediction methods of MusicGenreClassifier, so it can
+    be used wherever a single classifier is.
+    """
+    def __init__(self, members: List[EnsembleMember], version: int = 0,
+                 feature_cache: Optional[FeatureCache] = None,
+                 executor: Optional[ThreadPoolExecutor] = None):
+        """
+        Initialize the ensemble.
+
+        Parameters:
+            members: The models and their weights.
+            version: Number of the registry update that created the
+                ensemble.
+            feature_cache: Cache of extracted features.
+            executor: Thread pool the models are scored on in parallel,
+                they are scored one after another if None.
+
+        Raises:
+            ValueError: If there are no members, a weight is not positive
+                or the models predict different genres.
+        """
+        if not members:
+            raise ValueError("An ensemble needs at least one model")
+        if any(member.weight <= 0 for member in members):
+            raise ValueError("The weights of the models must be positive")
+
+        self.members = tuple(members)
+        self.version = version
+        self.feature_cache = feature_cache
+        self._executor = executor
+
+        # All models have to predict the same genres in the same order
+        self.label_encoder = members[0].classifier.label_encoder
+        for member in members[1:]:
+            if list(member.classifier.label_encoder.classes_) != list(self.label_encoder.classes_):
+                raise ValueError(f"Model '{member.name}' predicts different genres than "
+                                 f"model '{members[0].name}'")
+
+        self.profile = _covering_profile([member.classifier.feature_columns
+                                          for member in members])
+        self.feature_columns = extractor.profile_columns(self.profile)
+        self.sampling_rate = members[0].classifier.sampling_rate
+
+        weights = np.array([member.weight for member in members])
+        self._weights = weights / weights.sum()
+        self._column_indices = [
+            [self.feature_columns.index(name) for name in member.classifier.feature_columns]
+            for member in members]
+
+    def classify_genre(self, audio_data: NDArray[np.float32],
+                       segmented: bool = False,
+                       aggregation: str = "mean") -> str:
+        with profiling.stage("classify_genre"):
+            probabilities = self.predict_probabilities(audio_data, segmented, aggregation)
+            return max(probabilities, key=probabilities.get)
+
+    def predict_probabilities(self, audio_data: NDArray[np.float32],
+                              segmented: bool = False,
+                              aggregation: str = "mean") -> Dict[str, float]:
+        with profiling.stage("predict_probabilities"):
+            if segmented:
+                probabilities = prediction.aggregate_probabilities(
+                    self.predict_segment_probabilities(audio_data), aggregation)
+            else:
+                features = self._extract_features(audio_data)
+                probabilities = self.predict_feature_probabilities(
+                    extractor.features_to_matrix(features, self.feature_columns))[0]
+
+            return dict(zip(self.label_encoder.classes_, probabilities))
+
+    def predict_segment_probabilities(self,
+                                      audio_data: NDArray[np.float32]) -> NDArray[np.float64]:
+        features = self._extract_segment_features(audio_data)
+        return self.predict_feature_probabilities(
+            extractor.features_to_matrix(features, self.feature_columns))
+
+    def predict_feature_probabilities(self, features: NDArray[np.float32]) -> NDArray[np.float64]:
+        """
+        Get the weighted average of the genre probabilities of all models.
+
+        The scoring of all models is timed as one "model.predict_proba"
+        stage, like the scoring of a single classifier.
+
+        Parameters:
+            features: A matrix with one row of features per segment or
+                track and the columns in the order of feature_columns.
+
+        Returns:
+            An array of shape (n_rows, n_genres) with the columns in
+                the order of the label encoder classes.
+        """
+        def score(index: int) -> NDArray:
+            member = self.members[index]
+            matrix = features
+            if len(self._column_indices[index]) != features.shape[1]:
+                matrix = np.ascontiguousarray(features[:, self._column_indices[index]])
+            return member.classifier._predict_proba(matrix)
+
+        with profiling.stage("model.predict_proba"):
+            indices = range(len(self.members))
+            futures = None
+            if self._executor is not None and len(self.members) > 1:
+                try:
+                    futures = [self._executor.submit(score, index) for index in indices]
+                except RuntimeError:
+                    # The registry shut the pool down when a newer ensemble
+                    # replaced it, requests still holding this ensemble
+                    # score the models one after another
+                    futures = None
+            if futures is None:
+                probabilities = [score(index) for index in indices]
+            else:
+                probabilities = [future.result() for future in futures]
+
+            return np.tensordot(self._weights, np.stack(probabilities).astype(np.float64),
+                                axes=1)
+
+    def predict_batch_probabilities(self,
+                                    batch: List[Dict[str, NDArray]]) -> List[NDArray[np.float64]]:
+        matrices = [extractor.features_to_matrix(features, self.feature_columns)
+                    for features in batch]
+        probabilities = self.predict_feature_probabilities(np.concatenate(matrices))
+        boundaries = np.cumsum([len(matrix) for matrix in matrices])[:-1]
+
+        return np.split(probabilities, boundaries)
+
+    def _extract_features(self, audio_data: NDArray[np.float32]) -> Dict[str, float]:
+        if self.feature_cache is None:
+            return extractor.extract_features(audio_data, self.profile)
+        return self.feature_cache.extract_features(audio_data, self.sampling_rate,
+                                                   self.profile)
+
+    def _extract_segment_features(self, audio_data: NDArray[np.float32]) -> Dict[str, NDArray]:
+        if self.feature_cache is None:
+            return extractor.extract_segment_features(audio_data, profile=self.profile)
+        return self.feature_cache.extract_segment_features(audio_data,
+                                                           sampling_rate=self.sampling_rate,
+                                                           profile=self.profile)
+
+
+def _covering_profile(column_lists: List[List[str]]) -> str:
+    # The profile with the fewest columns that contains every column the
+    # models need, so that the features are extracted only once
+    needed = {name for columns in column_lists for name in columns}
+    candidates = [profile for profile in extractor.FEATURE_PROFILES
+                  if needed <= set(extractor.profile_columns(profile))]
+    return min(candidates, key=lambda profile: len(extractor.profile_columns(profile)))
+
+
+class ModelRegistry:
+    """
+    Named, weighted models published as an atomically swapped ensemble.
+    """
+    def __init__(self, feature_cache: Optional[FeatureCache] = None,
+                 max_workers: Optional[int] = None, compiled: bool = False):
+        """
+        Initialize an empty registry.
+
+        Parameters:
+            feature_cache: Cache of extracted features shared by all
+                ensembles.
+            max_workers: Number of threads the models of an ensemble are
+                scored on, one per model of the largest ensemble so far
+                if None.
+            compiled: Whether to compile the trees of loaded models, see
+                MusicGenreClassifier.
+        """
+        self.feature_cache = feature_cache
+        self.compiled = compiled
+        self._members: Dict[str, EnsembleMember] = {}
+        self._current: Optional[EnsembleClassifier] = None
+        self._version = 0
+        self._lock = threading.Lock()
+        self._max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_workers = 0
+
+    def current(self) -> EnsembleClassifier:
+        """
+        Get the current ensemble.
+
+        Callers should take the ensemble once per request and use it for
+        the whole request, so that a concurrent update cannot change the
+        models halfway through.
+
+        Returns:
+            The current ensemble.
+
+        Raises:
+            RuntimeError: If no model is loaded.
+        """
+        current = self._current
+        if current is None:
+            raise RuntimeError("No model is loaded")
+        return current
+
+    def load(self, name: str, model_path: str, encoder_path: Optional[str] = None,
+             weight: float = 1.0, profile: Optional[str] = None) -> EnsembleClassifier:
+        """
+        Load a model and add it to the ensemble, or replace the model of
+        the same name.
+
+        The model is loaded before the lock is taken, so predictions
+        continue with the previous ensemble while it loads.
+
+        Parameters:
+            name: Name of the model in the registry.
+            model_path: Path to a pickled model or a serving artifact.
+            encoder_path: Path to the label encoder, not needed for
+                artifacts.
+            weight: Weight of the model in the ensemble.
+            profile: Feature profile of the model, see
+                MusicGenreClassifier.
+
+        Returns:
+            The new current ensemble.
+
+        Raises:
+            IOError: If the model cannot be loaded.
+            ValueError: If the model does not fit the other models of
+                the ensemble.
+        """
+        classifier = prediction.MusicGenreClassifier(model_path, encoder_path, profile=profile,
+                                                     compiled=self.compiled)
+        return self._update(lambda members: members.update(
+            {name: EnsembleMember(name, classifier, weight)}))
+
+    def load_directory(self, directory: str, weights: Optional[Dict[str, float]] = None,
+                       profile: str = extractor.DEFAULT_PROFILE) -> EnsembleClassifier:
+        """
+        Load the models written by the training driver.
+
+        Serving artifacts are preferred over the pickles. Model families
+        that were not trained are skipped.
+
+        Parameters:
+            directory: Output directory of src.core.training.
+            weights: Weight of each model family ("rf", "gbm", "xgb"),
+                all families found get the same weight if None.
+            profile: Feature profile of the models to load.
+
+        Returns:
+            The new current ensemble.
+
+        Raises:
+            IOError: If none of the models exist.
+        """
+        # Imported here because the training module imports XGBoost and
+        # the training code
+        from src.core.training import MODEL_FAMILIES
+
+        classifiers = {}
+        for family, spec in MODEL_FAMILIES.items():
+            if weights is not None and family not in weights:
+                continue
+            base_path = os.path.join(directory,
+                                     model_artifact.profile_model_name(spec.model_name, profile))
+            if os.path.isdir(base_path):
+                classifiers[family] = prediction.MusicGenreClassifier(base_path, profile=profile,
+                                                                      compiled=self.compiled)
+            elif os.path.isfile(base_path + ".pkl"):
+                classifiers[family] = prediction.MusicGenreClassifier(
+                    base_path + ".pkl", os.path.join(directory, spec.encoder_name + ".pkl"),
+                    profile=profile, compiled=self.compiled)
+
+        if not classifiers:
+            raise IOError(f"No trained models found in {directory}")
+
+        def add(members: Dict[str, EnsembleMember]):
+            for family, classifier in classifiers.items():
+                weight = 1.0 if weights is None else weights[family]
+                members[family] = EnsembleMember(family, classifier, weight)
+        return self._update(add)
+
+    def remove(self, name: str) -> EnsembleClassifier:
+        """
+        Remove a model from the ensemble.
+
+        Raises:
+            KeyError: If there is no model of this name.
+            ValueError: If it is the last model.
+        """
+        return self._update(lambda members: members.pop(name))
+
+    def set_weights(self, weights: Dict[str, float]) -> EnsembleClassifier:
+        """
+        Change the weights of models in the ensemble.
+
+        Raises:
+            KeyError: If there is no model of one of the names.
+        """
+        def reweight(members: Dict[str, EnsembleMember]):
+            for name, weight in weights.items():
+                members[name] = members[name]._replace(weight=weight)
+        return self._update(reweight)
+
+    def models(self) -> Dict[str, Dict]:
+        """
+        Describe the models of the current ensemble.
+
+        Returns:
+            A dictionary mapping model names to their weight and feature
+                profile.
+        """
+        with self._lock:
+            return {name: {"weight": member.weight, "profile": member.classifier.profile}
+                    for name, member in self._members.items()}
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self._executor_workers = 0
+        if executor is not None:
+            executor.shutdown()
+
+    def _update(self, change) -> EnsembleClassifier:
+        # The new ensemble is validated before it replaces the current
+        # one, a failed update leaves the registry unchanged
+        with self._lock:
+            members = dict(self._members)
+            change(members)
+            previous = self._executor
+            executor, workers = self._scoring_executor(len(members))
+            try:
+                ensemble = EnsembleClassifier(list(members.values()), self._version + 1,
+                                              self.feature_cache, executor)
+            except Exception:
+                if executor is not previous:
+                    executor.shutdown(wait=False)
+                raise
+            self._members = members
+            self._executor, self._executor_workers = executor, workers
+            self._version += 1
+            self._current = ensemble
+
+        if previous is not None and previous is not executor:
+            # Scoring already submitted to the replaced pool still runs,
+            # then its threads exit
+            previous.shutdown(wait=False)
+        return ensemble
+
+    def _scoring_executor(self, n_members: int) -> Tuple[Optional[ThreadPoolExecutor], int]:
+        # Must be called with the lock held. A single thread scores the
+        # models one after another just as well, so there is no pool until
+        # two threads are needed. The pool is replaced by a larger one when
+        # an ensemble has more models than it has threads.
+        workers = self._max_workers or n_members
+        if workers > max(1, self._executor_workers):
+            return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ensemble"), workers
+        return self._executor, self._executor_workers
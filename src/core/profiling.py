@@ -0,0 +1,267 @@
+"""
+This module contains opt-in timing instrumentation of the prediction
+path.
+
+The loading, feature extraction and prediction functions wrap their
+stages in stage(name). While no sink is enabled stage() returns a shared
+no-op context manager, so the instrumentation costs a single list check.
+Once a sink is enabled every stage reports its wall time, the CPU time of
+the calling thread and, if requested, its peak traced memory (through
+tracemalloc, which slows Python allocations down noticeably and is
+therefore off by default).
+
+Sinks:
+- LogSink writes one log record per stage,
+- HistogramSink keeps per-stage histograms and recent samples in memory,
+- PrometheusSink additionally renders them in the Prometheus text format.
+
+Usage:
+    sink = profiling.HistogramSink()
+    profiling.enable(sink)
+    classifier.classify_genre(audio_data)
+    print(sink.summary())
+"""
+import bisect
+import contextlib
+import logging
+import threading
+import time
+import tracemalloc
+import numpy as np
+from collections import deque
+from typing import Dict, List, NamedTuple, Optional
+
+
+# Upper bounds of the histogram buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Number of most recent samples per stage used for percentiles
+SAMPLE_WINDOW = 1000
+
+
+class StageTiming(NamedTuple):
+    stage: str
+    wall_time: float
+    cpu_time: float
+    # Peak traced memory in bytes above the level at the start of the
+    # stage, None unless memory tracking is enabled
+    peak_memory: Optional[int]
+
+
+class LogSink:
+    """
+    Logs every stage timing.
+    """
+    def __init__(self, logger: Optional[logging.Logger] = None, level: int = logging.INFO):
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = level
+
+    def record(self, timing: StageTiming):
+        memory = "" if timing.peak_memory is None else f" peak={timing.peak_memory / 2**20:.1f}MiB"
+        self.logger.log(self.level, "%s: wall=%.4fs cpu=%.4fs%s",
+                        timing.stage, timing.wall_time, timing.cpu_time, memory)
+
+
+class HistogramSink:
+    """
+    Aggregates stage timings in memory.
+    """
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, timing: StageTiming):
+        with self._lock:
+            stage = self._stages.get(timing.stage)
+            if stage is None:
+                stage = {
+                    "count": 0,
+                    "wall_sum": 0.0,
+                    "cpu_sum": 0.0,
+                    "peak_memory": 0,
+                    "buckets": [0] * (len(self.buckets) + 1),
+                    "samples": deque(maxlen=SAMPLE_WINDOW),
+                }
+                self._stages[timing.stage] = stage
+
+            stage["count"] += 1
+            stage["wall_sum"] += timing.wall_time
+            stage["cpu_sum"] += timing.cpu_time
+            if timing.peak_memory is not None:
+                stage["peak_memory"] = max(stage["peak_memory"], timing.peak_memory)
+            stage["buckets"][bisect.bisect_left(self.buckets, timing.wall_time)] += 1
+            stage["samples"].append(timing.wall_time)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        Get statistics of every recorded stage.
+
+        Returns:
+            A dictionary mapping stage names to their count, total wall
+                and CPU time, wall time percentiles over the most recent
+                samples and the highest peak memory.
+        """
+        with self._lock:
+            summary = {}
+            for name, stage in self._stages.items():
+                p50, p90, p99 = np.percentile(stage["samples"], [50, 90, 99])
+                summary[name] = {
+                    "count": stage["count"],
+                    "wall_total": stage["wall_sum"],
+                    "cpu_total": stage["cpu_sum"],
+                    "wall_p50": float(p50),
+                    "wall_p90": float(p90),
+                    "wall_p99": float(p99),
+                    "peak_memory": stage["peak_memory"],
+                }
+            return summary
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+
+
+class PrometheusSink(HistogramSink):
+    """
+    Aggregates stage timings and renders them as Prometheus metrics.
+    """
+    def __init__(self, prefix: str = "genre_classifier", buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(buckets)
+        self.prefix = prefix
+
+    def exposition(self) -> str:
+        """
+        Render the metrics in the Prometheus text exposition format.
+
+        Returns:
+            A histogram of the wall time, a counter of the CPU time and a
+                gauge of the peak memory of every stage.
+        """
+        seconds = f"{self.prefix}_stage_seconds"
+        cpu = f"{self.prefix}_stage_cpu_seconds_total"
+        memory = f"{self.prefix}_stage_peak_memory_bytes"
+        lines = [
+            f"# HELP {seconds} Wall time of the prediction stages.",
+            f"# TYPE {seconds} histogram",
+        ]
+        with self._lock:
+            stages = sorted(self._stages.items())
+            for name, stage in stages:
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), stage["buckets"]):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{seconds}_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'{seconds}_sum{{stage="{name}"}} {stage["wall_sum"]}')
+                lines.append(f'{seconds}_count{{stage="{name}"}} {stage["count"]}')
+
+            lines += [f"# HELP {cpu} CPU time of the prediction stages.",
+                      f"# TYPE {cpu} counter"]
+            lines += [f'{cpu}{{stage="{name}"}} {stage["cpu_sum"]}' for name, stage in stages]
+
+            lines += [f"# HELP {memory} Highest peak traced memory of the prediction stages.",
+                      f"# TYPE {memory} gauge"]
+            lines += [f'{memory}{{stage="{name}"}} {stage["peak_memory"]}'
+                      for name, stage in stages]
+
+        return "\n".join(lines) + "\n"
+
+
+_sinks: List = []
+_track_memory = False
+_local = threading.local()
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def enable(sink, track_memory: bool = False):
+    """
+    Start reporting stage timings to a sink.
+
+    Parameters:
+        sink: An object with a record(timing) method, e.g. LogSink,
+            HistogramSink or PrometheusSink.
+        track_memory: Whether to measure the peak memory of the stages
+            with tracemalloc.
+    """
+    global _track_memory
+    _sinks.append(sink)
+    if track_memory:
+        _track_memory = True
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+def disable(sink=None):
+    """
+    Stop reporting to a sink, or to all sinks if None.
+    """
+    global _track_memory
+    if sink is None:
+        _sinks.clear()
+    else:
+        _sinks.remove(sink)
+    if not _sinks and _track_memory:
+        _track_memory = False
+        tracemalloc.stop()
+
+
+def stage(name: str):
+    """
+    Measure a stage of the prediction path.
+
+    Parameters:
+        name: Name of the stage, e.g. "features.hpss".
+
+    Returns:
+        A context manager timing the code it wraps.
+    """
+    if not _sinks:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+class _Stage:
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.peak_memory = None
+        self.track_memory = _track_memory
+        if self.track_memory:
+            # tracemalloc has a single peak for the whole process, keep
+            # the peak of enclosing stages of this thread on a stack
+            stack = _memory_stack()
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1] = max(stack[-1], peak)
+            stack.append(0)
+            tracemalloc.reset_peak()
+            self.start_memory = current
+
+        self.start_cpu = time.thread_time()
+        self.start_wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall_time = time.perf_counter() - self.start_wall
+        cpu_time = time.thread_time() - self.start_cpu
+
+        if self.track_memory:
+            stack = _memory_stack()
+            _, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, stack.pop())
+            self.peak_memory = peak - self.start_memory
+            if stack:
+                stack[-1] = max(stack[-1], peak)
+
+        timing = StageTiming(self.name, wall_time, cpu_time, self.peak_memory)
+        for sink in list(_sinks):
+            sink.record(timing)
+        return False
+
+
+def _memory_stack() -> List[int]:
+    if not hasattr(_local, "memory_stack"):
+        _local.memory_stack = []
+    return _local.memory_stack
@@ -0,0 +1,411 @@
+"""
+Local HTTP inference server around a ModelRegistry.
+
+The models are loaded once when the server starts and can be replaced
+or reweighted at runtime through /models without interrupting requests
+in flight. Decoding and feature extraction run in a pool of worker
+processes, while all predictions go through a single micro-batcher
+thread: requests arriving at the same time are coalesced into one call
+to the model, up to a maximum batch size or a maximum waiting time,
+whichever comes first.
+
+Endpoints:
+    POST /classify    Classify an audio file. The body is either JSON
+                      {"path": "..."} referring to a file on the server,
+                      or the raw bytes of an uploaded audio file (the
+                      'format' query parameter gives its extension).
+    GET  /metrics     Latency percentiles, queue depth and batch sizes.
+    GET  /models      The models of the ensemble and their weights.
+    POST /models      Load or replace a model, JSON {"name": "...",
+                      "path": "...", "encoder": "...", "weight": 1.0}
+                      (encoder and weight are optional), or reweight
+                      the models with JSON {"weights": {"name": 0.5}}.
+                      Loading unpickles the model, so only paths under
+                      the model root (--model-root, or the --ensemble
+                      directory) are accepted, relative paths are taken
+                      relative to it. Without a model root only
+                      reweighting is allowed.
+    GET  /health      Liveness check.
+
+Usage:
+    python -m src.core.server --port 8000
+    python -m src.core.server --ensemble models/
+    python -m src.core.server --model-root models/
+"""
+import argparse
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+import numpy as np
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from numpy.typing import NDArray
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+import src.core.audio_feature_extractor as extractor
+import src.core.genre_prediction as prediction
+from src.core.model_registry import EnsembleClassifier, ModelRegistry
+
+
+MODEL_PATH = r"models\xgb_model.pkl"
+ENCODER_PATH = r"models\xgb_encoder.pkl"
+
+MAX_BATCH_SIZE = 64
+MAX_WAIT_SECONDS = 0.01
+
+# Number of most recent requests the latency percentiles are computed over
+LATENCY_WINDOW = 10000
+
+
+def _extract_features(file_path: Optional[str] = None,
+                      data: Optional[bytes] = None,
+                      suffix: str = "",
+                      profile: str = extractor.DEFAULT_PROFILE) -> Dict[str, NDArray]:
+    # Runs in a worker process. Uploads are written to a temporary file
+    # because not every decoder can read from memory.
+    if data is None:
+        audio_data, _ = extractor.load_audio(file_path)
+        return extractor.extract_segment_features(audio_data, profile=profile)
+
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as file:
+        file.write(data)
+    try:
+        audio_data, _ = extractor.load_audio(file.name)
+        return extractor.extract_segment_features(audio_data, profile=profile)
+    finally:
+        os.remove(file.name)
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent prediction requests into batched model calls.
+    """
+    def __init__(self, max_batch_size: int = MAX_BATCH_SIZE,
+                 max_wait: float = MAX_WAIT_SECONDS):
+        """
+        Start the batching thread.
+
+        Parameters:
+            max_batch_size: Maximum number of requests per model call.
+            max_wait: Maximum time in seconds the first request of a
+                batch waits for others to join it.
+        """
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batch_sizes = deque(maxlen=LATENCY_WINDOW)
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, classifier: EnsembleClassifier, features: Dict[str, NDArray]) -> Future:
+        """
+        Queue the features of one file for prediction.
+
+        Parameters:
+            classifier: The ensemble the request started with. Requests
+                of different ensembles are scored separately, so a model
+                update does not affect requests already in the queue.
+            features: Features as returned by extract_segment_features.
+
+        Returns:
+            A future resolving to the segment probabilities of the file.
+        """
+        future = Future()
+        self._queue.put((classifier, features, future))
+        return future
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            self.batch_sizes.append(len(batch))
+            groups = {}
+            for request in batch:
+                groups.setdefault(id(request[0]), []).append(request)
+            for group in groups.values():
+                self._predict(group)
+
+    def _predict(self, batch: List):
+        classifier = batch[0][0]
+        try:
+            probabilities = classifier.predict_batch_probabilities(
+                [features for _, features, _ in batch])
+            for (_, _, future), file_probabilities in zip(batch, probabilities):
+                future.set_result(file_probabilities)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+
+
+class InferenceService:
+    """
+    Feature extraction pool, micro-batcher and request metrics.
+    """
+    def __init__(self, registry: ModelRegistry,
+                 workers: Optional[int] = None,
+                 max_batch_size: int = MAX_BATCH_SIZE,
+                 max_wait: float = MAX_WAIT_SECONDS,
+                 block_workers: Optional[int] = None):
+        self.registry = registry
+        # Each process runs the feature blocks of its request on
+        # block_workers threads, see extractor.set_block_workers
+        self.executor = ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                                            initializer=extractor.set_block_workers,
+                                            initargs=(block_workers,))
+        self.batcher = MicroBatcher(max_batch_size, max_wait)
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.requests = 0
+        self.errors = 0
+        self.extracting = 0
+        self._lock = threading.Lock()
+
+    def classify(self, file_path: Optional[str] = None, data: Optional[bytes] = None,
+                 suffix: str = "", aggregation: str = "mean") -> Dict:
+        """
+        Classify an audio file given by its path or its content.
+
+        Returns:
+            A dictionary with the predicted genre, the probability of
+                every genre and the number of classified segments.
+        """
+        start = time.perf_counter()
+        # The whole request uses the ensemble that is current now
+        classifier = self.registry.current()
+        with self._lock:
+            self.requests += 1
+            self.extracting += 1
+        try:
+            try:
+                features = self.executor.submit(_extract_features, file_path,
+                                                data, suffix,
+                                                classifier.profile).result()
+            finally:
+                with self._lock:
+                    self.extracting -= 1
+
+            segment_probabilities = self.batcher.submit(classifier, features).result()
+            probabilities = prediction.aggregate_probabilities(segment_probabilities,
+                                                               aggregation)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+
+        genres = classifier.label_encoder.classes_
+        with self._lock:
+            self.latencies.append(time.perf_counter() - start)
+
+        return {
+            "genre": str(genres[np.argmax(probabilities)]),
+            "probabilities": dict(zip(map(str, genres), map(float, probabilities))),
+            "segments": len(segment_probabilities),
+            "model_version": classifier.version,
+        }
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            latencies = np.array(self.latencies)
+            metrics = {
+                "requests": self.requests,
+                "errors": self.errors,
+                "extracting": self.extracting,
+            }
+        metrics["queue_depth"] = self.batcher.queue_depth()
+
+        if len(latencies):
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+            metrics["latency_seconds"] = {"p50": float(p50), "p90": float(p90), "p99": float(p99),
+                                          "max": float(latencies.max())}
+        batch_sizes = list(self.batcher.batch_sizes)
+        if batch_sizes:
+            metrics["mean_batch_size"] = float(np.mean(batch_sizes))
+
+        return metrics
+
+    def shutdown(self):
+        self.executor.shutdown()
+        self.registry.shutdown()
+
+
+def resolve_model_path(model_root: Optional[str], path: str) -> str:
+    """
+    Resolve a model path of a /models request.
+
+    Parameters:
+        model_root: Directory models may be loaded from, None if loading
+            models at runtime is disabled.
+        path: Path of the model or label encoder, absolute or relative
+            to the model root.
+
+    Returns:
+        The real path of the model.
+
+    Raises:
+        PermissionError: If loading is disabled or the path is outside of
+            the model root.
+    """
+    if model_root is None:
+        raise PermissionError("Loading models at runtime is disabled, "
+                              "start the server with --model-root")
+
+    # Symbolic links and '..' must not lead out of the root
+    root = os.path.realpath(model_root)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise PermissionError(f"Model path {path} is outside of the model root")
+    return resolved
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    service: InferenceService = None
+    # Directory POST /models may load models from, see resolve_model_path
+    model_root: Optional[str] = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/metrics":
+            self._send_json(200, self.service.metrics())
+        elif url.path == "/models":
+            self._send_json(200, self.service.registry.models())
+        elif url.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path == "/models":
+            self._update_models()
+            return
+        if url.path != "/classify":
+            self._send_json(404, {"error": "not found"})
+            return
+
+        query = parse_qs(url.query)
+        aggregation = query.get("aggregation", ["mean"])[0]
+        if aggregation not in prediction.AGGREGATIONS:
+            self._send_json(400, {"error": f"unknown aggregation '{aggregation}'"})
+            return
+
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        file_path, data, suffix = None, None, ""
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            try:
+                file_path = json.loads(body)["path"]
+            except (ValueError, KeyError, TypeError):
+                self._send_json(400, {"error": "expected a JSON object with a 'path'"})
+                return
+        else:
+            data = body
+            suffix = "." + query.get("format", ["wav"])[0].lstrip(".")
+
+        try:
+            result = self.service.classify(file_path, data, suffix, aggregation)
+        except Exception as e:
+            self._send_json(422, {"error": str(e)})
+            return
+        self._send_json(200, result)
+
+    def _update_models(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            request = json.loads(body)
+            registry = self.service.registry
+            if "weights" in request:
+                ensemble = registry.set_weights({name: float(weight) for name, weight
+                                                 in request["weights"].items()})
+            else:
+                model_path = resolve_model_path(self.model_root, request["path"])
+                encoder_path = request.get("encoder")
+                if encoder_path is not None:
+                    encoder_path = resolve_model_path(self.model_root, encoder_path)
+                ensemble = registry.load(request["name"], model_path, encoder_path,
+                                         float(request.get("weight", 1.0)))
+        except PermissionError as e:
+            self._send_json(403, {"error": str(e)})
+            return
+        except (ValueError, KeyError, TypeError, AttributeError, IOError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        self._send_json(200, {"model_version": ensemble.version,
+                              "models": self.service.registry.models()})
+
+    def log_message(self, format, *args):
+        # Keep the console quiet, metrics are available at /metrics
+        pass
+
+    def _send_json(self, status: int, payload: Dict):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Serve genre predictions over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--model", default=MODEL_PATH, help="path to the trained model")
+    parser.add_argument("--encoder", default=ENCODER_PATH, help="path to the label encoder")
+    parser.add_argument("--ensemble", default=None, metavar="DIRECTORY",
+                        help="serve an ensemble of the models in the output directory "
+                             "of src.core.training instead of --model")
+    parser.add_argument("--model-root", default=None, metavar="DIRECTORY",
+                        help="directory POST /models may load models from (default: the "
+                             "--ensemble directory, loading is disabled without either)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of feature extraction processes (default: all cores)")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE,
+                        help="maximum number of requests per model call")
+    parser.add_argument("--max-wait", type=float, default=MAX_WAIT_SECONDS,
+                        help="maximum time in seconds a request waits for a batch to fill")
+    parser.add_argument("--block-workers", type=int, default=None,
+                        help="number of threads the feature blocks of one request run on "
+                             "(default: one after another)")
+    parser.add_argument("--compiled", action="store_true",
+                        help="evaluate the trees with the compiled inference engine")
+    args = parser.parse_args(argv)
+
+    registry = ModelRegistry(compiled=args.compiled)
+    if args.ensemble is not None:
+        registry.load_directory(args.ensemble)
+    else:
+        registry.load("default", args.model, args.encoder)
+    service = InferenceService(registry, args.workers, args.max_batch_size, args.max_wait,
+                               args.block_workers)
+    InferenceRequestHandler.service = service
+    InferenceRequestHandler.model_root = args.model_root or args.ensemble
+
+    server = ThreadingHTTPServer((args.host, args.port), InferenceRequestHandler)
+    server.daemon_threads = True
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+if __name__ == "__main__":
+    main()
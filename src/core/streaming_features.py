@@ -0,0 +1,279 @@
+"""
+This module contains a streaming version of the feature extraction for
+long audio files (DJ mixes, live recordings).
+
+The file is decoded and resampled block by block and the features are
+computed on overlapping chunks of the resampled signal. Every chunk is
+extended by a margin of context on both sides, and only the frames and
+samples of its core are accumulated into running mean/variance
+statistics. Peak memory therefore depends on the block size and not on
+the length of the track.
+
+The statistics of every chunk are computed by the feature blocks of
+extract_features, restricted to the frames and samples of the core, and
+merged into the running statistics of the track. Apart from floating
+point rounding the result equals the one of extract_features on the
+whole track, with two exceptions:
+- the tuning used by the chroma features is estimated per chunk,
+- the 80 dB floor of the log-mel spectrogram (used by the MFCCs and the
+  tempo) is relative to the loudest frame of each chunk.
+Both only matter for tracks whose tuning or loudness changes a lot.
+
+The onset envelope needed for the tempo estimate is kept for the whole
+track. It holds one value per hop, i.e. 1/512 of the decoded signal.
+"""
+import numpy as np
+import soundfile as sf
+import soxr
+from numpy.typing import NDArray
+from typing import Dict, Iterator, List, Tuple, Union
+import src.core.audio_feature_extractor as extractor
+from src.core.audio_feature_extractor import SAMPLING_RATE, HOP_LENGTH
+
+
+# Length of the core of each chunk
+BLOCK_SECONDS = 30.0
+
+# Context added on both sides of a chunk. Harmonic/percussive separation
+# looks 15 frames ahead and behind, plus the frames overlapping a sample.
+MARGIN_FRAMES = 24
+
+# Resamplers of load_audio that can resample block by block, with their
+# soxr quality. The polyphase filters of the other ones need the whole
+# signal.
+STREAMING_RESAMPLERS = {"soxr_hq": "HQ", "soxr_qq": "QQ"}
+
+
+class RunningMoments:
+    """
+    Mean and variance of a stream of values, updated batch by batch from
+    the mean and variance of each batch.
+
+    Batches are merged with the parallel algorithm of Chan et al., which
+    is numerically stable for long streams.
+    """
+    def __init__(self, shape: Union[int, Tuple[int, ...]] = ()):
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def merge(self, n: int, mean: NDArray, var: NDArray):
+        """
+        Add the mean and variance of a batch of values.
+
+        Parameters:
+            n: Number of values in the batch.
+            mean: Mean of the batch.
+            var: Variance of the batch.
+        """
+        if n == 0:
+            return
+
+        total = self.count + n
+        delta = np.asarray(mean, dtype=np.float64) - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = (self.m2 + np.asarray(var, dtype=np.float64) * n
+                   + delta ** 2 * self.count * n / total)
+        self.count = total
+
+    @property
+    def var(self) -> NDArray[np.float64]:
+        return self.m2 / self.count
+
+
+class StreamingFeatureAccumulator:
+    """
+    Accumulates the statistics of extract_features chunk by chunk.
+    """
+    def __init__(self, sampling_rate: int = SAMPLING_RATE,
+                 profile: str = extractor.DEFAULT_PROFILE):
+        """
+        Initialize the accumulator.
+
+        Parameters:
+            sampling_rate: Sampling rate of the audio data.
+            profile: Name of the feature profile to extract.
+
+        Raises:
+            ValueError: If the profile does not exist.
+        """
+        self.sampling_rate = sampling_rate
+        self.columns = extractor.profile_columns(profile)
+        blocks = extractor.FEATURE_PROFILES[profile]
+
+        # The tempo is estimated once from the onset envelope of the whole
+        # track, every other block is a set of means and variances
+        self.blocks = [(name, block) for name, block in extractor.FEATURE_BLOCKS
+                       if name in blocks and name != "tempo"]
+        self.moments = {name[:-len("_mean")]: RunningMoments()
+                        for name in self.columns if name.endswith("_mean")}
+        self.onset_envelope: List[NDArray[np.float32]] = [] if "tempo" in blocks else None
+
+    def add(self, chunk: NDArray[np.float32], chunk_start: int,
+            core_start: int, core_end: int, last: bool = False):
+        """
+        Add the features of the core of a chunk.
+
+        Parameters:
+            chunk: Resampled audio starting at sample chunk_start of the
+                track. It must extend MARGIN_FRAMES hops beyond the core
+                on both sides unless it reaches the track boundary.
+            chunk_start: Position of the chunk in the track, a multiple
+                of HOP_LENGTH.
+            core_start: Start of the core in the track, a multiple of
+                HOP_LENGTH.
+            core_end: End of the core in the track, a multiple of
+                HOP_LENGTH unless this is the last chunk.
+            last: Whether the chunk ends at the end of the track.
+        """
+        # The frames centered in the core and, for the last chunk, the
+        # final frame centered on the end of the track
+        first_frame = (core_start - chunk_start) // HOP_LENGTH
+        frames = slice(first_frame, None if last else (core_end - chunk_start) // HOP_LENGTH)
+        samples = slice(core_start - chunk_start, core_end - chunk_start)
+        context = extractor.SpectralContext(chunk, self.sampling_rate, frames, samples)
+
+        n_frames = len(range(context.stft.shape[-1])[frames])
+        n_samples = len(range(len(chunk))[samples])
+        for name, block in self.blocks:
+            statistics = block(context)
+            # The harmonic and percussive signals are summarized over
+            # samples, all other blocks over frames
+            n = n_samples if name == "hpss" else n_frames
+            for column in extractor.BLOCK_COLUMNS[name]:
+                if column.endswith("_mean"):
+                    feature = column[:-len("_mean")]
+                    self.moments[feature].merge(n, statistics[column],
+                                                statistics[f"{feature}_var"])
+
+        if self.onset_envelope is not None:
+            self.onset_envelope.append(extractor.onset_envelope(context))
+
+    def features(self) -> Dict[str, float]:
+        """
+        Get the accumulated features.
+
+        Returns:
+            A dictionary of features in the format of extract_features.
+        """
+        features = {}
+        for name, moments in self.moments.items():
+            features[f"{name}_mean"] = moments.mean[()]
+            features[f"{name}_var"] = moments.var[()]
+
+        if self.onset_envelope is not None:
+            features["tempo"] = extractor.estimate_tempo(np.concatenate(self.onset_envelope),
+                                                         self.sampling_rate)[()]
+
+        # Same order as the training columns
+        return {name: features[name] for name in self.columns}
+
+
+def stream_audio(file_path: str, block_seconds: float = BLOCK_SECONDS,
+                 resampler: str = extractor.DEFAULT_RESAMPLER
+                 ) -> Iterator[NDArray[np.float32]]:
+    """
+    Decode an audio file block by block, resampled to SAMPLING_RATE mono.
+
+    Files that soundfile cannot read are decoded with load_audio in one
+    piece and then split into blocks.
+
+    Parameters:
+        file_path: The path to the audio file.
+        block_seconds: Duration of the decoded blocks.
+        resampler: The resampling backend, one of STREAMING_RESAMPLERS.
+
+    Returns:
+        An iterator of consecutive blocks of the resampled signal.
+
+    Raises:
+        ValueError: If the resampler cannot resample block by block.
+        IOError: If the file cannot be loaded.
+    """
+    if resampler not in STREAMING_RESAMPLERS:
+        raise ValueError(f"Unknown streaming resampler '{resampler}', "
+                         f"expected one of {list(STREAMING_RESAMPLERS)}")
+
+    try:
+        info = sf.info(file_path)
+    except Exception:
+        audio_data, _ = extractor.load_audio(file_path, resampler)
+        block_length = int(block_seconds * SAMPLING_RATE)
+        for start in range(0, len(audio_data), block_length):
+            yield audio_data[start:start + block_length]
+        return
+
+    stream = None
+    if info.samplerate != SAMPLING_RATE:
+        stream = soxr.ResampleStream(info.samplerate, SAMPLING_RATE, 1, dtype="float32",
+                                     quality=STREAMING_RESAMPLERS[resampler])
+
+    try:
+        block_size = int(block_seconds * info.samplerate)
+        for block in sf.blocks(file_path, blocksize=block_size, dtype="float32",
+                               always_2d=True):
+            mono = block.mean(axis=1, dtype=np.float32)
+            if stream is not None:
+                mono = stream.resample_chunk(mono)
+            yield mono
+
+        if stream is not None:
+            yield stream.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+    except Exception as e:
+        raise IOError(f"Error loading {file_path}: {e}")
+
+
+def extract_features_streaming(file_path: str,
+                               block_seconds: float = BLOCK_SECONDS,
+                               profile: str = extractor.DEFAULT_PROFILE,
+                               resampler: str = extractor.DEFAULT_RESAMPLER
+                               ) -> Dict[str, float]:
+    """
+    Extract the features of an audio file without decoding it in full.
+
+    Parameters:
+        file_path: The path to the audio file.
+        block_seconds: Duration of the blocks the file is processed in.
+        profile: Name of the feature profile to extract.
+        resampler: The resampling backend, one of STREAMING_RESAMPLERS.
+
+    Returns:
+        A dictionary of extracted features, see extract_features.
+
+    Raises:
+        ValueError: If the profile does not exist or the resampler cannot
+            resample block by block.
+        IOError: If the file cannot be loaded or contains no audio.
+    """
+    core_length = max(int(block_seconds * SAMPLING_RATE) // HOP_LENGTH, 1) * HOP_LENGTH
+    margin = MARGIN_FRAMES * HOP_LENGTH
+    accumulator = StreamingFeatureAccumulator(profile=profile)
+
+    # Samples from buffer_start on that are still needed as core or context
+    buffer = np.zeros(0, dtype=np.float32)
+    buffer_start = 0
+    core_start = 0
+
+    for block in stream_audio(file_path, block_seconds, resampler):
+        buffer = np.concatenate([buffer, block])
+
+        while buffer_start + len(buffer) >= core_start + core_length + margin:
+            core_end = core_start + core_length
+            chunk_start = max(core_start - margin, 0)
+            chunk = buffer[chunk_start - buffer_start:core_end + margin - buffer_start]
+            accumulator.add(chunk, chunk_start, core_start, core_end)
+
+            core_start = core_end
+            if core_start - margin > buffer_start:
+                buffer = buffer[core_start - margin - buffer_start:]
+                buffer_start = core_start - margin
+
+    track_length = buffer_start + len(buffer)
+    if track_length == 0:
+        raise IOError(f"Error loading {file_path}: no audio data")
+
+    chunk_start = max(core_start - margin, 0)
+    accumulator.add(buffer[chunk_start - buffer_start:], chunk_start,
+                    core_start, track_length, last=True)
+
+    return accumulator.features()
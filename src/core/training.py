@@ -0,0 +1,330 @@
+"""
+Training of the genre classification models.
+
+The feature table is loaded once into a contiguous float32 matrix, split
+into training and test sets and encoded with a single label encoder that
+is shared by all model families and feature profiles trained in one run.
+Each family can either be trained with the parameters of the original
+training scripts or with the best parameters of a cross-validated random
+search, whose candidates are fitted in parallel.
+
+With --early-stopping, XGBoost and Gradient Boosting stop adding trees
+once their loss on a validation set held out from the training data
+stops improving, so their number of trees is an upper bound. XGBoost
+monitors the multiclass log loss (mlogloss) of an explicit validation
+set, Gradient Boosting the loss of its internal validation_fraction with
+n_iter_no_change.
+
+The total number of threads and processes is capped by --n-jobs, which
+is split between the parallel search candidates and the threads of each
+model.
+
+Usage:
+    python -m src.core.training rf gbm xgb
+    python -m src.core.training xgb --search 20 --n-jobs 16
+    python -m src.core.training xgb gbm --early-stopping
+"""
+import argparse
+import joblib
+import os
+import sys
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from numpy.typing import NDArray
+from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
+from sklearn.metrics import accuracy_score, classification_report
+from sklearn.model_selection import RandomizedSearchCV, StratifiedKFold, train_test_split
+from sklearn.preprocessing import LabelEncoder
+from typing import Dict, List, NamedTuple, Optional
+import src.core.audio_feature_extractor as extractor
+from src.core.dataset_builder import TABLE_PATH, load_feature_table
+from src.core.model_artifact import export_model, profile_model_name
+
+
+SEED = 14
+TEST_RATIO = 0.2
+CSV_PATH = r"data\features_3_sec.csv"
+
+# Share of the training data held out for early stopping
+VALIDATION_RATIO = 0.1
+EARLY_STOPPING_ROUNDS = 20
+
+CV_FOLDS = 3
+
+
+class ModelFamily(NamedTuple):
+    display_name: str
+    model_name: str
+    encoder_name: str
+    # Parameters of the original training scripts
+    parameters: Dict
+    # Candidate values of the parameters tuned by the search
+    search_space: Dict[str, List]
+
+
+MODEL_FAMILIES = {
+    "rf": ModelFamily(
+        "Random Forest", "rf_model", "rf_encoder",
+        {"n_estimators": 500, "max_depth": 20},
+        {"n_estimators": [200, 500, 800],
+         "max_depth": [10, 20, 30, None],
+         "max_features": ["sqrt", "log2", 0.5],
+         "min_samples_leaf": [1, 2, 4]}),
+    "gbm": ModelFamily(
+        "Gradient Boosting", "gb_model", "gb_encoder",
+        {"n_estimators": 100, "learning_rate": 0.1, "max_depth": 3},
+        {"n_estimators": [100, 300, 500],
+         "learning_rate": [0.05, 0.1, 0.2],
+         "max_depth": [3, 4, 5],
+         "subsample": [0.8, 1.0]}),
+    "xgb": ModelFamily(
+        "XGBoost", "xgb_model", "xgb_encoder",
+        {"n_estimators": 1000, "learning_rate": 0.1, "max_depth": 5},
+        {"learning_rate": [0.05, 0.1, 0.2],
+         "max_depth": [3, 5, 7],
+         "subsample": [0.8, 1.0],
+         "colsample_bytree": [0.6, 0.8, 1.0],
+         "min_child_weight": [1, 5]}),
+}
+
+
+class TrainingData(NamedTuple):
+    X_train: NDArray[np.float32]
+    X_test: NDArray[np.float32]
+    y_train: NDArray[np.int64]
+    y_test: NDArray[np.int64]
+    label_encoder: LabelEncoder
+    columns: List[str]
+
+
+def load_training_data(path: Optional[str] = None) -> TrainingData:
+    """
+    Load the feature table and split it into training and test sets.
+
+    Parameters:
+        path: Directory of a table written by src.core.dataset_builder or
+            path to a CSV file with the layout of features_3_sec.csv. The
+            built table is used if it exists, otherwise the CSV file.
+
+    Returns:
+        The float32 feature matrices and encoded labels of both sets, the
+            label encoder and the names of the feature columns.
+    """
+    if path is None:
+        path = TABLE_PATH if os.path.isdir(TABLE_PATH) else CSV_PATH
+
+    if os.path.isdir(path):
+        features, labels, schema = load_feature_table(path)
+        X = np.ascontiguousarray(features, dtype=np.float32)
+        # The labels of the table are indices into its sorted labels,
+        # which is the encoding a fitted LabelEncoder would produce
+        label_encoder = LabelEncoder()
+        label_encoder.classes_ = np.array(schema["labels"])
+        y_encoded = np.asarray(labels, dtype=np.int64)
+        columns = schema["columns"]
+    else:
+        data = pd.read_csv(path)
+        # 'filename' and 'length' are not needed for classification
+        columns = [name for name in data.columns if name not in ("filename", "length", "label")]
+        X = np.ascontiguousarray(data[columns].to_numpy(dtype=np.float32))
+        label_encoder = LabelEncoder()
+        y_encoded = label_encoder.fit_transform(data["label"])
+
+    X_train, X_test, y_train, y_test = train_test_split(X, y_encoded, test_size=TEST_RATIO,
+                                                        random_state=SEED)
+    return TrainingData(X_train, X_test, y_train, y_test, label_encoder, list(columns))
+
+
+def create_model(family: str, parameters: Dict, n_jobs: int = 1,
+                 early_stopping: bool = False):
+    """
+    Create an unfitted model of a family.
+
+    Parameters:
+        family: One of MODEL_FAMILIES.
+        parameters: Parameters of the model.
+        n_jobs: Number of threads of the model. Gradient Boosting is
+            always single-threaded.
+        early_stopping: Whether XGBoost and Gradient Boosting stop adding
+            trees when the validation loss stops improving.
+
+    Returns:
+        The model.
+
+    Raises:
+        ValueError: If the family is unknown.
+    """
+    if family == "rf":
+        return RandomForestClassifier(random_state=SEED, n_jobs=n_jobs, **parameters)
+    if family == "gbm":
+        if early_stopping:
+            # Gradient Boosting holds out its validation set internally
+            parameters = dict(parameters, n_iter_no_change=EARLY_STOPPING_ROUNDS,
+                              validation_fraction=VALIDATION_RATIO)
+        return GradientBoostingClassifier(random_state=SEED, **parameters)
+    if family == "xgb":
+        if early_stopping:
+            parameters = dict(parameters, early_stopping_rounds=EARLY_STOPPING_ROUNDS,
+                              eval_metric="mlogloss")
+        return xgb.XGBClassifier(random_state=SEED, n_jobs=n_jobs, **parameters)
+
+    raise ValueError(f"Unknown model family '{family}', "
+                     f"expected one of {tuple(MODEL_FAMILIES)}")
+
+
+def search_parameters(family: str, X: pd.DataFrame, y: NDArray[np.int64],
+                      candidates: int, n_jobs: int, early_stopping: bool = False,
+                      fit_params: Optional[Dict] = None) -> Dict:
+    """
+    Find the best parameters of a family with a cross-validated random
+    search over its search space.
+
+    Parameters:
+        family: One of MODEL_FAMILIES.
+        X: Training features.
+        y: Encoded training labels.
+        candidates: Number of parameter combinations tried.
+        n_jobs: Total number of threads and processes to use.
+        early_stopping: Whether XGBoost and Gradient Boosting stop early.
+        fit_params: Additional arguments of the fit calls.
+
+    Returns:
+        The default parameters of the family updated with the best found.
+    """
+    spec = MODEL_FAMILIES[family]
+
+    # Candidates and folds are fitted in parallel processes, the rest of
+    # the budget goes to the threads of each model
+    search_jobs = max(1, min(n_jobs, candidates * CV_FOLDS))
+    model_jobs = max(1, n_jobs // search_jobs)
+
+    search = RandomizedSearchCV(
+        create_model(family, spec.parameters, model_jobs, early_stopping),
+        spec.search_space, n_iter=candidates,
+        cv=StratifiedKFold(CV_FOLDS, shuffle=True, random_state=SEED),
+        n_jobs=search_jobs, refit=False, random_state=SEED)
+    search.fit(X, y, **(fit_params or {}))
+
+    print(f"{spec.display_name} best cross-validated accuracy: {search.best_score_:.4f} "
+          f"with {search.best_params_}")
+    return dict(spec.parameters, **search.best_params_)
+
+
+def train_family(family: str, data: TrainingData,
+                 profiles: Optional[List[str]] = None,
+                 n_jobs: Optional[int] = None,
+                 search_candidates: int = 0,
+                 early_stopping: bool = False,
+                 output_dir: str = "."):
+    """
+    Train, save and evaluate the models of a family, one per feature
+    profile.
+
+    Every model is saved as a pickle and exported as a serving artifact
+    under the names the original training scripts used, along with the
+    label encoder.
+
+    Parameters:
+        family: One of MODEL_FAMILIES.
+        data: The training and test data.
+        profiles: Feature profiles to train models for, all if None.
+        n_jobs: Total number of threads and processes to use, all
+            available cores if None.
+        search_candidates: Number of parameter combinations tried by the
+            search, the parameters of the original scripts are used if 0.
+        early_stopping: Whether XGBoost and Gradient Boosting stop early.
+        output_dir: Directory to write the models to.
+    """
+    spec = MODEL_FAMILIES[family]
+    n_jobs = n_jobs or os.cpu_count()
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Save the label encoder, it is shared by the models of all
+    # feature profiles
+    joblib.dump(data.label_encoder, os.path.join(output_dir, spec.encoder_name + ".pkl"))
+
+    X_train, y_train = data.X_train, data.y_train
+    X_validation = y_validation = None
+    if family == "xgb" and early_stopping:
+        # XGBoost needs an explicit validation set for early stopping
+        X_train, X_validation, y_train, y_validation = train_test_split(
+            X_train, y_train, test_size=VALIDATION_RATIO, random_state=SEED)
+
+    for profile in profiles or list(extractor.FEATURE_PROFILES):
+        columns = extractor.profile_columns(profile)
+        indices = [data.columns.index(name) for name in columns]
+        profile_model = profile_model_name(spec.model_name, profile)
+
+        # The models are fitted on DataFrames so that they remember the
+        # feature names, which is how the classifier finds their profile
+        X_profile = _frame(X_train, indices, columns)
+        fit_params = {}
+        if X_validation is not None:
+            fit_params = {"eval_set": [(_frame(X_validation, indices, columns), y_validation)],
+                          "verbose": False}
+
+        parameters = spec.parameters
+        if search_candidates > 0:
+            parameters = search_parameters(family, X_profile, y_train, search_candidates,
+                                           n_jobs, early_stopping, fit_params)
+
+        model = create_model(family, parameters, n_jobs, early_stopping)
+        model.fit(X_profile, y_train, **fit_params)
+
+        # Save the model
+        model_path = os.path.join(output_dir, profile_model)
+        joblib.dump(model, model_path + ".pkl")
+
+        # Export a compact serving artifact with the labels and the feature
+        # order embedded, which can be memory-mapped when loaded
+        export_model(model, data.label_encoder, columns, model_path)
+
+        # Test and evaluate the model
+        y_pred = model.predict(_frame(data.X_test, indices, columns))
+
+        accuracy = accuracy_score(data.y_test, y_pred)
+        report = classification_report(data.y_test, y_pred,
+                                       target_names=data.label_encoder.classes_)
+
+        print(f"{spec.display_name} ({profile} features) Accuracy: {accuracy:.4f}")
+        print(f"{spec.display_name} ({profile} features) Classification Report:\n{report}")
+
+
+def _frame(X: NDArray[np.float32], indices: List[int], columns: List[str]) -> pd.DataFrame:
+    if indices != list(range(X.shape[1])):
+        X = np.ascontiguousarray(X[:, indices])
+    return pd.DataFrame(X, columns=columns, copy=False)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Train the genre classification models.")
+    parser.add_argument("families", nargs="+", choices=list(MODEL_FAMILIES),
+                        help="model families to train")
+    parser.add_argument("--data", default=None,
+                        help="feature table directory or CSV file (default: the built "
+                             "table if it exists, otherwise the CSV file)")
+    parser.add_argument("--profiles", nargs="+", choices=list(extractor.FEATURE_PROFILES),
+                        default=None, help="feature profiles to train (default: all)")
+    parser.add_argument("--search", type=int, default=0, metavar="CANDIDATES",
+                        help="number of parameter combinations of a cross-validated "
+                             "search (default: no search)")
+    parser.add_argument("--n-jobs", type=int, default=None,
+                        help="cap on the total number of threads and processes "
+                             "(default: all cores)")
+    parser.add_argument("--early-stopping", action="store_true",
+                        help="stop adding trees to XGBoost and Gradient Boosting once "
+                             "the validation loss stops improving")
+    parser.add_argument("-o", "--output-dir", default=".",
+                        help="directory to write the models to")
+    args = parser.parse_args(argv)
+
+    data = load_training_data(args.data)
+    for family in args.families:
+        train_family(family, data, args.profiles, args.n_jobs, args.search,
+                     args.early_stopping, args.output_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
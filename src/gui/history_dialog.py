@@ -1,70 +1,90 @@
-import sys
-from PyQt5.QtWidgets import (QApplication, QMainWindow, QAction, QFileDialog, 
-                             QLabel, QPushButton, QLineEdit, QVBoxLayout, QWidget, 
-                             QStatusBar, QDialog, QTableWidget, QTableWidgetItem, 
-                             QHeaderView, QMessageBox)
+from datetime import datetime, time, timedelta
+from PyQt5.QtWidgets import (QDialog, QPushButton, QVBoxLayout, QHBoxLayout, QTableView,
+                             QHeaderView, QComboBox, QCheckBox, QDateEdit, QLabel)
+from PyQt5.QtCore import QDate
+from src.core.history_store import HistoryStore
+from src.gui.history_model import HistoryTableModel
 
-from PyQt5.QtMultimedia import QMediaPlayer, QMediaContent
-from PyQt5.QtCore import QUrl
-import joblib
-import librosa
-import pandas as pd
-from typing import Dict
-from datetime import datetime
+
+ALL_GENRES = "All genres"
 
 
 class HistoryDialog(QDialog):
-    def __init__(self, history_file, parent=None):
+    def __init__(self, historyStore: HistoryStore, parent=None):
         super().__init__(parent)
-        self.history_file = history_file
-        
+        self.historyStore = historyStore
+
         self.setWindowTitle("Prediction History")
-        self.setGeometry(200, 200, 600, 400)
-        
+        self.setGeometry(200, 200, 700, 400)
+
+        self.createFilters()
         self.createTable()
         self.createButtons()
         self.setUpLayout()
-        
+
+    def createFilters(self):
+        self.genreFilter = QComboBox()
+        self.genreFilter.addItem(ALL_GENRES)
+        self.genreFilter.addItems(self.historyStore.genres())
+        self.genreFilter.currentIndexChanged.connect(self.applyFilter)
+
+        self.dateFilter = QCheckBox("From")
+        self.dateFilter.toggled.connect(self.applyFilter)
+        self.sinceEdit = QDateEdit(QDate.currentDate().addMonths(-1))
+        self.untilEdit = QDateEdit(QDate.currentDate())
+        for dateEdit in (self.sinceEdit, self.untilEdit):
+            dateEdit.setCalendarPopup(True)
+            dateEdit.dateChanged.connect(self.applyFilter)
+
     def createTable(self):
-        self.table = QTableWidget()
-        self.table.setRowCount(0)
-        self.table.setColumnCount(3)
-        self.table.setHorizontalHeaderLabels(["File Name",
-                                              "Predicted Genre",
-                                              "Date/Time"])
+        # The model reads the history page by page while it is scrolled
+        self.model = HistoryTableModel(self.historyStore, self)
+        self.table = QTableView()
+        self.table.setModel(self.model)
         self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
-        
-        # Load the history of predictions from persistent storage (CSV file)
-        self.loadHistory()
-        
+
     def createButtons(self):
         self.deleteButton = QPushButton("Delete History")
         self.deleteButton.clicked.connect(self.deleteHistory)
-        
+
         self.closeButton = QPushButton("Close")
         self.closeButton.clicked.connect(self.close)
-        
+
     def setUpLayout(self):
+        filterLayout = QHBoxLayout()
+        filterLayout.addWidget(QLabel("Genre:"))
+        filterLayout.addWidget(self.genreFilter)
+        filterLayout.addWidget(self.dateFilter)
+        filterLayout.addWidget(self.sinceEdit)
+        filterLayout.addWidget(QLabel("to"))
+        filterLayout.addWidget(self.untilEdit)
+        filterLayout.addStretch()
+
         layout = QVBoxLayout()
+        layout.addLayout(filterLayout)
         layout.addWidget(self.table)
         layout.addWidget(self.deleteButton)
         layout.addWidget(self.closeButton)
         self.setLayout(layout)
-    
-    def loadHistory(self):
-        try:
-            with open(self.history_file, mode="r") as file:
-                for line in file:
-                    file_name, predicted_genre, date_time = line.strip().split(",")
-                    row_position = self.table.rowCount()
-                    self.table.insertRow(row_position)
-                    self.table.setItem(row_position, 0, QTableWidgetItem(file_name))
-                    self.table.setItem(row_position, 1, QTableWidgetItem(predicted_genre))
-                    self.table.setItem(row_position, 2, QTableWidgetItem(date_time))
-        except FileNotFoundError:
-            print("Error: history.csv not found")
-    
+
+    def applyFilter(self):
+        genre = self.genreFilter.currentText()
+        if genre == ALL_GENRES:
+            genre = None
+
+        since = until = None
+        if self.dateFilter.isChecked():
+            # The end date is inclusive
+            since = datetime.combine(self.sinceEdit.date().toPyDate(), time()).timestamp()
+            until = datetime.combine(self.untilEdit.date().toPyDate() + timedelta(days=1),
+                                     time()).timestamp()
+
+        self.model.setFilter(genre, since, until)
+
     def deleteHistory(self):
-        self.table.setRowCount(0)
-        with open(self.history_file, "w") as file:
-            pass
+        self.historyStore.clear()
+        self.genreFilter.blockSignals(True)
+        self.genreFilter.clear()
+        self.genreFilter.addItem(ALL_GENRES)
+        self.genreFilter.blockSignals(False)
+        self.applyFilter()
@@ -0,0 +1,94 @@
+from datetime import datetime
+from typing import Optional
+from PyQt5.QtCore import QAbstractTableModel, QModelIndex, Qt
+from src.core.history_store import HistoryStore
+
+
+# Number of entries read from the store at once
+PAGE_SIZE = 200
+
+DATE_FORMAT = "%H:%M:%S %d-%m-%Y"
+
+
+class HistoryTableModel(QAbstractTableModel):
+    """
+    A table model of the prediction history that reads the store lazily.
+
+    Only the first page of the matching entries is read when the filter
+    changes. Views request the following pages through canFetchMore and
+    fetchMore while they are scrolled, so the cost of opening the history
+    does not depend on its length.
+    """
+    COLUMNS = ["File Name", "Predicted Genre", "Confidence", "Date/Time", "Duration"]
+
+    def __init__(self, historyStore: HistoryStore, parent=None):
+        super().__init__(parent)
+        self.historyStore = historyStore
+        self.entries = []
+        self.totalCount = 0
+        self.genre = None
+        self.since = None
+        self.until = None
+        self.refresh()
+
+    def setFilter(self, genre: Optional[str] = None, since: Optional[float] = None,
+                  until: Optional[float] = None):
+        self.genre = genre
+        self.since = since
+        self.until = until
+        self.refresh()
+
+    def refresh(self):
+        self.beginResetModel()
+        self.entries = []
+        self.totalCount = self.historyStore.count(self.genre, self.since, self.until)
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.entries)
+
+    def columnCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def canFetchMore(self, parent=QModelIndex()) -> bool:
+        return not parent.isValid() and len(self.entries) < self.totalCount
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return
+        after = None
+        if self.entries:
+            after = (self.entries[-1].timestamp, self.entries[-1].id)
+        page = self.historyStore.page(PAGE_SIZE, after, self.genre, self.since, self.until)
+        if not page:
+            # Entries were removed since counting, nothing more to read
+            self.totalCount = len(self.entries)
+            return
+
+        self.beginInsertRows(QModelIndex(), len(self.entries), len(self.entries) + len(page) - 1)
+        self.entries.extend(page)
+        self.endInsertRows()
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+
+        entry = self.entries[index.row()]
+        column = index.column()
+        if column == 0:
+            return entry.file_name
+        if column == 1:
+            return entry.genre
+        if column == 2:
+            return f"{entry.probabilities[entry.genre]:.1%}"
+        if column == 3:
+            return datetime.fromtimestamp(entry.timestamp).strftime(DATE_FORMAT)
+        if entry.elapsed is None:
+            return ""
+        return f"{entry.elapsed:.2f} s"
+
+    def headerData(self, section: int, orientation: Qt.Orientation,
+                   role: int = Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.COLUMNS[section]
+        return None
@@ -1,35 +1,68 @@
 import sys
 import os
+import sqlite3
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QAction, QFileDialog, 
                              QLabel, QPushButton, QLineEdit, QVBoxLayout, QWidget, 
                              QStatusBar, QDialog, QTableWidget, QTableWidgetItem, 
-                             QHeaderView, QMessageBox)
+                             QHeaderView, QMessageBox, QProgressBar)
 
 from PyQt5.QtMultimedia import QMediaPlayer, QMediaContent
-from PyQt5.QtCore import QUrl
+from PyQt5.QtCore import QUrl, QThreadPool
 import joblib
 import librosa
 import pandas as pd
-from typing import Dict
+from collections import OrderedDict
+from typing import Dict, Tuple
 from datetime import datetime
 import src.core.genre_prediction as prediction
 import src.core.audio_feature_extractor as extractor
+from src.core.audio_cache import AudioCache
+from src.core.feature_cache import FeatureCache
+from src.core.history_store import HistoryStore
+from src.core.model_registry import ModelRegistry
 from src.gui.probabilities_dialog import ProbabilitiesDialog
 from src.gui.history_dialog import HistoryDialog
+from src.gui.prediction_worker import PredictionWorker
 
 
 MODEL_PATH = r"models\xgb_model.pkl"
 ENCODER_PATH = r"models\xgb_encoder.pkl"
-HISTORY_FILE = r"src\gui\resources\history.csv"
+HISTORY_FILE = r"src\gui\resources\history.sqlite"
+# History of earlier versions, imported into HISTORY_FILE on start
+LEGACY_HISTORY_FILE = r"src\gui\resources\history.csv"
+FEATURE_CACHE_FILE = r"src\gui\resources\feature_cache.sqlite"
+AUDIO_CACHE_DIRECTORY = r"src\gui\resources\audio_cache"
+# Number of threads the feature blocks of a prediction run on
+BLOCK_WORKERS = min(4, os.cpu_count() or 1)
+# Number of files whose prediction results are kept
+MAX_PREDICTION_RESULTS = 32
 
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
         self._initUI()
-        self.classifier = prediction.MusicGenreClassifier(MODEL_PATH, ENCODER_PATH)
-        self.historyFile = HISTORY_FILE
+        extractor.set_block_workers(BLOCK_WORKERS)
+        self.featureCache = FeatureCache(FEATURE_CACHE_FILE)
+        self.audioCache = AudioCache(AUDIO_CACHE_DIRECTORY)
+        # Models can be swapped while the application runs, every
+        # prediction uses the ensemble that was current when it started
+        self.modelRegistry = ModelRegistry(feature_cache=self.featureCache)
+        self.modelRegistry.load("default", MODEL_PATH, ENCODER_PATH)
+        self.historyStore = HistoryStore(HISTORY_FILE)
+        self.importLegacyHistory()
         self.audio_file_path = None
         
+        # Predictions run on a background thread. A cancelled prediction
+        # stops at its next block or batch of segments, so the next one
+        # starts right after it. The results of the most recently used
+        # files are kept, so that predicting the genre and showing the
+        # probabilities of the same file share one computation.
+        self.threadPool = QThreadPool()
+        self.threadPool.setMaxThreadCount(1)
+        self.worker = None
+        self.pendingActions = set()
+        self.predictionResults = OrderedDict()
+        
     def _initUI(self):
         self.setWindowTitle("Music Genre Classifier")
         self.setGeometry(100, 100, 800, 600)
@@ -50,6 +83,10 @@ class MainWindow(QMainWindow):
         openFile.triggered.connect(self.openFileDialog)
         fileMenu.addAction(openFile)
         
+        loadModel = QAction("Load Model...", self)
+        loadModel.triggered.connect(self.loadModelDialog)
+        fileMenu.addAction(loadModel)
+        
         # History menu
         historyMenu = menubar.addMenu("History")
         
@@ -98,6 +135,16 @@ class MainWindow(QMainWindow):
     def createStatusBar(self):
         self.statusBar = QStatusBar()
         self.setStatusBar(self.statusBar)
+        
+        self.progressBar = QProgressBar()
+        self.progressBar.setRange(0, 100)
+        self.progressBar.setMaximumWidth(200)
+        self.cancelButton = QPushButton("Cancel")
+        self.cancelButton.clicked.connect(self.cancelPrediction)
+        self.statusBar.addPermanentWidget(self.progressBar)
+        self.statusBar.addPermanentWidget(self.cancelButton)
+        self.progressBar.hide()
+        self.cancelButton.hide()
     
     def setUpLayout(self):
         mainLayout = QVBoxLayout()
@@ -133,6 +180,25 @@ class MainWindow(QMainWindow):
             self.player.setMedia(QMediaContent(QUrl.fromLocalFile(filePath)))
             self.statusBar.showMessage("File loaded successfully", 5000)
     
+    def loadModelDialog(self):
+        # Serving artifacts are directories that embed their labels
+        modelPath = QFileDialog.getExistingDirectory(self, "Open Model Artifact")
+        if not modelPath:
+            return
+        
+        try:
+            self.modelRegistry.load("default", modelPath)
+        except (IOError, ValueError) as e:
+            QMessageBox.warning(self, "Load Model", f"Error: {e}")
+            return
+        
+        # Results of the previous model must not be reused
+        if self.worker is not None:
+            self.worker.cancel()
+            self.finishWorker()
+        self.predictionResults.clear()
+        self.statusBar.showMessage(f"Model loaded from {modelPath}", 5000)
+    
     def playAudio(self):
         if self.audio_file_path is not None:
             self.player.play()
@@ -149,38 +215,142 @@ class MainWindow(QMainWindow):
         filePath = self.filePathEdit.text()
         
         if filePath:
-            try:
-                audio_data, _ = extractor.load_audio(filePath)
-                predicted_genre = self.classifier.classify_genre(audio_data)
-                self.predictedGenreEdit.setText(predicted_genre)
-                self.statusBar.showMessage("Genre predicted successfully", 5000)
-                
-                # Save to history
-                with open(self.historyFile, mode="a") as file:
-                    file.write(f"{os.path.basename(filePath)}," + 
-                                f"{predicted_genre}," +
-                                f"{datetime.now().strftime('%H:%M:%S %d-%m-%Y')}\n")
-            except Exception as e:
-                self.statusBar.showMessage(f"Error: {e}", 5000)
+            self.requestPrediction(filePath, "predict")
         else:
             self.statusBar.showMessage("Please load an audio file first", 5000)
 
     def showProbabilities(self):
         filePath = self.filePathEdit.text()
         if filePath:
+            self.requestPrediction(filePath, "probabilities")
+        else:
+            self.statusBar.showMessage("Please load an audio file first", 5000)
+    
+    def requestPrediction(self, filePath: str, action: str):
+        key = self.resultKey(filePath)
+        result = self.predictionResults.get(key)
+        if result is not None:
+            self.predictionResults.move_to_end(key)
+            self.runAction(action, filePath, result)
+            return
+        
+        # Join a prediction of the same file that is already running. A
+        # cancelled worker is no longer current, see cancelPrediction.
+        if self.worker is not None and self.worker.filePath == filePath:
+            self.pendingActions.add(action)
+            return
+        
+        if self.worker is not None:
+            self.worker.cancel()
+        
+        self.worker = PredictionWorker(self.modelRegistry.current(), filePath,
+                                       self.audioCache)
+        self.worker.signals.progress.connect(self.onPredictionProgress)
+        self.worker.signals.finished.connect(self.onPredictionFinished)
+        self.worker.signals.error.connect(self.onPredictionError)
+        self.worker.signals.cancelled.connect(self.onPredictionCancelled)
+        self.pendingActions = {action}
+        
+        self.progressBar.setValue(0)
+        self.progressBar.show()
+        self.cancelButton.show()
+        self.threadPool.start(self.worker)
+    
+    def cancelPrediction(self):
+        # The worker stops in the background, its signals are ignored
+        if self.worker is not None:
+            self.worker.cancel()
+            self.finishWorker()
+            self.statusBar.showMessage("Prediction cancelled", 5000)
+    
+    def isCurrentWorker(self) -> bool:
+        # Signals of replaced or cancelled workers may still be queued, and
+        # their results may come from a model that has been replaced since
+        return self.worker is not None and self.sender() is self.worker.signals
+    
+    def onPredictionProgress(self, percent: int, message: str):
+        if self.isCurrentWorker():
+            self.progressBar.setValue(percent)
+            self.statusBar.showMessage(message)
+    
+    def onPredictionFinished(self, filePath: str, probabilities: Dict[str, float],
+                             fileHash: str, elapsed: float):
+        if not self.isCurrentWorker():
+            return
+        
+        result = (probabilities, fileHash, elapsed)
+        self.predictionResults[self.resultKey(filePath)] = result
+        while len(self.predictionResults) > MAX_PREDICTION_RESULTS:
+            self.predictionResults.popitem(last=False)
+        actions = self.pendingActions
+        self.finishWorker()
+        
+        # Predict before showing the (modal) probabilities dialog
+        for action in ("predict", "probabilities"):
+            if action in actions:
+                self.runAction(action, filePath, result)
+    
+    def onPredictionError(self, filePath: str, message: str):
+        if self.isCurrentWorker():
+            self.finishWorker()
+            self.statusBar.showMessage(f"Error: {message}", 5000)
+    
+    def onPredictionCancelled(self, filePath: str):
+        if self.isCurrentWorker():
+            self.finishWorker()
+            self.statusBar.showMessage("Prediction cancelled", 5000)
+    
+    def finishWorker(self):
+        self.worker = None
+        self.pendingActions = set()
+        self.progressBar.hide()
+        self.cancelButton.hide()
+        self.statusBar.clearMessage()
+    
+    def runAction(self, action: str, filePath: str, result: Tuple[Dict[str, float], str, float]):
+        probabilities, fileHash, elapsed = result
+        if action == "predict":
+            predicted_genre = max(probabilities, key=probabilities.get)
+            if filePath == self.filePathEdit.text():
+                self.predictedGenreEdit.setText(predicted_genre)
+            self.statusBar.showMessage("Genre predicted successfully", 5000)
+            
+            # Save to history
             try:
-                audio_data, _ = extractor.load_audio(filePath)
-                probabilities = self.classifier.predict_probabilities(audio_data)
-                
-                probsDialog = ProbabilitiesDialog(probabilities, self)
-                probsDialog.exec_()
-            except Exception as e:
+                self.historyStore.add(filePath, probabilities, fileHash, elapsed)
+            except sqlite3.Error as e:
                 self.statusBar.showMessage(f"Error: {e}", 5000)
         else:
-            self.statusBar.showMessage("Please load an audio file first", 5000)
+            probsDialog = ProbabilitiesDialog(probabilities, self)
+            probsDialog.exec_()
+    
+    def resultKey(self, filePath: str):
+        # A file that changed on disk has to be predicted again
+        try:
+            return filePath, os.path.getmtime(filePath)
+        except OSError:
+            return filePath, None
+    
+    def closeEvent(self, event):
+        if self.worker is not None:
+            self.worker.cancel()
+        self.threadPool.waitForDone()
+        self.historyStore.close()
+        self.modelRegistry.shutdown()
+        super().closeEvent(event)
+    
+    def importLegacyHistory(self):
+        # The CSV file is renamed afterwards so that it is imported once
+        if not os.path.exists(LEGACY_HISTORY_FILE):
+            return
+        try:
+            self.historyStore.import_csv(LEGACY_HISTORY_FILE)
+            os.replace(LEGACY_HISTORY_FILE, LEGACY_HISTORY_FILE + ".imported")
+        except (OSError, sqlite3.Error) as e:
+            print(f"Error importing {LEGACY_HISTORY_FILE}: {e}")
     
     def viewHistory(self):
-        historyDialog = HistoryDialog(HISTORY_FILE, self)
+        historyDialog = HistoryDialog(self.historyStore, self)
         historyDialog.exec_()
         
     def about(self):
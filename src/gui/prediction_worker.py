@@ -0,0 +1,113 @@
+import threading
+import time
+import numpy as np
+from concurrent.futures import CancelledError
+from typing import Dict, Optional
+from numpy.typing import NDArray
+from PyQt5.QtCore import QObject, QRunnable, pyqtSignal
+import src.core.audio_feature_extractor as extractor
+import src.core.genre_prediction as prediction
+from src.core.audio_cache import AudioCache
+from src.core.model_registry import EnsembleClassifier
+from src.core.history_store import file_hash
+
+
+# Number of 3 second segments extracted between two checks for
+# cancellation
+SEGMENT_BATCH = 4
+
+
+class PredictionSignals(QObject):
+    # Percentage of the work done and a description of the current stage
+    progress = pyqtSignal(int, str)
+    # File path, the probability of each genre, the hash of the file
+    # content and the duration of the prediction in seconds
+    finished = pyqtSignal(str, dict, str, float)
+    # File path and the error message
+    error = pyqtSignal(str, str)
+    # File path
+    cancelled = pyqtSignal(str)
+
+
+class PredictionWorker(QRunnable):
+    """
+    Loads an audio file and predicts its genre probabilities off the
+    GUI thread.
+
+    The file is classified from its 3 second segments, like the GUI has
+    done since the segmented mode was added, so the results are the same
+    as the ones of predict_probabilities(audio_data, segmented=True).
+
+    Results are reported through the signals, which Qt delivers on the
+    thread of the receiving widget. Cancellation stops the decoding
+    between blocks and the feature extraction between batches of
+    SEGMENT_BATCH segments, so the next prediction does not wait for a
+    cancelled one to finish.
+    """
+    def __init__(self, classifier: EnsembleClassifier, filePath: str,
+                 audioCache: Optional[AudioCache] = None, aggregation: str = "mean"):
+        super().__init__()
+        self.classifier = classifier
+        self.filePath = filePath
+        self.audioCache = audioCache
+        self.aggregation = aggregation
+        self.signals = PredictionSignals()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def isCancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def run(self):
+        try:
+            start = time.perf_counter()
+            self.signals.progress.emit(0, "Loading audio...")
+            audio_data, _ = extractor.load_audio(self.filePath, cache=self.audioCache,
+                                                 cancel=self._cancelled)
+            fileHash = file_hash(self.filePath)
+
+            probabilities = self.predictProbabilities(audio_data)
+
+            self.signals.progress.emit(100, "Done")
+            self.signals.finished.emit(self.filePath, probabilities, fileHash,
+                                       time.perf_counter() - start)
+        except CancelledError:
+            self.signals.cancelled.emit(self.filePath)
+        except Exception as e:
+            self.signals.error.emit(self.filePath, str(e))
+
+    def predictProbabilities(self, audio_data: NDArray[np.float32]) -> Dict[str, float]:
+        classifier = self.classifier
+        cache = classifier.feature_cache
+        segments = extractor.segment_audio(audio_data)
+
+        # Segments whose features are cached are not extracted again
+        batches = []
+        if cache is not None:
+            cached = cache.get_leading_segments(audio_data, sampling_rate=classifier.sampling_rate,
+                                                profile=classifier.profile)
+            if cached is not None:
+                batches.append(cached.astype(np.float32))
+        n_cached = extracted = sum(len(batch) for batch in batches)
+
+        while extracted < len(segments):
+            self.signals.progress.emit(40 + 50 * extracted // len(segments),
+                                       "Extracting features...")
+            if self.isCancelled():
+                raise CancelledError()
+            batches.append(extractor.extract_features_batch(
+                segments[extracted:extracted + SEGMENT_BATCH], profile=classifier.profile))
+            extracted = min(extracted + SEGMENT_BATCH, len(segments))
+
+        matrix = np.concatenate(batches)
+        if cache is not None and extracted > n_cached:
+            cache.put_leading_segments(audio_data, matrix, sampling_rate=classifier.sampling_rate,
+                                       profile=classifier.profile)
+        if self.isCancelled():
+            raise CancelledError()
+
+        probabilities = prediction.aggregate_probabilities(
+            classifier.predict_feature_probabilities(matrix), self.aggregation)
+        return dict(zip(classifier.label_encoder.classes_, probabilities))
@@ -0,0 +1,52 @@
+import os
+import numpy as np
+import soundfile as sf
+import src.core.audio_feature_extractor as extractor
+from src.core.audio_cache import AudioCache
+
+
+def write_clips(directory: str, count: int, duration: float = 1.0) -> list:
+    rng = np.random.default_rng(0)
+    paths = []
+    for index in range(count):
+        path = os.path.join(directory, f"clip_{index}.wav")
+        sf.write(path, 0.1 * rng.standard_normal(int(duration * extractor.SAMPLING_RATE)),
+                 extractor.SAMPLING_RATE)
+        paths.append(path)
+    return paths
+
+
+def test_hit_returns_the_decoded_signal(tmp_path):
+    path, = write_clips(tmp_path, 1)
+    cache = AudioCache(os.path.join(tmp_path, "cache"))
+
+    decoded = cache.load(path)
+    cached = cache.load(path)
+
+    np.testing.assert_array_equal(cached, extractor.load_audio(path)[0])
+    np.testing.assert_array_equal(cached, decoded)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_misses_scan_the_directory_only_over_budget(tmp_path, monkeypatch):
+    paths = write_clips(tmp_path, 6)
+    clip_bytes = extractor.SAMPLING_RATE * 4
+    cache = AudioCache(os.path.join(tmp_path, "cache"), max_disk_bytes=int(3.5 * clip_bytes))
+
+    scans = []
+    scan = cache._scan
+    monkeypatch.setattr(cache, "_scan", lambda: scans.append(1) or scan())
+    for path in paths[:3]:
+        cache.load(path)
+    assert not scans
+
+    for path in paths[3:]:
+        cache.load(path)
+    assert len(scans) == 3
+    stats = cache.stats()
+    assert stats["files"] == 3
+    assert stats["disk_bytes"] <= cache.max_disk_bytes
+
+    # The least recently used files were evicted
+    cache.load(paths[0])
+    assert cache.misses == 7
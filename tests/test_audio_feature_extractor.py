@@ -0,0 +1,125 @@
+import librosa
+import numpy as np
+import pytest
+import src.core.audio_feature_extractor as extractor
+from benchmarks.benchmark import synthesize_audio
+
+
+def reference_features(audio_data: np.ndarray) -> dict:
+    # The features as the original extraction computed them, one librosa
+    # call per feature on the raw signal
+    sr = extractor.SAMPLING_RATE
+    features = {}
+    chroma_stft = librosa.feature.chroma_stft(y=audio_data, sr=sr)
+    features["chroma_stft_mean"] = np.mean(chroma_stft)
+    features["chroma_stft_var"] = np.var(chroma_stft)
+    rms = librosa.feature.rms(y=audio_data)
+    features["rms_mean"] = np.mean(rms)
+    features["rms_var"] = np.var(rms)
+    spectral_centroid = librosa.feature.spectral_centroid(y=audio_data, sr=sr)
+    features["spectral_centroid_mean"] = np.mean(spectral_centroid)
+    features["spectral_centroid_var"] = np.var(spectral_centroid)
+    spectral_bandwidth = librosa.feature.spectral_bandwidth(y=audio_data, sr=sr)
+    features["spectral_bandwidth_mean"] = np.mean(spectral_bandwidth)
+    features["spectral_bandwidth_var"] = np.var(spectral_bandwidth)
+    rolloff = librosa.feature.spectral_rolloff(y=audio_data, sr=sr)
+    features["rolloff_mean"] = np.mean(rolloff)
+    features["rolloff_var"] = np.var(rolloff)
+    zero_crossing_rate = librosa.feature.zero_crossing_rate(y=audio_data)
+    features["zero_crossing_rate_mean"] = np.mean(zero_crossing_rate)
+    features["zero_crossing_rate_var"] = np.var(zero_crossing_rate)
+    harmonic, perceptr = librosa.effects.hpss(audio_data)
+    features["harmony_mean"] = np.mean(harmonic)
+    features["harmony_var"] = np.var(harmonic)
+    features["perceptr_mean"] = np.mean(perceptr)
+    features["perceptr_var"] = np.var(perceptr)
+    tempo, _ = librosa.beat.beat_track(y=audio_data, sr=sr)
+    features["tempo"] = np.ravel(tempo)[0]
+    mfccs = librosa.feature.mfcc(y=audio_data, sr=sr, n_mfcc=extractor.N_MFCC)
+    for i in range(extractor.N_MFCC):
+        features[f"mfcc{i + 1}_mean"] = np.mean(mfccs[i])
+        features[f"mfcc{i + 1}_var"] = np.var(mfccs[i])
+    return features
+
+
+def assert_features_close(actual: dict, expected: dict, columns: list):
+    for name in columns:
+        np.testing.assert_allclose(actual[name], expected[name], rtol=extractor.FEATURE_RTOL,
+                                   atol=1e-7, err_msg=name)
+
+
+@pytest.fixture(scope="module")
+def audio_data():
+    return synthesize_audio(3.0)
+
+
+def test_shared_stft_matches_librosa(audio_data):
+    features = extractor.extract_features(audio_data)
+
+    assert list(features) == extractor.FEATURE_COLUMNS
+    assert_features_close(features, reference_features(audio_data), extractor.FEATURE_COLUMNS)
+
+
+def test_profile_is_a_subset_of_the_full_features(audio_data):
+    full = extractor.extract_features(audio_data)
+    fast = extractor.extract_features(audio_data, profile="fast")
+
+    assert list(fast) == extractor.profile_columns("fast")
+    assert_features_close(fast, full, list(fast))
+
+
+def test_segments_match_single_extractions():
+    audio_data = synthesize_audio(10.0)
+    segments = extractor.segment_audio(audio_data)
+    features = extractor.extract_segment_features(audio_data)
+
+    assert len(segments) == 3
+    for index, segment in enumerate(segments):
+        single = extractor.extract_features(segment)
+        assert_features_close({name: values[index] for name, values in features.items()},
+                              single, extractor.FEATURE_COLUMNS)
+
+
+def test_block_workers_give_the_same_features(audio_data):
+    sequential = extractor.extract_features(audio_data)
+    extractor.set_block_workers(4)
+    try:
+        parallel = extractor.extract_features(audio_data)
+    finally:
+        extractor.set_block_workers(None)
+
+    assert parallel == sequential
+
+
+def test_batch_matches_single_extractions():
+    # Two full windows and a padded shorter one, which is processed alone
+    rng = np.random.default_rng(0)
+    window = extractor.SEGMENT_LENGTH
+    clips = np.stack([synthesize_audio(3.0)[:window],
+                      (0.1 * rng.standard_normal(window)).astype(np.float32),
+                      synthesize_audio(3.0, seed=1)[:window]])
+    lengths = np.array([window, window, window // 2])
+    clips[2, window // 2:] = 1.0
+
+    matrix = extractor.extract_features_batch(clips, lengths)
+
+    assert matrix.dtype == np.float32
+    assert matrix.shape == (3, len(extractor.FEATURE_COLUMNS))
+    for row, (clip, length) in enumerate(zip(clips, lengths)):
+        single = extractor.extract_features(clip[:length])
+        expected = [single[name] for name in extractor.FEATURE_COLUMNS]
+        # The batch is stored as float32
+        np.testing.assert_allclose(matrix[row], expected,
+                                   rtol=max(extractor.FEATURE_RTOL, np.finfo(np.float32).eps),
+                                   atol=1e-7)
+
+
+def test_batch_rejects_bad_lengths():
+    clips = np.zeros((2, 1024), dtype=np.float32)
+
+    with pytest.raises(ValueError):
+        extractor.extract_features_batch(clips, [1024])
+    with pytest.raises(ValueError):
+        extractor.extract_features_batch(clips, [1024, 2048])
+    with pytest.raises(ValueError):
+        extractor.extract_features_batch(clips[0])
@@ -0,0 +1,91 @@
+import os
+import numpy as np
+import pytest
+import xgboost as xgb
+from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
+from sklearn.preprocessing import LabelEncoder
+import src.core.model_artifact as model_artifact
+from src.core.compiled_trees import PROBABILITY_ATOL, compile_model
+
+
+N_CLASSES = 4
+
+
+def make_data(seed: int = 0, n_rows: int = 600, n_features: int = 8):
+    rng = np.random.default_rng(seed)
+    X = rng.standard_normal((n_rows, n_features)).astype(np.float32)
+    y = (np.digitize(X[:, 0] + 0.5 * X[:, 1] * X[:, 2], [-0.7, 0, 0.7])
+         + rng.integers(0, 2, n_rows)) % N_CLASSES
+    return X, y
+
+
+def make_model(family: str, X, y):
+    if family == "rf":
+        return RandomForestClassifier(n_estimators=30, max_depth=8, random_state=0).fit(X, y)
+    if family == "gbm":
+        return GradientBoostingClassifier(n_estimators=20, max_depth=3,
+                                          random_state=0).fit(X, y)
+    return xgb.XGBClassifier(n_estimators=30, max_depth=4, random_state=0).fit(X, y)
+
+
+def assert_equivalent(compiled, model, X):
+    np.testing.assert_allclose(compiled.predict_proba(X), model.predict_proba(X),
+                               atol=PROBABILITY_ATOL, rtol=0)
+
+
+@pytest.mark.parametrize("family", ["rf", "gbm", "xgb"])
+def test_compiled_model_matches_original(family):
+    X, y = make_data()
+    model = make_model(family, X, y)
+    X_test, _ = make_data(seed=1)
+
+    compiled = compile_model(model, check_features=X_test)
+
+    assert_equivalent(compiled, model, X_test)
+    # Values exactly at the thresholds take the same branch
+    assert_equivalent(compiled, model, np.round(X_test, 1))
+    np.testing.assert_array_equal(compiled.predict(X_test), model.predict(X_test))
+
+
+@pytest.mark.parametrize("family", ["rf", "gbm", "xgb"])
+def test_compiled_artifact_matches_original(family, tmp_path):
+    X, y = make_data()
+    model = make_model(family, X, y)
+    labels = LabelEncoder().fit(np.arange(N_CLASSES))
+    path = os.path.join(tmp_path, family)
+    model_artifact.export_model(model, labels, [f"f{index}" for index in range(X.shape[1])],
+                                path)
+    artifact, _ = model_artifact.load_model(path)
+    X_test, _ = make_data(seed=1)
+
+    assert_equivalent(compile_model(artifact), artifact, X_test)
+
+
+@pytest.mark.parametrize("family", ["rf", "xgb"])
+def test_missing_values_follow_the_default_direction(family):
+    X, y = make_data()
+    rng = np.random.default_rng(2)
+    X[rng.random(X.shape) < 0.2] = np.nan
+    model = make_model(family, X, y)
+    X_test, _ = make_data(seed=1)
+    X_test[rng.random(X_test.shape) < 0.2] = np.nan
+
+    if family == "xgb":
+        # Both directions occur, so NaN cannot always go right
+        trees = model.get_booster().trees_to_dataframe()
+        splits = trees[trees["Feature"] != "Leaf"]
+        assert (splits["Missing"] == splits["Yes"]).any()
+        assert (splits["Missing"] == splits["No"]).any()
+
+    assert_equivalent(compile_model(model), model, X_test)
+
+
+def test_compile_rejects_a_compiled_model_that_differs():
+    X, y = make_data()
+    model = make_model("rf", X, y)
+    assert compile_model(model).n_trees == 30
+
+    # Stands in for a model the engine gets wrong
+    model.predict_proba = lambda X: RandomForestClassifier.predict_proba(model, X)[:, ::-1]
+    with pytest.raises(ValueError, match="differs from the original model"):
+        compile_model(model)
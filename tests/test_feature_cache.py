@@ -0,0 +1,90 @@
+import os
+import numpy as np
+import pytest
+import src.core.audio_feature_extractor as extractor
+from src.core.feature_cache import FeatureCache
+
+
+def make_audio(seed: int, duration: float = 0.5) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return (0.1 * rng.standard_normal(int(duration * extractor.SAMPLING_RATE))).astype(np.float32)
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return os.path.join(tmp_path, "features.sqlite")
+
+
+def test_hit_returns_the_extracted_features(db_path):
+    cache = FeatureCache(db_path)
+    audio_data = make_audio(0)
+
+    features = cache.extract_features(audio_data)
+    cached = cache.extract_features(audio_data.copy())
+
+    assert cached == features
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+    cache.close()
+
+
+def test_disk_tier_survives_a_restart(db_path):
+    audio_data = make_audio(0)
+    cache = FeatureCache(db_path)
+    features = cache.extract_segment_features(audio_data, segment_length=4096)
+    cache.close()
+
+    cache = FeatureCache(db_path)
+    cached = cache.extract_segment_features(audio_data, segment_length=4096)
+
+    assert cache.stats()["disk_hits"] == 1
+    assert list(cached) == list(features)
+    for name in features:
+        np.testing.assert_array_equal(cached[name], features[name])
+    cache.close()
+
+
+def test_key_depends_on_version_profile_and_segmentation(db_path, monkeypatch):
+    cache = FeatureCache(db_path)
+    audio_data = make_audio(0)
+    cache.extract_features(audio_data)
+
+    cache.extract_features(audio_data, profile="fast")
+    cache.extract_segment_features(audio_data)
+    cache.extract_features(audio_data, sampling_rate=16000)
+    monkeypatch.setattr(extractor, "FEATURE_VERSION", extractor.FEATURE_VERSION + 1)
+    cache.extract_features(audio_data)
+
+    assert cache.stats()["hits"] == 0 and cache.stats()["misses"] == 5
+    cache.close()
+
+
+def test_memory_tier_evicts_the_least_recently_used():
+    entry_bytes = len(extractor.FEATURE_COLUMNS) * 8
+    cache = FeatureCache(max_memory_bytes=2 * entry_bytes)
+    first, second, third = make_audio(0), make_audio(1), make_audio(2)
+    cache.extract_features(first)
+    cache.extract_features(second)
+    cache.extract_features(first)
+
+    cache.extract_features(third)
+
+    assert cache.stats()["memory_bytes"] == 2 * entry_bytes
+    cache.extract_features(first)
+    assert cache.stats()["hits"] == 2
+    cache.extract_features(second)
+    assert cache.stats()["misses"] == 4
+
+
+def test_disk_tier_stays_within_budget(db_path):
+    entry_bytes = len(extractor.FEATURE_COLUMNS) * 8
+    cache = FeatureCache(db_path, max_memory_bytes=0, max_disk_bytes=3 * entry_bytes)
+    clips = [make_audio(seed) for seed in range(5)]
+    for clip in clips:
+        cache.extract_features(clip)
+
+    assert cache.stats()["disk_bytes"] <= 3 * entry_bytes
+    # The last clip is also in memory, the third oldest only on disk
+    cache.extract_features(clips[2])
+    cache.extract_features(clips[0])
+    assert cache.stats()["disk_hits"] == 1 and cache.stats()["misses"] == 6
+    cache.close()
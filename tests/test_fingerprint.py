@@ -0,0 +1,103 @@
+import os
+import tracemalloc
+import numpy as np
+import pytest
+import soundfile as sf
+import src.core.audio_feature_extractor as extractor
+from src.core.fingerprint import (FRAME_HOP, MAX_BIT_ERROR_RATE, Fingerprint, FingerprintIndex,
+                                  compute_fingerprint)
+
+
+def synthesize_track(seed: int, duration: float = 30.0,
+                     sampling_rate: int = extractor.SAMPLING_RATE) -> np.ndarray:
+    # A melody of random notes of a scale with decaying harmonics over
+    # noise bursts at 120 BPM, different for every seed
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sampling_rate)) / sampling_rate
+    signal = np.zeros_like(t)
+    scale = 220.0 * 2 ** (np.array([0, 2, 4, 5, 7, 9, 11, 12, 14, 16]) / 12)
+    note_length = int(0.25 * sampling_rate)
+    for start in range(0, len(t), note_length):
+        stop = min(len(t), start + int(1.5 * note_length))
+        frequency = rng.choice(scale)
+        envelope = np.exp(-6 * t[:stop - start])
+        for harmonic in range(1, 5):
+            signal[start:stop] += (envelope * np.sin(2 * np.pi * frequency * harmonic
+                                                     * t[:stop - start]) / harmonic)
+
+    beat_phase = (t * 2.0) % 1.0
+    signal += 0.8 * np.exp(-beat_phase * 30) * rng.standard_normal(len(t))
+    signal += 0.02 * rng.standard_normal(len(t))
+    return (0.9 * signal / np.max(np.abs(signal))).astype(np.float32)
+
+
+@pytest.fixture
+def low_bitrate_copy(tmp_path):
+    # The original track and a real MP3 re-encode of it at the lowest
+    # bitrate, decoded like any input of a batch job
+    if "MP3" not in sf.available_formats():
+        pytest.skip("libsndfile cannot write MP3")
+    original = synthesize_track(1)
+    path = os.path.join(tmp_path, "copy.mp3")
+    sf.write(path, original, extractor.SAMPLING_RATE, format="MP3",
+             subtype="MPEG_LAYER_III", compression_level=0.9, bitrate_mode="CONSTANT")
+    copy, _ = extractor.load_audio(path)
+    return original, copy
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = FingerprintIndex(os.path.join(tmp_path, "fingerprints.sqlite"))
+    yield index
+    index.close()
+
+
+@pytest.mark.parametrize("trim", [0, 100, 3001, 2 * extractor.SAMPLING_RATE + 77])
+def test_trimmed_reencode_matches(low_bitrate_copy, index, trim):
+    # None of the trims is a whole number of fingerprint frames
+    original, copy = low_bitrate_copy
+    track_id = index.add("original.wav", compute_fingerprint(original).words)
+    index.add("other.wav", compute_fingerprint(synthesize_track(2)).words)
+
+    match = index.find(compute_fingerprint(copy[trim:]))
+
+    assert match is not None
+    assert match.track_id == track_id
+    # The low bitrate copy really differs in many bits
+    assert 0.1 < match.bit_error_rate <= MAX_BIT_ERROR_RATE
+
+
+def test_unrelated_track_does_not_match(index):
+    index.add("original.wav", compute_fingerprint(synthesize_track(1)).words)
+
+    assert index.find(compute_fingerprint(synthesize_track(3))) is None
+
+
+def test_copy_is_found_by_hash(index):
+    track_id = index.add("original.wav", compute_fingerprint(synthesize_track(1)).words,
+                         "original-hash")
+    index.add_copy("copy-hash", track_id)
+
+    assert index.find_exact("original-hash") == track_id
+    assert index.find_exact("copy-hash") == track_id
+    assert index.find_exact("unknown-hash") is None
+
+
+def test_long_query_memory_is_bounded(index):
+    # Ten minutes of fingerprint at a hop of FRAME_HOP samples. Generating
+    # the variants of all frames at once took about 650 MB.
+    rng = np.random.default_rng(0)
+    n_words = int(600 * extractor.SAMPLING_RATE / FRAME_HOP)
+    words = rng.integers(0, 2 ** 32, n_words, dtype=np.uint64).astype(np.uint32)
+    reliability = rng.random((n_words, 32), dtype=np.float32)
+    track_id = index.add("long.wav", words)
+
+    tracemalloc.start()
+    try:
+        match = index.find(Fingerprint(words, reliability))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert match is not None and match.track_id == track_id
+    assert peak < 128 * 2 ** 20
@@ -0,0 +1,93 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import soundfile as sf
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.preprocessing import LabelEncoder
+import src.core.audio_feature_extractor as extractor
+import src.core.batch as batch
+import src.core.model_artifact as model_artifact
+from benchmarks.benchmark import synthesize_audio
+from src.core.feature_cache import FeatureCache
+from src.core.genre_prediction import MusicGenreClassifier
+
+GENRES = ["blues", "jazz", "rock"]
+
+
+@pytest.fixture(scope="module")
+def model_path(tmp_path_factory):
+    # A forest on random features of the fast profile, whose predictions
+    # are never certain enough for an early exit at a margin of 1
+    rng = np.random.default_rng(0)
+    columns = extractor.profile_columns("fast")
+    X = pd.DataFrame(rng.standard_normal((200, len(columns))).astype(np.float32),
+                     columns=columns)
+    labels = LabelEncoder().fit(GENRES)
+    y = labels.transform(np.resize(GENRES, len(X)))
+    model = RandomForestClassifier(n_estimators=10, max_depth=4, random_state=0).fit(X, y)
+    path = os.path.join(tmp_path_factory.mktemp("model"), "model")
+    model_artifact.export_model(model, labels, columns, path)
+    return path
+
+
+@pytest.fixture
+def count_extracted(monkeypatch):
+    # Number of segments extracted by extract_features_batch
+    counts = []
+    extract = extractor.extract_features_batch
+
+    def counting(clips, *args, **kwargs):
+        counts.append(len(clips))
+        return extract(clips, *args, **kwargs)
+    monkeypatch.setattr(extractor, "extract_features_batch", counting)
+    return counts
+
+
+def test_progressive_reuses_cached_segments(model_path, tmp_path, count_extracted):
+    audio_data = synthesize_audio(15.0)
+    cache = FeatureCache(os.path.join(tmp_path, "features.sqlite"))
+    classifier = MusicGenreClassifier(model_path, feature_cache=cache)
+
+    # Stops after the first segments, which the next calls reuse
+    first = classifier.predict_progressive(audio_data, threshold=0.0, min_segments=2)
+    assert (first.segments_used, sum(count_extracted)) == (2, 2)
+    again = classifier.predict_progressive(audio_data, threshold=0.0, min_segments=2)
+    assert sum(count_extracted) == 2
+    assert again.probabilities == first.probabilities
+
+    complete = classifier.predict_progressive(audio_data, threshold=1.0, min_segments=2)
+    assert complete.segments_used == complete.total_segments == 5
+    assert sum(count_extracted) == 5
+
+    # The complete entry is reused by segmented mode, a partial one is not
+    uncached = MusicGenreClassifier(model_path).predict_probabilities(audio_data,
+                                                                      segmented=True)
+    cached = classifier.predict_probabilities(audio_data, segmented=True)
+    assert cached.keys() == uncached.keys()
+    np.testing.assert_allclose(list(cached.values()), list(uncached.values()), atol=1e-6)
+    assert cache.stats()["misses"] == 1
+    cache.close()
+
+
+def test_batch_progressive_workers_load_the_model(model_path, tmp_path):
+    audio_path = os.path.join(tmp_path, "track.wav")
+    sf.write(audio_path, synthesize_audio(10.0), extractor.SAMPLING_RATE)
+    output_path = os.path.join(tmp_path, "results.jsonl")
+    cache_path = os.path.join(tmp_path, "features.sqlite")
+    writer = batch.ResultWriter(output_path, GENRES, "jsonl")
+
+    classified, failed = batch.classify_files([audio_path], MusicGenreClassifier(model_path),
+                                              writer, workers=1, cache_path=cache_path,
+                                              early_exit=1.0)
+    writer.close()
+
+    assert (classified, failed) == (1, 0)
+    with open(output_path) as file:
+        assert json.loads(file.readline())["genre"] in GENRES
+    # All three segments were classified and cached by the worker
+    cache = FeatureCache(cache_path)
+    audio_data, _ = extractor.load_audio(audio_path)
+    assert len(cache.get_leading_segments(audio_data, profile="fast")) == 3
+    cache.close()
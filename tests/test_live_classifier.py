@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from sklearn.preprocessing import LabelEncoder
+import src.core.audio_feature_extractor as extractor
+from benchmarks.benchmark import synthesize_audio
+from src.core.live_classifier import (HOP_LENGTH, LIVE_MEAN_TOLERANCE, LIVE_RTOL,
+                                      LiveGenreTracker, RingBuffer)
+
+
+class RecordingClassifier:
+    # Stands in for a classifier and keeps the feature rows of the windows
+    sampling_rate = extractor.SAMPLING_RATE
+
+    def __init__(self, profile: str):
+        self.profile = profile
+        self.feature_columns = extractor.profile_columns(profile)
+        self.label_encoder = LabelEncoder().fit(["blues", "rock"])
+        self.rows = []
+
+    def predict_feature_probabilities(self, features):
+        self.rows.append(features[0])
+        return np.full((1, 2), 0.5)
+
+
+def test_ring_buffer_keeps_the_latest_items():
+    buffer = RingBuffer(4)
+    buffer.extend(np.arange(3))
+    buffer.extend(np.arange(3, 9))
+
+    np.testing.assert_array_equal(buffer.read(5, 9), [5, 6, 7, 8])
+    with pytest.raises(ValueError):
+        buffer.read(4, 6)
+    with pytest.raises(ValueError):
+        buffer.read(8, 10)
+
+
+@pytest.mark.parametrize("profile, seed", [("full", 0), ("fast", 1)])
+def test_window_features_match_offline(profile, seed):
+    audio_data = synthesize_audio(8.0, seed=seed)
+    classifier = RecordingClassifier(profile)
+    tracker = LiveGenreTracker(classifier, smoothing_seconds=0)
+
+    # Blocks of an odd size, like the ones of an audio device
+    estimates = [estimate for start in range(0, len(audio_data), 1000)
+                 for estimate in tracker.push(audio_data[start:start + 1000])]
+
+    assert len(estimates) == len(classifier.rows) > 5
+    for estimate, row in zip(estimates, classifier.rows):
+        # The last frame of the window is centered on the sample at
+        # estimate.time, the first one on the first sample of the window
+        end = int(round(estimate.time * extractor.SAMPLING_RATE / HOP_LENGTH)) + 1
+        start = (end - tracker.window_frames) * HOP_LENGTH
+        expected = extractor.extract_features(
+            audio_data[start:start + extractor.SEGMENT_LENGTH], profile)
+
+        for name, value in zip(classifier.feature_columns, row):
+            if name.endswith("_mean"):
+                std = np.sqrt(expected[name[:-len("_mean")] + "_var"])
+                assert abs(value - expected[name]) <= LIVE_MEAN_TOLERANCE * std, name
+            else:
+                np.testing.assert_allclose(value, expected[name], rtol=LIVE_RTOL, err_msg=name)
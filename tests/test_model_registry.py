@@ -0,0 +1,102 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.preprocessing import LabelEncoder
+import src.core.audio_feature_extractor as extractor
+import src.core.model_artifact as model_artifact
+from src.core.genre_prediction import MusicGenreClassifier
+from src.core.model_registry import ModelRegistry
+
+GENRES = ["blues", "jazz", "rock"]
+
+
+def make_features(profile: str, seed: int, n_rows: int = 200) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    columns = extractor.profile_columns(profile)
+    return pd.DataFrame(rng.standard_normal((n_rows, len(columns))).astype(np.float32),
+                        columns=columns)
+
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory):
+    # Three small forests on random features, one of them on the fast
+    # profile, and one with different genres
+    directory = tmp_path_factory.mktemp("models")
+    specs = {"a": ("full", GENRES), "b": ("full", GENRES), "fast": ("fast", GENRES),
+             "other": ("full", ["pop", "rock", "soul"])}
+    for seed, (name, (profile, genres)) in enumerate(specs.items()):
+        X = make_features(profile, seed)
+        labels = LabelEncoder().fit(genres)
+        y = labels.transform(np.resize(genres, len(X)))
+        model = RandomForestClassifier(n_estimators=10, max_depth=4, random_state=seed).fit(X, y)
+        model_artifact.export_model(model, labels, list(X.columns), os.path.join(directory, name))
+    return directory
+
+
+@pytest.fixture
+def registry():
+    registry = ModelRegistry()
+    yield registry
+    registry.shutdown()
+
+
+def test_single_model_matches_its_classifier(registry, model_dir):
+    path = os.path.join(model_dir, "a")
+    ensemble = registry.load("a", path)
+    X = make_features("full", 10).values
+
+    np.testing.assert_allclose(ensemble.predict_feature_probabilities(X),
+                               MusicGenreClassifier(path).predict_feature_probabilities(X))
+
+
+def test_ensemble_is_the_weighted_average(registry, model_dir):
+    registry.load("a", os.path.join(model_dir, "a"))
+    registry.load("fast", os.path.join(model_dir, "fast"), weight=3.0)
+    ensemble = registry.current()
+    X = make_features("full", 10).values
+    fast_columns = [ensemble.feature_columns.index(name)
+                    for name in extractor.profile_columns("fast")]
+
+    expected = (MusicGenreClassifier(os.path.join(model_dir, "a"))
+                .predict_feature_probabilities(X)
+                + 3.0 * MusicGenreClassifier(os.path.join(model_dir, "fast"))
+                .predict_feature_probabilities(X[:, fast_columns])) / 4.0
+
+    # The features cover both profiles and are extracted once
+    assert ensemble.profile == "full"
+    np.testing.assert_allclose(ensemble.predict_feature_probabilities(X), expected)
+    assert registry.models() == {"a": {"weight": 1.0, "profile": "full"},
+                                 "fast": {"weight": 3.0, "profile": "fast"}}
+
+
+def test_swap_keeps_the_ensemble_of_running_requests(registry, model_dir):
+    registry.load("a", os.path.join(model_dir, "a"))
+    registry.load("b", os.path.join(model_dir, "b"))
+    running = registry.current()
+    X = make_features("full", 10).values
+    before = running.predict_feature_probabilities(X)
+
+    # A third model needs a larger pool, the previous one is shut down
+    swapped = registry.load("fast", os.path.join(model_dir, "fast"))
+    reweighted = registry.set_weights({"a": 2.0})
+
+    assert registry.current() is reweighted
+    assert [swapped.version, reweighted.version] == [running.version + 1, running.version + 2]
+    assert [member.name for member in running.members] == ["a", "b"]
+    assert running._executor is not reweighted._executor
+    assert running._executor._shutdown
+    np.testing.assert_array_equal(running.predict_feature_probabilities(X), before)
+
+
+def test_failed_update_leaves_the_registry_unchanged(registry, model_dir):
+    current = registry.load("a", os.path.join(model_dir, "a"))
+
+    with pytest.raises(ValueError, match="different genres"):
+        registry.load("other", os.path.join(model_dir, "other"))
+    with pytest.raises(ValueError):
+        registry.remove("a")
+
+    assert registry.current() is current
+    assert list(registry.models()) == ["a"]
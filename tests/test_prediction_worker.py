@@ -0,0 +1,93 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import soundfile as sf
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.preprocessing import LabelEncoder
+import src.core.audio_feature_extractor as extractor
+import src.core.model_artifact as model_artifact
+from benchmarks.benchmark import synthesize_audio
+from src.core.feature_cache import FeatureCache
+from src.core.model_registry import ModelRegistry
+
+pytest.importorskip("PyQt5")
+from src.gui.prediction_worker import SEGMENT_BATCH, PredictionWorker  # noqa: E402
+
+GENRES = ["blues", "jazz", "rock"]
+
+
+@pytest.fixture
+def classifier(tmp_path):
+    rng = np.random.default_rng(0)
+    columns = extractor.profile_columns("fast")
+    X = pd.DataFrame(rng.standard_normal((200, len(columns))).astype(np.float32),
+                     columns=columns)
+    labels = LabelEncoder().fit(GENRES)
+    y = labels.transform(np.resize(GENRES, len(X)))
+    model = RandomForestClassifier(n_estimators=10, max_depth=4, random_state=0).fit(X, y)
+    path = os.path.join(tmp_path, "model")
+    model_artifact.export_model(model, labels, columns, path)
+
+    registry = ModelRegistry(feature_cache=FeatureCache())
+    yield registry.load("default", path)
+    registry.shutdown()
+
+
+@pytest.fixture
+def audio_path(tmp_path):
+    # Eleven segments, three batches of extraction
+    path = os.path.join(tmp_path, "track.wav")
+    sf.write(path, synthesize_audio(33.0), extractor.SAMPLING_RATE)
+    return path
+
+
+def run_worker(worker: PredictionWorker) -> dict:
+    # The signals are delivered directly, there is no other thread
+    events = {"progress": []}
+    worker.signals.progress.connect(lambda percent, message: events["progress"].append(percent))
+    worker.signals.finished.connect(lambda *result: events.update(finished=result))
+    worker.signals.error.connect(lambda *error: events.update(error=error))
+    worker.signals.cancelled.connect(lambda filePath: events.update(cancelled=filePath))
+    worker.run()
+    return events
+
+
+def test_worker_predicts_the_segments(classifier, audio_path):
+    events = run_worker(PredictionWorker(classifier, audio_path))
+
+    audio_data, _ = extractor.load_audio(audio_path)
+    expected = classifier.predict_probabilities(audio_data, segmented=True)
+    filePath, probabilities, _, _ = events["finished"]
+    assert filePath == audio_path
+    assert probabilities.keys() == expected.keys()
+    np.testing.assert_allclose(list(probabilities.values()), list(expected.values()),
+                               atol=1e-6)
+
+
+def test_cancel_stops_the_extraction(classifier, audio_path, monkeypatch):
+    extracted = []
+    extract = extractor.extract_features_batch
+
+    def counting(clips, *args, **kwargs):
+        extracted.append(len(clips))
+        return extract(clips, *args, **kwargs)
+    monkeypatch.setattr(extractor, "extract_features_batch", counting)
+
+    worker = PredictionWorker(classifier, audio_path)
+    worker.signals.progress.connect(lambda *_: worker.cancel() if extracted else None)
+    events = run_worker(worker)
+
+    assert events["cancelled"] == audio_path
+    assert "finished" not in events
+    assert extracted == [SEGMENT_BATCH]
+
+
+def test_cancel_stops_the_decoding(classifier, audio_path):
+    worker = PredictionWorker(classifier, audio_path)
+    worker.cancel()
+
+    events = run_worker(worker)
+
+    assert events["cancelled"] == audio_path
+    assert events["progress"] == [0]
@@ -0,0 +1,34 @@
+import os
+import numpy as np
+import pytest
+import soundfile as sf
+import src.core.audio_feature_extractor as extractor
+from benchmarks.benchmark import synthesize_audio
+from src.core.streaming_features import extract_features_streaming
+
+
+@pytest.fixture(scope="module")
+def track_path(tmp_path_factory):
+    # 20 seconds at 44.1 kHz, processed in chunks of 4 seconds
+    path = os.path.join(tmp_path_factory.mktemp("streaming"), "track.wav")
+    sf.write(path, synthesize_audio(20.0, sampling_rate=44100), 44100)
+    return path
+
+
+@pytest.mark.parametrize("profile, resampler", [("full", "soxr_hq"), ("fast", "soxr_qq")])
+def test_streaming_matches_offline(track_path, profile, resampler):
+    features = extract_features_streaming(track_path, block_seconds=4.0, profile=profile,
+                                          resampler=resampler)
+    audio_data, _ = extractor.load_audio(track_path, resampler)
+    expected = extractor.extract_features(audio_data, profile)
+
+    assert list(features) == extractor.profile_columns(profile)
+    for name in expected:
+        # Means close to zero, such as harmony_mean, only agree absolutely
+        np.testing.assert_allclose(features[name], expected[name],
+                                   rtol=extractor.FEATURE_RTOL, atol=1e-7, err_msg=name)
+
+
+def test_streaming_rejects_whole_signal_resamplers(track_path):
+    with pytest.raises(ValueError, match="polyphase"):
+        extract_features_streaming(track_path, resampler="polyphase")